@@ -0,0 +1,385 @@
+"""
+Benchmark ingest, aggregation and plotting on synthetic stats databases
+
+Everything runs offline, in a temporary directory, which is also used as
+PRISMS_CODE_STATS_DIR so no tokens are read. Synthetic GitHub and
+Travis stats are generated for each scale (number of repos x years, with
+gaps), loaded, aggregated and plotted, and the timings written to JSON.
+
+    python benchmark.py --repos 10 100 --years 1 5 --output bench.json
+    python benchmark.py --repos 10 100 --years 1 5 --compare bench.json
+
+With --compare, timings are printed next to those of an earlier run, and
+the exit status is 1 if any got slower by more than --threshold.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import code_stats as cs
+
+# synthetic stats end on this Friday, so that weeks end on `rollup_day_index`
+# and the missing data rules' 2020 to 2022 weeks are covered with enough years
+end_date = datetime.date(2024, 12, 27)
+
+# repos `plot.area_plot` and `plot.make_plots` expect, always included
+plot_repos = [
+    "prisms-center/prisms_jobs",
+    "prisms-center/pbs",
+    "prisms-center/CASMcode",
+    "prisms-center/phaseField",
+    "prisms-center/plasticity",
+    "dftfeDevelopers/dftfe",
+    "prisms-center/Fatigue",
+]
+
+
+def synthetic_repo_names(n_repos):
+    """
+    :return: list of str, `plot_repos` and then "bench-org/repo0000", ...,
+        at least len(plot_repos) names
+    """
+    names = list(plot_repos)
+    i = 0
+    while len(names) < n_repos:
+        names.append("bench-org/repo" + str(i).zfill(4))
+        i += 1
+    return names
+
+
+def synthetic_days(rng, years):
+    """
+    :return: numpy.ndarray of int, ordinal days with stats for one repo: from
+        a random start in the first third of the period to `end_date`,
+        without a few random gaps of 1 to 60 days
+    """
+    last = cs.toordinal(end_date)
+    first = last - int(365.25 * years) + 1
+    first += int(rng.integers(0, max((last - first) // 3, 1)))
+    keep = np.ones(last - first + 1, dtype=bool)
+    for i in range(int(rng.integers(0, 4))):
+        begin = int(rng.integers(0, len(keep)))
+        keep[begin : begin + int(rng.integers(1, 61))] = False
+    return np.arange(first, last + 1)[keep]
+
+
+def synthetic_stats(n_repos, years, seed=0):
+    """
+    :return: list of (repo_name, days, values), with values an int64 array
+        of shape (len(days), 4) of views, unique_views, clones, unique_clones
+    """
+    rng = np.random.default_rng(seed)
+    stats = []
+    for repo_name in synthetic_repo_names(n_repos):
+        days = synthetic_days(rng, years)
+        scale = rng.uniform(0.5, 50.0)
+        views = rng.poisson(scale, len(days))
+        unique_views = rng.binomial(views, 0.3)
+        clones = rng.poisson(scale / 10.0, len(days))
+        unique_clones = rng.binomial(clones, 0.6)
+        stats.append(
+            (
+                repo_name,
+                days,
+                np.stack([views, unique_views, clones, unique_clones], axis=1),
+            )
+        )
+    return stats
+
+
+def github_rows(db, stats):
+    """:return: generator of (repo_id, day, record) for `StatsBase.upsert_stats`"""
+    cols = ["views", "unique_views", "clones", "unique_clones"]
+    for repo_name, days, values in stats:
+        repo_id = db.get_repo_id(repo_name)
+        for day, row in zip(days.tolist(), values.tolist()):
+            yield (repo_id, day, dict(zip(cols, row)))
+
+
+def travis_rows(db, stats, seed=0):
+    """:return: generator of build_count rows, for every other repo, ~2 days/week"""
+    rng = random.Random(seed)
+    for repo_name, days, values in stats[::2]:
+        repo_id = db.get_repo_id(repo_name)
+        for day in days.tolist():
+            if rng.random() < 0.3:
+                yield (repo_id, day, {"build_count": rng.randint(1, 6)})
+
+
+def write_legacy_file(path, orgname, stats):
+    """
+    Write stats in the clone-scraper format read by `create_from_legacy_data`,
+    the first half of each repo's days as "type 1" lines, the rest "type 2"
+
+    :return: int, number of data lines
+    """
+    count = 0
+    with open(path, "w") as f:
+        for repo_name, days, values in stats:
+            f.write(repo_name.split("/")[-1] + " Daily Statistics:\n")
+            half = len(days) // 2
+            for i, (day, row) in enumerate(zip(days.tolist(), values.tolist())):
+                date = cs.fromordinal(day).isoformat()
+                if i < half:
+                    f.write(date + " 19:00:00 -0500\t" + "\t".join(map(str, row)) + "\n")
+                else:
+                    f.write(date + "T00\t" + "\t\t".join(map(str, row)) + "\n")
+                count += 1
+            f.write("\n")
+    return count
+
+
+class Benchmark(object):
+    """Collects timings, as dicts, for one (repos, years) scale"""
+
+    def __init__(self, results, n_repos, years):
+        self.results = results
+        self.n_repos = n_repos
+        self.years = years
+
+    def time(self, name, n, func, *args, **kwargs):
+        """
+        Call `func(*args, **kwargs)` and record how long it took
+
+        :param name: str, benchmark name
+        :param n: int, number of items (rows, charts, ...) processed
+        :return: the result of `func`
+        """
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.results.append(
+            {
+                "name": name,
+                "repos": self.n_repos,
+                "years": self.years,
+                "n": n,
+                "seconds": seconds,
+                "per_second": n / seconds if seconds > 0 else None,
+            }
+        )
+        print(
+            "  " + name + ":", round(seconds, 4), "s,", n, "items,",
+            int(n / seconds) if seconds > 0 else "-", "/s",
+        )
+        return value
+
+
+def chdir_new(root, name):
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    os.chdir(path)
+    return path
+
+
+def run_scale(results, root, n_repos, years, per_row_limit, seed=0):
+    from code_stats import GithubStats, TravisStats
+    import code_stats_data as csd
+    import create_from_legacy_data
+
+    n_repos = max(n_repos, len(plot_repos))
+    print("repos:", n_repos, "years:", years)
+    bench = Benchmark(results, n_repos, years)
+    stats = synthetic_stats(n_repos, years, seed=seed)
+    n_rows = sum(len(days) for repo_name, days, values in stats)
+    repo_names = [repo_name for repo_name, days, values in stats]
+
+    # legacy import, into its own database
+    chdir_new(root, "legacy-" + str(n_repos) + "-" + str(years))
+    legacy_path = os.path.abspath("legacy.txt")
+    n_lines = write_legacy_file(legacy_path, "bench", stats)
+    legacy_repos = ["bench/" + repo_name.split("/")[-1] for repo_name in repo_names]
+    with create_from_legacy_data.open_legacy_file(legacy_path) as f:
+        bench.time(
+            "legacy_import",
+            n_lines,
+            create_from_legacy_data.create_from_legacy,
+            "bench",
+            legacy_repos,
+            f,
+        )
+
+    # row by row `_insert_or_update_stats`, one commit, on at most per_row_limit rows
+    chdir_new(root, "per-row-" + str(n_repos) + "-" + str(years))
+    db = GithubStats()
+    db.connect()
+    for repo_name in repo_names:
+        db.add_repo(repo_name)
+
+    def insert_rows(rows):
+        n = 0
+        for repo_id, day, record in rows:
+            if n == per_row_limit:
+                break
+            db._insert_or_update_stats(repo_id, day, record)
+            n += 1
+        db.conn.commit()
+        return n
+
+    n = min(n_rows, per_row_limit)
+    bench.time("insert_or_update_stats", n, insert_rows, github_rows(db, stats))
+    db.close()
+
+    # bulk `upsert_stats`, building the databases used below
+    chdir_new(root, "db-" + str(n_repos) + "-" + str(years))
+    db = GithubStats()
+    db.connect()
+    for repo_name in repo_names:
+        db.add_repo(repo_name)
+    bench.time("upsert_stats", n_rows, db.upsert_stats, github_rows(db, stats))
+    travis_db = TravisStats()
+    travis_db.connect()
+    for repo_name in repo_names:
+        travis_db.add_repo(repo_name)
+    rows = list(travis_rows(travis_db, stats, seed=seed))
+    bench.time("upsert_stats_travis", len(rows), travis_db.upsert_stats, rows)
+    travis_db.close()
+
+    # aggregation
+    dates = csd.get_weekly_dates(db)
+    n_cells = n_repos * len(dates)
+    cols = ["views", "unique_views", "clones", "unique_clones"]
+    bench.time(
+        "get_all_weekly_stats", n_cells,
+        csd.get_all_weekly_stats, db, dates, "views", estimate_missing=False,
+    )
+    bench.time(
+        "get_all_weekly_stats_estimate_missing", n_cells,
+        csd.get_all_weekly_stats, db, dates, "views", estimate_missing=True,
+    )
+    bench.time(
+        "get_all_weekly_stats_frames", n_cells * len(cols),
+        csd.get_all_weekly_stats_frames, db, dates, cols,
+    )
+    bench.time(
+        "weekly_cache_cold", n_cells * len(cols),
+        csd.get_weekly_cube, db, dates, cols, estimate_missing=False, cache=True,
+    )
+    bench.time(
+        "weekly_cache_warm", n_cells * len(cols),
+        csd.get_weekly_cube, db, dates, cols, estimate_missing=False, cache=True,
+    )
+
+    # plotting, the frame `plot.make_plots` would draw, without a display
+    import matplotlib
+    import matplotlib.pyplot as plt
+    import plot
+
+    matplotlib.use("Agg")
+
+    df = csd.get_weekly_cube(db, dates, ["views"]).merge(plot.merged_repos).frame("views")
+    db.close()
+
+    def draw():
+        ax = plot.area_plot(df, "Weekly Views", fontsize=14, saveas="views.png")
+        plt.close(ax.figure)
+        return ax
+
+    bench.time("area_plot", 1, draw)
+
+
+def run_info():
+    import matplotlib
+    import pandas
+
+    return {
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite": sqlite3.sqlite_version,
+        "numpy": np.__version__,
+        "pandas": pandas.__version__,
+        "matplotlib": matplotlib.__version__,
+    }
+
+
+def compare(results, previous, threshold):
+    """
+    Print timings next to those of an earlier run
+
+    :return: list of dict, results slower than `threshold` times before
+    """
+    before = {
+        (r["name"], r["repos"], r["years"]): r for r in previous["results"]
+    }
+    slower = []
+    print("name repos years: before -> after (ratio)")
+    for r in results:
+        key = (r["name"], r["repos"], r["years"])
+        if key not in before:
+            continue
+        ratio = r["seconds"] / before[key]["seconds"] if before[key]["seconds"] else None
+        mark = ""
+        if ratio is not None and ratio > threshold:
+            slower.append(r)
+            mark = "  <-- slower"
+        print(
+            "  " + " ".join(map(str, key)) + ":",
+            round(before[key]["seconds"], 4), "->", round(r["seconds"], 4),
+            "(" + ("-" if ratio is None else str(round(ratio, 2))) + ")" + mark,
+        )
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark ingest, aggregation and plotting on synthetic data"
+    )
+    parser.add_argument("--repos", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5])
+    parser.add_argument(
+        "--per-row-limit",
+        type=int,
+        default=20000,
+        help="rows loaded with _insert_or_update_stats per scale",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON results file")
+    parser.add_argument("--compare", help="JSON results file of an earlier run")
+    parser.add_argument(
+        "--threshold", type=float, default=1.2, help="slowdown ratio reported"
+    )
+    args = parser.parse_args(argv)
+
+    output = None if args.output is None else os.path.abspath(args.output)
+    previous = None
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            previous = json.load(f)
+
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="code_stats_bench_") as root:
+        # an empty config, rather than the user's tokens
+        os.environ["PRISMS_CODE_STATS_DIR"] = root
+        try:
+            for n_repos in args.repos:
+                for years in args.years:
+                    run_scale(
+                        results, root, n_repos, years, args.per_row_limit, seed=args.seed
+                    )
+        finally:
+            os.chdir(cwd)
+
+    data = {"info": run_info(), "args": vars(args), "results": results}
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(data, f, indent=2)
+        print("Wrote:", output)
+    if previous is not None:
+        if len(compare(results, previous, args.threshold)):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
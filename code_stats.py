@@ -2,13 +2,26 @@
 Create and update sqlite databases with daily open source project stats
 """
 
+import contextlib
 import datetime
-import dateutil.parser
+import glob
 import json
 import os
 import os.path
-import requests
+import queue
 import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+
+import instrument
+
+# Only the standard library modules needed for sqlite access, and
+# instrument, which only uses the standard library, are imported here.
+# asyncio, dateutil, requests and PyGithub are imported by the functions
+# that make requests, so that commands which only read the databases start
+# quickly.
 
 
 def config_dir():
@@ -59,6 +72,20 @@ def set_config_value(name, token, value):
     write_config(config)
 
 
+def api_url(name, default):
+    """
+    :param name: str, i.e. "github"
+    :param default: str, the API's URL
+    :return: str, the PRISMS_CODE_STATS_<NAME>_URL environment variable if
+        set, i.e. to use `standin_server`, else `default`
+    """
+    return os.environ.get("PRISMS_CODE_STATS_" + name.upper() + "_URL", default)
+
+
+def http_cache_db():
+    return os.path.join(code_stats_prefix(), "http_cache.db")
+
+
 def toordinal(date):
     return date.toordinal()
 
@@ -73,10 +100,157 @@ def code_stats_prefix():
     return os.path.join(os.getcwd(), "data")
 
 
+# per connection settings: wait up to `busy_timeout` seconds for another
+# connection's lock, keep 16 MiB of pages cached, read through up to 256 MiB
+# of memory-mapped file, and sync only at WAL checkpoints, which is safe
+# from corruption in WAL mode
+busy_timeout = 30.0
+sqlite_pragmas = [
+    ("cache_size", -16384),
+    ("mmap_size", 256 * 2**20),
+    ("temp_store", "MEMORY"),
+    ("synchronous", "NORMAL"),
+]
+
+
+def connect_db(path, readonly=False, check_same_thread=True):
+    """
+    Open a stats database connection
+
+    Writers switch the database to WAL mode, which is kept in the file, so
+    that readers do not block the writer and the writer does not block
+    readers. Readers open the file read-only, with a URI, and can not write
+    even by mistake.
+
+    :param path: str, sqlite database file
+    :param readonly: bool, open read-only; the file must exist
+    :param check_same_thread: bool, as for sqlite3.connect; False allows
+        using the connection in another thread, one thread at a time
+    :return: sqlite3.Connection, with row_factory sqlite3.Row
+    """
+    if readonly:
+        if not os.path.isfile(path):
+            raise Exception("Cannot open " + path + " read-only: does not exist")
+        conn = sqlite3.connect(
+            "file:" + urllib.parse.quote(os.path.abspath(path)) + "?mode=ro",
+            uri=True,
+            timeout=busy_timeout,
+            check_same_thread=check_same_thread,
+        )
+    else:
+        conn = sqlite3.connect(
+            path, timeout=busy_timeout, check_same_thread=check_same_thread
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+    for name, value in sqlite_pragmas:
+        conn.execute("PRAGMA " + name + "=" + str(value))
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class ReaderPool(object):
+    """
+    A small pool of read-only connections to one database, shared by threads
+
+    Usage:
+
+        pool = db.reader_pool()
+        with pool.connection() as conn:
+            conn.execute(...)
+
+    Connections are opened when first needed, and kept open when returned,
+    so repeated reads, i.e. the daemon's report after each tick, do not
+    reopen the database. `acquire` waits for a connection to be returned if
+    `size` are in use.
+    """
+
+    def __init__(self, path, size=4):
+        """
+        :param path: str, sqlite database file
+        :param size: int, maximum number of connections
+        """
+        self.path = path
+        self.size = size
+        self.closed = False
+        self.idle = queue.LifoQueue()
+        self.slots = queue.Queue()
+        for i in range(size):
+            self.slots.put(None)
+
+    def acquire(self):
+        """
+        :return: sqlite3.Connection, read-only, to be given back with
+            `release`; it reads from one consistent snapshot if its queries
+            run in a transaction, i.e. after conn.execute("BEGIN")
+        """
+        self.slots.get()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return connect_db(self.path, readonly=True, check_same_thread=False)
+        except:
+            self.slots.put(None)
+            raise
+
+    def release(self, conn):
+        """Give back a connection from `acquire`"""
+        try:
+            conn.rollback()
+        finally:
+            if self.closed:
+                conn.close()
+            else:
+                self.idle.put(conn)
+            self.slots.put(None)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a read-only connection for a "with" block"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close idle connections; connections in use are closed when returned"""
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# {absolute path: ReaderPool}, shared by all readers in the process
+reader_pools = {}
+reader_pools_lock = threading.Lock()
+
+
+def reader_pool(path):
+    """:return: ReaderPool, the process's shared pool for the database at `path`"""
+    path = os.path.abspath(path)
+    with reader_pools_lock:
+        if path not in reader_pools:
+            reader_pools[path] = ReaderPool(path)
+        return reader_pools[path]
+
+
+def close_reader_pools():
+    """Close the idle connections of all `reader_pool`s"""
+    with reader_pools_lock:
+        for pool in reader_pools.values():
+            pool.close()
+        reader_pools.clear()
+
+
 def list_tables(conn):
-    return list(
-        conn.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()[0]
-    )
+    return [
+        r[0]
+        for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    ]
 
 
 def insert_str(record):
@@ -102,6 +276,70 @@ def update_str(record):
     return setstr, tuple(val)
 
 
+def upsert_sql(cols):
+    """
+    :param cols: tuple of str, stats columns other than repo_id and day
+    :return: str, "INSERT ... ON CONFLICT (repo_id, day) DO UPDATE" statement;
+        rows whose values are unchanged are not updated, so they fire no
+        triggers and do not change `StatsBase.stats_version`
+    """
+    colstr = ", ".join(("repo_id", "day") + cols)
+    questionstr = ", ".join(["?"] * (len(cols) + 2))
+    if not cols:
+        return (
+            "INSERT INTO stats (" + colstr + ") VALUES (" + questionstr + ")"
+            " ON CONFLICT (repo_id, day) DO NOTHING"
+        )
+    setstr = ", ".join(key + "=excluded." + key for key in cols)
+    return (
+        "INSERT INTO stats (" + colstr + ") VALUES (" + questionstr + ")"
+        " ON CONFLICT (repo_id, day) DO UPDATE SET " + setstr
+        + " WHERE "
+        + " OR ".join("stats." + key + " IS NOT excluded." + key for key in cols)
+    )
+
+
+# (table, key column) of the rollups maintained by `StatsBase.rebuild_rollups`
+rollups = [("stats_weekly", "week_end"), ("stats_monthly", "month")]
+
+
+def week_end_sql(day, day_index):
+    """
+    :param day: str, SQL expression for an ordinal day
+    :param day_index: int, weekday ending each week, Monday is 0
+    :return: str, SQL expression for the ordinal day of the first `day_index`
+        weekday on or after `day`
+    """
+    # the weekday of ordinal day d is (d - 1) % 7
+    return (
+        "(" + day + " + (" + str(day_index) + " - (" + day + " - 1) % 7 + 7) % 7)"
+    )
+
+
+def month_sql(day):
+    """
+    :param day: str, SQL expression for an ordinal day
+    :return: str, SQL expression for the day's month as integer yyyymm
+    """
+    # 1721424.5 is the Julian day of ordinal day 0
+    return "CAST(strftime('%Y%m', " + day + " + 1721424.5) AS INT)"
+
+
+def rollup_delta_sql(table, key, key_sql, cols, record, sign):
+    """
+    :return: str, statement adding (sign "") or subtracting (sign "-") the
+        trigger record's values to its rollup row
+    """
+    return (
+        "INSERT INTO " + table + " (repo_id, " + key
+        + "".join(", " + col for col in cols) + ") VALUES ("
+        + record + ".repo_id, " + key_sql
+        + "".join(", " + sign + "COALESCE(" + record + "." + col + ", 0)" for col in cols)
+        + ") ON CONFLICT (repo_id, " + key + ") DO UPDATE SET "
+        + ", ".join(col + "=" + col + " + excluded." + col for col in cols)
+    )
+
+
 def add_defaults(record, default_values):
     for key in default_values.keys():
         if key not in record:
@@ -126,13 +364,62 @@ class StatsBase(object):
         @staticmethod _stats_colinfo(self) -> list of str, for ALTER TABLE
     """
 
+    # weekday (Monday is 0) ending the weeks of the "stats_weekly" rollup,
+    # as `code_stats_data.get_weekly_dates` day_index
+    rollup_day_index = 4
+
+    # (index, n_shards) if this database holds one shard of the repos, see
+    # `shards`, or None for the canonical database
+    shard = None
+
+    # days of history the API keeps, stats not requested within it are lost,
+    # or None if all history can be requested
+    history_days = None
+
+    # True if repos are GitHub "owner/name" repos, so the repos of
+    # `update_all.repos` and of GitHub discovery apply
+    github_repos = True
+
+    # {column: rule} for merging shards, for columns not using "max"; "max"
+    # also suits ISO time text, i.e. TravisStats last_build_started_at
+    merge_rules = {}
+
+    @classmethod
+    def db_path(cls, shard=None):
+        """
+        :param shard: (index, n_shards), optional, for a shard database
+        :return: str, the database file, which may not exist yet
+        """
+        name = cls._shortname() + "_stats"
+        if shard is not None:
+            name += ".shard-" + str(shard[0]) + "-of-" + str(shard[1])
+        return os.path.join(code_stats_prefix(), name + ".db")
+
     def _db(self):
-        return os.path.join(code_stats_prefix(), self._shortname() + "_stats.db")
+        return self.db_path(self.shard)
+
+    def connect(self, readonly=False):
+        """
+        :param readonly: bool, open a read-only connection, i.e. for reports
+            while an update is writing; the database is first migrated with a
+            temporary writable connection if needed; read-only connections
+            are borrowed from the shared `reader_pool` and given back by
+            `close`
+        """
+        if readonly:
+            pool = reader_pool(self._db())
+            self.conn = pool.acquire()
+            if self._needs_migration():
+                pool.release(self.conn)
+                self.connect()
+                self.conn.close()
+                self.conn = pool.acquire()
+            self._pool = pool
+            return
 
-    def connect(self):
+        self._pool = None
         if not os.path.isfile(self._db()):
-            self.conn = sqlite3.connect(self._db())
-            self.conn.row_factory = sqlite3.Row
+            self.conn = connect_db(self._db())
 
             # self.conn.execute("CREATE TABLE repos (repo_id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
             create_str = "CREATE TABLE repos (repo_id INTEGER PRIMARY KEY"
@@ -150,8 +437,45 @@ class StatsBase(object):
 
             self.conn.commit()
         else:
-            self.conn = sqlite3.connect(self._db())
-            self.conn.row_factory = sqlite3.Row
+            self.conn = connect_db(self._db())
+
+        self.migrate()
+
+    def schema_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        """
+        Apply any `schema_migrations` newer than the database's user_version
+
+        Each migration runs in its own transaction together with the
+        user_version bump, so a failed migration leaves the database as it was.
+        """
+        version = self.schema_version()
+        if version > len(schema_migrations):
+            raise Exception(
+                "Cannot use " + self._db() + ": schema version "
+                + str(version) + " is newer than this code_stats supports"
+            )
+        for i in range(version, len(schema_migrations)):
+            self.conn.execute("BEGIN")
+            try:
+                schema_migrations[i](self)
+                self.conn.execute("PRAGMA user_version = " + str(i + 1))
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+        self._check_rollups()
+
+    def _needs_migration(self):
+        """:return: bool, True if `migrate` would change the database"""
+        if self.schema_version() < len(schema_migrations):
+            return True
+        if "rollup_info" not in list_tables(self.conn):
+            return True
+        info = self.conn.execute("SELECT signature FROM rollup_info").fetchone()
+        return info is None or info["signature"] != self._rollup_signature()
 
     def add_repos_column(self, colinfo):
         self.conn.execute("ALTER TABLE repos ADD COLUMN " + colinfo)
@@ -161,8 +485,18 @@ class StatsBase(object):
         self.conn.execute("ALTER TABLE stats ADD COLUMN " + colinfo)
         self.conn.commit()
 
+    def reader_pool(self):
+        """:return: ReaderPool, the shared pool of read-only connections"""
+        return reader_pool(self._db())
+
     def close(self):
-        self.conn.close()
+        if getattr(self, "_pool", None) is not None:
+            self._pool.release(self.conn)
+            self._pool = None
+        else:
+            self.conn.close()
+        if getattr(self, "http_cache", None) is not None:
+            self.http_cache.close()
 
     def add_repo(self, repo_name):
         result = self.conn.execute(
@@ -173,6 +507,62 @@ class StatsBase(object):
         self.conn.execute("INSERT INTO repos (name) VALUES (?)", (repo_name,))
         self.conn.commit()
 
+    def discover_repos(self):
+        """
+        Add the repos found by listing the provider, i.e. the packages of
+        `AnacondaStats.channels`; none by default
+
+        :return: list of str, the repos that were added
+        """
+        return []
+
+    def add_repos(self, repo_names):
+        """
+        Add many repos in one transaction, ignoring those already added
+
+        :param repo_names: iterable of str, i.e. "prisms-center/CASMcode"
+        :return: list of str, the repos that were added
+        """
+        repo_names = list(repo_names)
+        existing = set(self.list_repo_names())
+        with self.transaction():
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO repos (name) VALUES (?)",
+                [(repo_name,) for repo_name in repo_names],
+            )
+        added = []
+        for repo_name in repo_names:
+            if repo_name not in existing:
+                existing.add(repo_name)
+                added.append(repo_name)
+        return added
+
+    def sync_repos(self, repo_names, owners, prune=False):
+        """
+        Add `repo_names`, and find repos of `owners` not in `repo_names`
+
+        :param repo_names: list of str, all repos of `owners` to track, as
+            from `discover_github_repos`
+        :param owners: list of str, orgs or users `repo_names` were listed for;
+            repos of other owners are never removed
+        :param prune: bool, if True, remove the repos of `owners` not in
+            `repo_names`, and their stats
+        :return (added, removed): lists of str, repos added, and repos of
+            `owners` not in `repo_names`, removed only if `prune`
+        """
+        owners = set(owner.lower() for owner in owners)
+        keep = set(repo_names)
+        removed = [
+            repo_name
+            for repo_name in self.list_repo_names()
+            if repo_name.split("/")[0].lower() in owners and repo_name not in keep
+        ]
+        added = self.add_repos(repo_names)
+        if prune:
+            for repo_name in removed:
+                self.remove_repo(repo_name)
+        return added, removed
+
     def get_repo_id(self, repo_name):
         record = self.conn.execute(
             "SELECT * FROM repos WHERE name=?", (repo_name,)
@@ -188,6 +578,10 @@ class StatsBase(object):
             raise Exception("Cannot remove repo '" + repo_name + "': does not exist")
         else:
             self.conn.execute("DELETE FROM stats WHERE repo_id=?", (repo_id,))
+            for table, key in rollups:
+                self.conn.execute("DELETE FROM " + table + " WHERE repo_id=?", (repo_id,))
+            self.conn.execute("DELETE FROM schedule WHERE repo_id=?", (repo_id,))
+            self.conn.execute("DELETE FROM snapshot_totals WHERE repo_id=?", (repo_id,))
             self.conn.execute("DELETE FROM repos WHERE repo_id=?", (repo_id,))
             self.conn.commit()
 
@@ -205,48 +599,559 @@ class StatsBase(object):
         ).fetchall():
             print(dict(record))
 
+    @staticmethod
+    def snapshot_cols():
+        """
+        :return: list of str, stats columns holding a running total on the
+            day recorded (i.e. stars), rather than a count for that day
+        """
+        return []
+
+    def metric_cols(self):
+        """
+        :return: list of str, stats columns other than repo_id and day
+        """
+        return [
+            colinfo.split()[0]
+            for colinfo in self._stats_colinfo()
+            if colinfo.split()[0] not in ("repo_id", "day")
+        ]
+
+    def _rollup_key_sql(self, key, day):
+        """
+        :param key: str, "week_end" or "month"
+        :param day: str, SQL expression for an ordinal day
+        """
+        if key == "week_end":
+            return week_end_sql(day, self.rollup_day_index)
+        return month_sql(day)
+
+    def _rollup_signature(self):
+        return json.dumps([self.rollup_day_index, self.metric_cols()])
+
+    def _check_rollups(self):
+        """Rebuild rollups if missing, or made for other columns or weekday"""
+        if "rollup_info" in list_tables(self.conn):
+            info = self.conn.execute("SELECT signature FROM rollup_info").fetchone()
+            if info is not None and info["signature"] == self._rollup_signature():
+                return
+        self.rebuild_rollups()
+
+    def rebuild_rollups(self):
+        """
+        Recreate the weekly and monthly rollup tables from "stats", and the
+        triggers keeping them up to date
+
+        The "stats_weekly" table sums each metric by (repo_id, week_end), the
+        ordinal day of the `rollup_day_index` weekday ending the week, and
+        "stats_monthly" by (repo_id, month), as yyyymm. Triggers on "stats"
+        add the difference between new and old values of every inserted,
+        updated or deleted record, in the same transaction.
+        """
+        cols = self.metric_cols()
+        self.conn.execute("BEGIN")
+        try:
+            for action in ["insert", "update", "delete"]:
+                self.conn.execute("DROP TRIGGER IF EXISTS stats_rollup_" + action)
+            trigger_sql = {"insert": [], "update": [], "delete": []}
+            for table, key in rollups:
+                self.conn.execute("DROP TABLE IF EXISTS " + table)
+                self.conn.execute(
+                    "CREATE TABLE " + table + " (repo_id INT, " + key + " INT"
+                    + "".join(", " + col + " INT" for col in cols)
+                    + ", PRIMARY KEY (repo_id, " + key + "))"
+                )
+                key_sql = self._rollup_key_sql(key, "day")
+                self.conn.execute(
+                    "INSERT INTO " + table + " SELECT repo_id, " + key_sql + " AS k"
+                    + "".join(", COALESCE(SUM(" + col + "), 0)" for col in cols)
+                    + " FROM stats GROUP BY repo_id, k"
+                )
+                for action, record, sign in [
+                    ("insert", "NEW", ""),
+                    ("update", "OLD", "-"),
+                    ("update", "NEW", ""),
+                    ("delete", "OLD", "-"),
+                ]:
+                    trigger_sql[action].append(
+                        rollup_delta_sql(
+                            table,
+                            key,
+                            self._rollup_key_sql(key, record + ".day"),
+                            cols,
+                            record,
+                            sign,
+                        )
+                    )
+            for action, statements in trigger_sql.items():
+                self.conn.execute(
+                    "CREATE TRIGGER stats_rollup_" + action + " AFTER "
+                    + action.upper() + " ON stats BEGIN "
+                    + "; ".join(statements) + "; END"
+                )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rollup_info (signature TEXT)"
+            )
+            self.conn.execute("DELETE FROM rollup_info")
+            self.conn.execute(
+                "INSERT INTO rollup_info (signature) VALUES (?)",
+                (self._rollup_signature(),),
+            )
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+    def stats_version(self):
+        """:return: int, count of changes to "stats", maintained by triggers"""
+        return self.conn.execute("SELECT version FROM stats_version").fetchone()[0]
+
+    def first_day_changed_since(self, version):
+        """
+        :param version: int, as from `stats_version`
+        :return: int, first ordinal day of stats inserted, updated or deleted
+            since `version`, or None if there were no changes
+        """
+        return self.conn.execute(
+            "SELECT MIN(day) FROM stats_changes WHERE version > ?", (version,)
+        ).fetchone()[0]
+
     def _insert_or_update_stats(self, repo_id, day, record):
         """
         INSERT INTO, if record with repo_id and day does not exist, otherwise UPDATE
 
+        Does not commit. Prefer `upsert_stats` for more than a few records.
+
         :param repo_id: integer, repo_id
         :param day: integer, ordinal day, as from `toordinal`
         :param record: dict, data to be inserted
         """
-        existing = self.conn.execute(
-            "SELECT * FROM stats WHERE repo_id=? AND day=?", (repo_id, day)
-        ).fetchall()
-        if len(existing) > 1:
-            for existing_record in existing:
-                print(str(existing_record))
-            raise Exception(
-                "Multiple "
-                + self._shortname()
-                + " stats records with same repo_id and day"
-            )
-        elif len(existing) == 0:
-            record["repo_id"] = repo_id
-            record["day"] = day
-            (colstr, questionstr, valtuple) = insert_str(record)
-            self.conn.execute(
-                "INSERT INTO stats " + colstr + " VALUES " + questionstr, valtuple
-            )
-        else:
-            (setstr, valtuple) = update_str(record)
-            self.conn.execute(
-                "UPDATE stats SET " + setstr + " WHERE record_id=?",
-                valtuple + (existing[0]["record_id"],),
+        self._upsert_stats([(repo_id, day, record)])
+
+    def _upsert_stats(self, rows, batch_size=10000):
+        """
+        INSERT ... ON CONFLICT DO UPDATE each row, without committing
+
+        Consecutive rows with the same columns share one `executemany`, so
+        the order rows are given in is the order they are applied in. At most
+        `batch_size` rows are held in memory, so `rows` may be a generator
+        over more data than fits.
+
+        :param rows: iterable of (repo_id, day, record) tuples
+        :param batch_size: int, maximum rows per `executemany`
+        :return: int, number of rows written
+        """
+        count = 0
+        cols = None
+        batch = []
+        for repo_id, day, record in rows:
+            record_cols = tuple(record.keys())
+            if record_cols != cols or len(batch) >= batch_size:
+                if batch:
+                    self.conn.executemany(upsert_sql(cols), batch)
+                cols = record_cols
+                batch = []
+            batch.append((repo_id, day) + tuple(record[key] for key in cols))
+            count += 1
+        if batch:
+            self.conn.executemany(upsert_sql(cols), batch)
+        instrument.count("rows_written", count, db=self._shortname())
+        return count
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Commit if the "with" block succeeds and roll back if it raises, as
+        "with self.conn:", recording the transaction and commit times in
+        `instrument`
+        """
+        start = time.perf_counter()
+        try:
+            yield self.conn
+        except:
+            self.conn.rollback()
+            raise
+        with instrument.timer("sqlite_commit", db=self._shortname()):
+            self.conn.commit()
+        instrument.observe(
+            "sqlite_transaction", time.perf_counter() - start, db=self._shortname()
+        )
+
+    def upsert_stats(self, rows):
+        """
+        Insert or update many stats records in one transaction
+
+        Only the columns present in each record are written, existing values
+        in other columns are kept.
+
+        :param rows: iterable of (repo_id, day, record) tuples, where day is an
+            integer ordinal day, as from `toordinal`, and record is a dict of
+            {column: value}
+        :return: int, number of rows written
+        """
+        with self.transaction():
+            return self._upsert_stats(rows)
+
+    def export_tables(self, dirpath, fmt="arrow", chunk_size=65536):
+        """
+        Write repos, stats and rollups to Arrow IPC or Parquet files,
+        partitioned by provider and year, see `stats_arrow`
+
+        :param dirpath: str, export directory
+        :param fmt: str, "arrow" or "parquet"
+        :param chunk_size: int, maximum rows held in memory
+        :return: dict of {table: number of rows written}
+        """
+        import stats_arrow
+
+        return stats_arrow.export_tables(
+            self, dirpath, fmt=fmt, chunk_size=chunk_size
+        )
+
+    def import_tables(self, dirpath, chunk_size=65536):
+        """
+        Insert or update repos and stats from `export_tables` files, in one
+        transaction, see `stats_arrow`
+
+        :param dirpath: str, export directory
+        :param chunk_size: int, maximum rows held in memory
+        :return: dict of {table: number of rows read}
+        """
+        import stats_arrow
+
+        return stats_arrow.import_tables(self, dirpath, chunk_size=chunk_size)
+
+    def merge_rule(self, col):
+        """:return: str, "max" or "latest", how `merge_shard` resolves `col`"""
+        return self.merge_rules.get(col, "max")
+
+    def merge_shard(self, path, rules=None):
+        """
+        Insert or update the repos and stats of a shard database, matching
+        repos by name, in one transaction, see `shards`
+
+        :param path: str, shard database file
+        :param rules: dict of {column: rule}, optional, overriding `merge_rule`
+        :return: dict of {"repos": int, "stats": int}, the shard's row counts
+        """
+        import shards
+
+        return shards.merge_shard(self, path, rules=rules)
+
+
+def _migration_1_indexes(db):
+    """Unique (repo_id, day) stats index, used by ON CONFLICT, and repos(name) index"""
+    duplicates = db.conn.execute(
+        "SELECT repo_id, day, COUNT(*) AS n FROM stats"
+        " GROUP BY repo_id, day HAVING n > 1"
+    ).fetchall()
+    if len(duplicates):
+        for record in duplicates:
+            print(dict(record))
+        raise Exception(
+            "Cannot migrate "
+            + db._db()
+            + ": "
+            + str(len(duplicates))
+            + " repo_id and day pairs have multiple stats records"
+        )
+    db.conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS stats_repo_id_day ON stats (repo_id, day)"
+    )
+    db.conn.execute("CREATE INDEX IF NOT EXISTS repos_name ON repos (name)")
+
+
+def _migration_2_stats_version(db):
+    """
+    Count changes to "stats", in "stats_version", and record the count at the
+    last change of each day, in "stats_changes", so that caches of aggregates
+    can tell which days changed since they were made
+    """
+    db.conn.execute("CREATE TABLE stats_version (version INT)")
+    db.conn.execute("INSERT INTO stats_version (version) VALUES (0)")
+    db.conn.execute("CREATE TABLE stats_changes (day INTEGER PRIMARY KEY, version INT)")
+    for action, records in [
+        ("insert", ["NEW"]),
+        ("update", ["OLD", "NEW"]),
+        ("delete", ["OLD"]),
+    ]:
+        statements = ["UPDATE stats_version SET version = version + 1"]
+        for record in records:
+            statements.append(
+                "INSERT INTO stats_changes (day, version) SELECT " + record
+                + ".day, version FROM stats_version WHERE true"
+                " ON CONFLICT (day) DO UPDATE SET version = excluded.version"
             )
+        db.conn.execute(
+            "CREATE TRIGGER stats_version_" + action + " AFTER " + action.upper()
+            + " ON stats BEGIN " + "; ".join(statements) + "; END"
+        )
+
+
+def _migration_3_schedule(db):
+    """
+    Per repo update schedule of the daemon, see `daemon`; times are epoch
+    seconds
+    """
+    db.conn.execute(
+        "CREATE TABLE schedule (repo_id INTEGER PRIMARY KEY, next_due REAL,"
+        " last_attempt REAL, last_success REAL, failures INT DEFAULT 0,"
+        " last_error TEXT)"
+    )
+
+
+def _migration_4_snapshot_totals(db):
+    """
+    Running totals last seen for items of a repo, i.e. the downloads of each
+    file of a conda package, from which the daily increases are recorded in
+    "stats", see `AnacondaStats`
+    """
+    db.conn.execute(
+        "CREATE TABLE snapshot_totals (repo_id INT, item TEXT, version TEXT,"
+        " total INT, PRIMARY KEY (repo_id, item))"
+    )
+
+
+def _add_columns(db, table, colinfos):
+    """
+    ALTER TABLE ADD COLUMN for each colinfo missing from `table`; databases
+    created after the column was added to the provider's colinfo have it
+    """
+    existing = [r["name"] for r in db.conn.execute("PRAGMA table_info(" + table + ")")]
+    for colinfo in colinfos:
+        if colinfo.split()[0] not in existing:
+            db.conn.execute("ALTER TABLE " + table + " ADD COLUMN " + colinfo)
+
 
+def _migration_5_github_snapshot_counts(db):
+    """
+    GitHub open issues and releases counts, see
+    `GithubStats.get_snapshots_graphql`
+    """
+    if isinstance(db, GithubStats):
+        _add_columns(db, "stats", ["open_issues_count INT", "releases_count INT"])
+
+
+def _migration_6_travis_watermark(db):
+    """
+    Travis newest build "started_at" counted in stats, from which builds are
+    synced incrementally, see `TravisStats.update_repos`
+    """
+    if isinstance(db, TravisStats):
+        _add_columns(db, "repos", ["last_build_started_at TEXT"])
+
+
+# schema_migrations[i] upgrades a database from user_version i to i+1
+schema_migrations = [
+    _migration_1_indexes,
+    _migration_2_stats_version,
+    _migration_3_schedule,
+    _migration_4_snapshot_totals,
+    _migration_5_github_snapshot_counts,
+    _migration_6_travis_watermark,
+]
 
-from github import Github
-from github.GithubException import GithubException
 
 # github API:
 #   traffic requires a token with "repo" scope
 
 
+def github_client(
+    token, cache=None, limiter=None, pool_size=8, per_page=100, base_url=None
+):
+    """
+    Construct a github.Github whose requests share one pooled session
+
+    PyGithub normally reuses a single connection object, which is not safe to
+    use from several threads. Here each request gets its own connection
+    object, but they all send through the same session, and so the same
+    connection pool, HttpCache and RateLimiter. The connection classes are
+    set on this client's Requester only; other clients are unaffected. They
+    are private attributes of PyGithub 2's Requester, hence the upper bound
+    in requirements.txt. `withLazy` returns a client sharing the session.
+    Call `close()` on the client, or use it in a "with" block, to close
+    the session.
+
+    :param token: str, GitHub token, or None for unauthenticated requests
+    :param cache: HttpCache, optional
+    :param limiter: RateLimiter, optional. PyGithub's own fixed delay
+        between requests is turned off, pacing is left to `limiter`.
+    :param pool_size: int, connection pool size
+    :param per_page: int, items per page of paginated lists
+    :param base_url: str, optional, GitHub API URL, default
+        `api_url("github", ...)`
+    :return: github.Github
+    """
+    import requests
+    from github import Auth, Github
+    from github.Requester import (
+        HTTPRequestsConnectionClass,
+        HTTPSRequestsConnectionClass,
+        Requester,
+    )
+    from http_cache import CachingAdapter
+
+    if base_url is None:
+        base_url = api_url("github", "https://api.github.com")
+    session = requests.Session()
+    # as in PyGithub: disables falling back to .netrc
+    session.auth = Requester.noopAuth
+    adapter = CachingAdapter(
+        cache, limiter=limiter, pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def shared_session_class(base, protocol, default_port):
+        class SharedSessionConnection(base):
+            def __init__(self, host, port=None, strict=False, timeout=None, **kwargs):
+                # as base.__init__, without creating a session of its own
+                self.host = host
+                self.port = port if port else default_port
+                self.protocol = protocol
+                self.timeout = timeout
+                self.verify = kwargs.get("verify", True)
+                self.session = session
+
+            def close(self):
+                # the session outlives each request's connection object
+                pass
+
+        return SharedSessionConnection
+
+    http_class = shared_session_class(HTTPRequestsConnectionClass, "http", 80)
+    https_class = shared_session_class(HTTPSRequestsConnectionClass, "https", 443)
+
+    # {lazy: client}, Github.withLazy would make a client without the session
+    clients = {}
+
+    class SharedSessionGithub(Github):
+        def withLazy(self, lazy):
+            return clients[lazy]
+
+        def close(self):
+            for client in clients.values():
+                Github.close(client)
+            session.close()
+
+    def new_client(lazy):
+        client = SharedSessionGithub(
+            auth=Auth.Token(token) if token is not None else None,
+            base_url=base_url,
+            pool_size=pool_size,
+            per_page=per_page,
+            seconds_between_requests=None,
+            seconds_between_writes=None,
+            lazy=lazy,
+        )
+        # the per-instance equivalent of Requester.injectConnectionClasses,
+        # which would change the connection classes of every client in the
+        # process
+        requester = client.requester
+        requester._Requester__httpConnectionClass = http_class
+        requester._Requester__httpsConnectionClass = https_class
+        requester._Requester__connectionClass = (
+            https_class if base_url.startswith("https:") else http_class
+        )
+        # a new connection object for each request, see above
+        requester._Requester__persist = False
+        return client
+
+    for lazy in (False, True):
+        clients[lazy] = new_client(lazy)
+    return clients[False]
+
+
+def seed_github_rate_limiter(g, limiter):
+    """
+    Seed `limiter` from `g.get_rate_limit()`, which is not itself counted
+    against the rate limit
+
+    :param g: github.Github
+    :param limiter: RateLimiter
+    """
+    overview = g.get_rate_limit()
+    core = getattr(overview, "resources", overview).core
+    limiter.seed(core.limit, core.remaining, core.reset.timestamp())
+
+
+def match_repo_name(repo_name, include=None, exclude=None):
+    """
+    :param repo_name: str, i.e. "prisms-center/CASMcode"
+    :param include: list of str, optional, glob patterns, at least one of
+        which must match
+    :param exclude: list of str, optional, glob patterns, none of which may
+        match
+    :return: bool
+
+    Patterns with a "/" match the full name, i.e. "prisms-center/CASM*", and
+    patterns without one the repo name only, i.e. "CASM*".
+    """
+    import fnmatch
+
+    def matches(pattern):
+        if "/" in pattern:
+            return fnmatch.fnmatchcase(repo_name, pattern)
+        return fnmatch.fnmatchcase(repo_name.split("/")[-1], pattern)
+
+    if include and not any(matches(pattern) for pattern in include):
+        return False
+    if exclude and any(matches(pattern) for pattern in exclude):
+        return False
+    return True
+
+
+def discover_github_repos(
+    g, owners, include=None, exclude=None, archived=False, forks=False
+):
+    """
+    List the repos of GitHub orgs or users, following pagination
+
+    :param g: github.Github, as from `github_client`
+    :param owners: list of str, org or user logins
+    :param include: list of str, optional, see `match_repo_name`
+    :param exclude: list of str, optional, see `match_repo_name`
+    :param archived: bool, include archived repos
+    :param forks: bool, include forks
+    :return: list of str, full repo names, sorted
+    """
+    from github.GithubException import UnknownObjectException
+
+    repo_names = []
+    for owner in owners:
+        try:
+            repos = g.get_organization(owner).get_repos(type="all")
+        except UnknownObjectException:
+            repos = g.get_user(owner).get_repos(type="owner")
+        for repo in repos:
+            if repo.archived and not archived:
+                continue
+            if repo.fork and not forks:
+                continue
+            if match_repo_name(repo.full_name, include=include, exclude=exclude):
+                repo_names.append(repo.full_name)
+    return sorted(repo_names)
+
+
+class PartialRowsError(Exception):
+    """
+    The requests for a repo failed after some of its rows were received
+
+    :param message: str
+    :param rows: list of (repo_id, day, record), the rows received, for
+        `upsert_stats`
+    """
+
+    def __init__(self, message, rows):
+        super(PartialRowsError, self).__init__(message)
+        self.rows = rows
+
+
 class GithubStats(StatsBase):
+
+    # the traffic API returns the last 14 days
+    history_days = 14
+
     @staticmethod
     def _shortname():
         return "github"
@@ -267,67 +1172,345 @@ class GithubStats(StatsBase):
             "stargazers_count INT",
             "watchers_count INT",
             "forks_count INT",
+            "open_issues_count INT",
+            "releases_count INT",
         ]
 
-    def update_stats(self):
-        g = Github(get_config_value(self._shortname(), "token"))
+    @staticmethod
+    def snapshot_cols():
+        return [
+            "stargazers_count",
+            "watchers_count",
+            "forks_count",
+            "open_issues_count",
+            "releases_count",
+        ]
 
-        # for each repo in 'repos' database:
-        repos = [repo for repo in self.conn.execute("SELECT * FROM repos").fetchall()]
-        for repo in repos:
-            repo_id = repo["repo_id"]
-            repo_name = repo["name"]
+    # repos per GraphQL snapshot query
+    graphql_batch_size = 100
 
-            repo = g.get_repo(repo_name)
+    def planned_requests(self, repo_names=None):
+        """
+        :param repo_names: list of str, optional, the repos updated, default all
+        :return: int, number of requests `update_stats` makes: views traffic
+            and clones traffic for each repo, and one GraphQL snapshot query
+            per `graphql_batch_size` repos
+        """
+        n = len(self.list_repo_names() if repo_names is None else repo_names)
+        return 2 * n + -(-n // self.graphql_batch_size)
 
-            try:
-                # request views traffic from GitHub
-                views_traffic = repo.get_views_traffic()
-
-                if "views" in views_traffic:
-                    for view in views_traffic["views"]:
-                        day = toordinal(view.timestamp.date())
-                        record = {"views": view.count, "unique_views": view.uniques}
-                        self._insert_or_update_stats(repo_id, day, record)
-                self.conn.commit()
-            except GithubException as e:
-                print("error:", repo_name, e.data["message"])
-                if e.data["message"] == "Must have push access to repository":
-                    continue
-                raise e
+    @staticmethod
+    def graphql_snapshot_query(n):
+        """
+        :param n: int, number of repos
+        :return: str, GraphQL query for the snapshot counts of repos "r0", ...,
+            "r<n-1>", with variables "o<i>" and "n<i>" for owner and name
+        """
+        fields = (
+            "stargazerCount forkCount"
+            " issues(states: OPEN) { totalCount }"
+            " pullRequests(states: OPEN) { totalCount }"
+            " releases { totalCount }"
+        )
+        return (
+            "query("
+            + ", ".join("$o" + str(i) + ": String!, $n" + str(i) + ": String!" for i in range(n))
+            + ") { "
+            + " ".join(
+                "r" + str(i) + ": repository(owner: $o" + str(i) + ", name: $n"
+                + str(i) + ") { " + fields + " }"
+                for i in range(n)
+            )
+            + " rateLimit { cost remaining } }"
+        )
 
-            try:
-                # request clone traffic from Github
-                clones_traffic = repo.get_clones_traffic()
-
-                if "clones" in clones_traffic:
-                    for clone in clones_traffic["clones"]:
-                        day = toordinal(clone.timestamp.date())
-                        record = {"clones": clone.count, "unique_clones": clone.uniques}
-                        self._insert_or_update_stats(repo_id, day, record)
-                self.conn.commit()
-            except GithubException as e:
-                print("error:", repo_name, e.data["message"])
-                if e.data["message"] == "Must have push access to repository":
+    def get_snapshots_graphql(self, g, repo_names):
+        """
+        Request the snapshot counts of many repos, `graphql_batch_size` repos
+        per GraphQL query
+
+        As in the REST API, "watchers_count" is the number of stargazers, and
+        "open_issues_count" includes open pull requests.
+
+        :param g: github.Github
+        :param repo_names: list of str, i.e. "prisms-center/CASMcode"
+        :return: dict of {repo_name: record}; repos that could not be
+            requested, i.e. not found, or if GraphQL fails, are not included
+        """
+        snapshots = {}
+        for begin in range(0, len(repo_names), self.graphql_batch_size):
+            batch = repo_names[begin : begin + self.graphql_batch_size]
+            variables = {}
+            for i, repo_name in enumerate(batch):
+                owner, name = repo_name.split("/", 1)
+                variables["o" + str(i)] = owner
+                variables["n" + str(i)] = name
+            try:
+                # not `graphql_query`, which raises if any repo has an error
+                headers, res = g.requester.requestJsonAndCheck(
+                    "POST",
+                    g.requester.graphql_url,
+                    input={
+                        "query": self.graphql_snapshot_query(len(batch)),
+                        "variables": variables,
+                    },
+                )
+            except Exception as e:
+                print("error: GraphQL snapshot query:", repr(e))
+                continue
+            data = res.get("data") or {}
+            for error in res.get("errors", []):
+                print("error: GraphQL snapshot query:", error.get("message"))
+            if data.get("rateLimit") is not None:
+                instrument.gauge(
+                    "rate_limit_remaining", data["rateLimit"]["remaining"],
+                    api="github_graphql",
+                )
+            for i, repo_name in enumerate(batch):
+                node = data.get("r" + str(i))
+                if node is None:
                     continue
-                raise e
+                snapshots[repo_name] = {
+                    "stargazers_count": node["stargazerCount"],
+                    "forks_count": node["forkCount"],
+                    "watchers_count": node["stargazerCount"],
+                    "open_issues_count": node["issues"]["totalCount"]
+                    + node["pullRequests"]["totalCount"],
+                    "releases_count": node["releases"]["totalCount"],
+                }
+        return snapshots
+
+    def get_repo_rows(self, g, repo_id, repo_name, snapshot=True):
+        """
+        Request traffic and repo stats for one repo, without touching the database
 
-            # repo stats - today only
-            repo_stats = {
-                "stargazers_count": repo.stargazers_count,
-                "forks_count": repo.forks_count,
-                "watchers_count": repo.watchers_count,
-            }
-            day = toordinal(datetime.date.today())
-            self._insert_or_update_stats(repo_id, day, repo_stats)
-            self.conn.commit()
+        :param g: github.Github
+        :param repo_id: integer, repo_id
+        :param repo_name: str, i.e. "prisms-center/CASMcode"
+        :param snapshot: bool, if True, request the repo for today's stars,
+            forks, watchers and open issues, otherwise only traffic
+        :return: list of (repo_id, day, record), for `upsert_stats`
+        :raises PartialRowsError: if the clones request fails after views
+            were received
+        """
+        from github.GithubException import GithubException
+
+        # a lazy repo makes no request until one of its attributes is used
+        repo = g.withLazy(not snapshot).get_repo(repo_name)
+
+        rows = []
+        try:
+            # request views traffic from GitHub
+            views_traffic = repo.get_views_traffic()
+
+            for view in views_traffic.views:
+                day = toordinal(view.timestamp.date())
+                record = {"views": view.count, "unique_views": view.uniques}
+                rows.append((repo_id, day, record))
+        except GithubException as e:
+            print("error:", repo_name, e.data["message"])
+            if e.data["message"] == "Must have push access to repository":
+                return rows
+            raise e
+
+        try:
+            # request clone traffic from Github
+            clones_traffic = repo.get_clones_traffic()
+
+            for clone in clones_traffic.clones:
+                day = toordinal(clone.timestamp.date())
+                record = {"clones": clone.count, "unique_clones": clone.uniques}
+                rows.append((repo_id, day, record))
+        except GithubException as e:
+            print("error:", repo_name, e.data["message"])
+            if e.data["message"] == "Must have push access to repository":
+                return rows
+            raise PartialRowsError(
+                repo_name + ": clones: " + str(e.data["message"]), rows
+            ) from e
+        except Exception as e:
+            raise PartialRowsError(repo_name + ": clones: " + repr(e), rows) from e
+
+        if not snapshot:
+            return rows
+
+        # repo stats - today only
+        repo_stats = {
+            "stargazers_count": repo.stargazers_count,
+            "forks_count": repo.forks_count,
+            "watchers_count": repo.watchers_count,
+            "open_issues_count": repo.open_issues_count,
+        }
+        day = toordinal(datetime.date.today())
+        rows.append((repo_id, day, repo_stats))
+        return rows
+
+    def update_stats(self, max_workers=8, use_cache=True):
+        """
+        Request stats for all repos, see `update_repos`; if any failed, an
+        Exception listing them is raised at the end
+        """
+        failed = self.update_repos(max_workers=max_workers, use_cache=use_cache)
+        if len(failed):
+            raise Exception("Failed to update github stats for: " + ", ".join(failed))
+
+    def update_repos(self, repo_names=None, max_workers=8, use_cache=True):
+        """
+        Request stats for repos in parallel and write each repo's in one transaction
+
+        Requests run in a pool of `max_workers` threads, while this thread is
+        the only one using `self.conn`. A repo that fails does not stop the
+        others.
+
+        :param repo_names: list of str, optional, only update these repos
+        :param max_workers: int, number of repos requested at the same time
+        :param use_cache: bool, if True, make conditional requests using the
+            HttpCache at `http_cache_db()`
+        :return: list of str, the repos that failed
+        """
+        import concurrent.futures
+        from http_cache import HttpCache
+        from rate_limit import RateLimiter
+
+        cache = None
+        g = None
+        try:
+            with instrument.timer("phase", provider="github", phase="setup"):
+                cache = HttpCache(http_cache_db()) if use_cache else None
+                limiter = RateLimiter(self._shortname())
+                g = github_client(
+                    get_config_value(self._shortname(), "token"),
+                    cache=cache,
+                    limiter=limiter,
+                    pool_size=max_workers,
+                )
+                seed_github_rate_limiter(g, limiter)
+                limiter.report(self.planned_requests(repo_names))
+
+            # for each repo in 'repos' database:
+            repos = [
+                repo
+                for repo in self.conn.execute("SELECT * FROM repos").fetchall()
+                if repo_names is None or repo["name"] in repo_names
+            ]
+
+            # today's snapshot counts for all repos in a few GraphQL queries,
+            # repos missing from the result get them from the REST repo request
+            with instrument.timer("phase", provider="github", phase="snapshots"):
+                snapshots = self.get_snapshots_graphql(g, [repo["name"] for repo in repos])
+                day = toordinal(datetime.date.today())
+                self.upsert_stats(
+                    (repo["repo_id"], day, snapshots[repo["name"]])
+                    for repo in repos
+                    if repo["name"] in snapshots
+                )
+            if len(snapshots) < len(repos):
+                print(
+                    "Snapshots for", len(repos) - len(snapshots), "of", len(repos),
+                    "repos requested with REST",
+                )
+
+            def repo_rows(repo):
+                with instrument.timer("repo", provider="github", repo=repo["name"]):
+                    return self.get_repo_rows(
+                        g,
+                        repo["repo_id"],
+                        repo["name"],
+                        snapshot=repo["name"] not in snapshots,
+                    )
+
+            failed = []
+            with instrument.timer("phase", provider="github", phase="requests"), \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = {pool.submit(repo_rows, repo): repo["name"] for repo in repos}
+                for future in concurrent.futures.as_completed(futures):
+                    repo_name = futures[future]
+                    try:
+                        rows = future.result()
+                    except Exception as e:
+                        print("error:", repo_name, repr(e))
+                        instrument.count(
+                            "repo_errors", provider="github", repo=repo_name
+                        )
+                        failed.append(repo_name)
+                        # the views received before clones failed are kept
+                        if isinstance(e, PartialRowsError):
+                            self.upsert_stats(e.rows)
+                        continue
+                    self.upsert_stats(rows)
+        finally:
+            if g is not None:
+                g.close()
+            if cache is not None:
+                cache.close()
+        return failed
+
+
+def page_href(href, limit, offset):
+    """
+    :param href: str, Travis API v3 href, i.e. "/repo/123/builds"
+    :param limit: int, page size
+    :param offset: int, index of first item on the page
+    :return: str, href for the page
+    """
+    return (
+        href + ("&" if "?" in href else "?")
+        + "limit=" + str(limit) + "&offset=" + str(offset)
+    )
 
 
 class TravisStats(StatsBase):
 
-    def __init__(self, domain="https://api.travis-ci.org"):
+    def __init__(
+        self,
+        domain=None,
+        max_connections=8,
+        page_limit=100,
+        use_cache=True,
+    ):
+        """
+        :param domain: str, Travis API domain, default
+            `api_url("travis", "https://api.travis-ci.org")`
+        :param max_connections: int, size of the pooled session, and maximum
+            number of requests in flight at the same time
+        :param page_limit: int, items requested per page
+        :param use_cache: bool, if True, make conditional requests using the
+            HttpCache at `http_cache_db()`
+        """
+        if domain is None:
+            domain = api_url("travis", "https://api.travis-ci.org")
         self.domain = domain
         self.token = get_config_value(self._shortname(), "token")
+        self.max_connections = max_connections
+        self.page_limit = page_limit
+        self.use_cache = use_cache
+        self.session = None
+        self.http_cache = None
+        self.rate_limiter = None
+
+    def _connect_session(self):
+        """Create the pooled session, on first request"""
+        if self.session is not None:
+            return
+        import requests
+        from http_cache import CachingAdapter, HttpCache
+        from rate_limit import RateLimiter
+
+        self.http_cache = HttpCache(http_cache_db()) if self.use_cache else None
+        self.rate_limiter = RateLimiter(self._shortname())
+        adapter = CachingAdapter(
+            self.http_cache,
+            limiter=self.rate_limiter,
+            pool_connections=self.max_connections,
+            pool_maxsize=self.max_connections,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(
+            {"Travis-API-Version": "3", "Authorization": "token " + str(self.token)}
+        )
+        self.session = session
 
     @staticmethod
     def _shortname():
@@ -335,25 +1518,100 @@ class TravisStats(StatsBase):
 
     @staticmethod
     def _repos_colinfo():
-        return ["name TEXT UNIQUE", "travis_id INT"]
+        # last_build_started_at: newest build "started_at" counted in stats
+        return ["name TEXT UNIQUE", "travis_id INT", "last_build_started_at TEXT"]
 
     @staticmethod
     def _stats_colinfo():
         return ["repo_id INT", "day INT", "build_count INT"]
 
+    def _get(self, href):
+        self._connect_session()
+        return self.session.get(self.domain + href)
+
+    async def _get_async(self, href, semaphore):
+        """Run `_get` in a worker thread, at most `semaphore` at a time"""
+        import asyncio
+
+        async with semaphore:
+            return await asyncio.to_thread(self._get, href)
+
+    async def _get_all_pages_async(self, href, key, semaphore):
+        """
+        Request every page of a paginated Travis API v3 collection
+
+        After the first page, if "@pagination" gives the total count, the
+        remaining pages are requested in parallel by offset. Otherwise the
+        "next" links are followed one at a time.
+
+        :param href: str, i.e. "/repo/123/builds"
+        :param key: str, collection key in the response, i.e. "builds"
+        :param semaphore: asyncio.Semaphore, bounds concurrent requests
+        :return: list of collection items, or None if the first response did
+            not contain `key`
+        """
+        import asyncio
+
+        r = await self._get_async(page_href(href, self.page_limit, 0), semaphore)
+        res = r.json()
+        if not res or key not in res:
+            return None
+        items = list(res[key])
+
+        if "@pagination" not in res:
+            print(r.text)
+            raise Exception("travis " + key + " pagination unexpected behavior")
+        pagination = res["@pagination"]
+        if pagination["is_last"] == True:
+            return items
+
+        if pagination.get("count") is not None and pagination.get("limit"):
+            limit = pagination["limit"]
+            offsets = range(pagination["offset"] + limit, pagination["count"], limit)
+            responses = await asyncio.gather(
+                *[
+                    self._get_async(page_href(href, limit, offset), semaphore)
+                    for offset in offsets
+                ]
+            )
+            for r in responses:
+                res = r.json()
+                if key not in res:
+                    print(r.text)
+                    raise Exception("travis " + key + " pagination unexpected behavior")
+                items += res[key]
+            return items
+
+        # handle pagination without a total count
+        while pagination["is_last"] != True:
+            r = await self._get_async(pagination["next"]["@href"], semaphore)
+            res = r.json()
+            if key not in res or "@pagination" not in res:
+                print(r.text)
+                raise Exception("travis " + key + " pagination unexpected behavior")
+            items += res[key]
+            pagination = res["@pagination"]
+        return items
+
     def get_travis_ids(self):
         """
         :return repo_ids: dict of {slug: travis_id}
         """
-        r = requests.get(
-            self.domain + "/repos",
-            headers={"Travis-API-Version": "3", "Authorization": "token " + self.token},
+        import asyncio
+
+        return asyncio.run(self._get_travis_ids_async())
+
+    async def _get_travis_ids_async(self):
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.max_connections)
+        repositories = await self._get_all_pages_async(
+            "/repos", "repositories", semaphore
         )
-        res = r.json()
-        if not res:
+        if not repositories:
             return None
         repo_ids = {}
-        for repo in res["repositories"]:
+        for repo in repositories:
             repo_ids[repo["slug"]] = str(repo["id"])
         return repo_ids
 
@@ -378,64 +1636,1084 @@ class TravisStats(StatsBase):
                     "UPDATE repos SET " + setstr + " WHERE repo_id=?",
                     valtuple + (repo_id,),
                 )
-                self.conn.commit()
-                break
+        self.conn.commit()
         return
 
-    def get_build_counts(self, travis_id):
-        href = "/repo/" + str(travis_id) + "/builds"
+    def get_build_counts(self, travis_id, since=None):
+        """
+        :param travis_id: int, Travis repository id
+        :param since: datetime.date, optional. If given, only builds started on
+            or after this day are requested and counted.
+        :return build_counts: dict of {datetime.date: number of builds started},
+            or None if Travis did not return builds
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.max_connections)
+        result = asyncio.run(self._get_build_counts_async(travis_id, since, semaphore))
+        if result is None:
+            return None
+        return result[0]
+
+    @staticmethod
+    def _count_builds(builds, since=None):
+        """
+        :return (build_counts, last_started_at): dict of {datetime.date: count}
+            of builds started on or after `since`, and the newest "started_at"
+        """
+        import dateutil.parser
+
         build_counts = {}
-        # handle pagination
+        last_started_at = None
+        # pages requested by offset can overlap if builds are added meanwhile
+        build_ids = set()
+        for build in builds:
+            if build["id"] in build_ids:
+                continue
+            build_ids.add(build["id"])
+            if build["started_at"] is not None:
+                started_at = dateutil.parser.parse(build["started_at"])
+                if since is not None and started_at.date() < since:
+                    continue
+                if started_at.date() not in build_counts:
+                    build_counts[started_at.date()] = 0
+                build_counts[started_at.date()] += 1
+                if last_started_at is None or started_at > last_started_at:
+                    last_started_at = started_at
+        if last_started_at is not None:
+            last_started_at = last_started_at.isoformat()
+        return build_counts, last_started_at
+
+    async def _get_builds_since_async(self, travis_id, since, semaphore):
+        """
+        Request builds newest first, stopping at the first page that reaches
+        back before the day `since`
+        """
+        import dateutil.parser
+
+        href = page_href(
+            "/repo/" + str(travis_id) + "/builds?sort_by=started_at:desc",
+            self.page_limit,
+            0,
+        )
+        builds = []
         while True:
-            r = requests.get(
-                self.domain + href,
-                headers={
-                    "Travis-API-Version": "3",
-                    "Authorization": "token " + self.token,
-                },
-            )
+            r = await self._get_async(href, semaphore)
             res = r.json()
             if "builds" not in res:
                 return None
-            for build in res["builds"]:
-                if build["started_at"] is not None:
-                    started_at = dateutil.parser.parse(build["started_at"])
-                    if started_at.date() not in build_counts:
-                        build_counts[started_at.date()] = 0
-                    build_counts[started_at.date()] += 1
-
+            builds += res["builds"]
             if "@pagination" not in res:
                 print(r.text)
                 raise Exception("travis builds pagination unexpected behavior")
             if res["@pagination"]["is_last"] == True:
                 break
+            if any(
+                build["started_at"] is not None
+                and dateutil.parser.parse(build["started_at"]).date() < since
+                for build in res["builds"]
+            ):
+                break
+            href = res["@pagination"]["next"]["@href"]
+        return builds
+
+    async def _get_build_counts_async(self, travis_id, since, semaphore):
+        """
+        :return (build_counts, last_started_at), as from `_count_builds`, or
+            None if Travis did not return builds
+        """
+        if since is None:
+            builds = await self._get_all_pages_async(
+                "/repo/" + str(travis_id) + "/builds", "builds", semaphore
+            )
+        else:
+            builds = await self._get_builds_since_async(travis_id, since, semaphore)
+        if builds is None:
+            return None
+        return self._count_builds(builds, since)
+
+    async def _get_all_build_counts_async(self, repos, full):
+        """
+        :return: list, for each repo, the result of `_get_build_counts_async`,
+            or the exception it raised, so one repo failing does not stop the
+            others
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.max_connections)
+
+        async def repo_build_counts(repo):
+            with instrument.timer("repo", provider="travis", repo=repo["name"]):
+                return await self._get_build_counts_async(
+                    repo["travis_id"], self._sync_since(repo, full), semaphore
+                )
+
+        return await asyncio.gather(
+            *[repo_build_counts(repo) for repo in repos], return_exceptions=True
+        )
+
+    @staticmethod
+    def _sync_since(repo, full):
+        """
+        :return: datetime.date, day of the repo's last counted build, which is
+            recounted in full, or None to resync all builds
+        """
+        import dateutil.parser
+
+        if full or repo["last_build_started_at"] is None:
+            return None
+        return dateutil.parser.parse(repo["last_build_started_at"]).date()
+
+    def planned_requests(self, repo_names=None):
+        """
+        :param repo_names: list of str, optional, the repos updated, default all
+        :return: int, minimum number of requests `update_stats` makes: one
+            page of builds per repo, and one for repo ids if any are unknown
+        """
+        repos = [
+            repo
+            for repo in self.conn.execute("SELECT name, travis_id FROM repos").fetchall()
+            if repo_names is None or repo["name"] in repo_names
+        ]
+        n_unknown = len([repo for repo in repos if repo["travis_id"] is None])
+        return len(repos) - n_unknown + (1 if n_unknown else 0)
+
+    def update_stats(self, full=False):
+        """
+        Count builds per day for all repos, see `update_repos`
+
+        :param full: bool, if True, request and recount every build
+        """
+        self.update_repos(full=full)
+
+    def update_repos(self, repo_names=None, full=False):
+        """
+        Count builds per day and write them to the "stats" table
+
+        Only builds started on or after the day of the newest build already
+        counted for a repo are requested, and only those days are rewritten.
+        Repos without a Travis id are skipped.
+
+        :param repo_names: list of str, optional, only update these repos
+        :param full: bool, if True, request and recount every build
+        :return: list of str, the repos that failed
+        """
+        import asyncio
+
+        with instrument.timer("phase", provider="travis", phase="setup"):
+            self._connect_session()
+            self.rate_limiter.report(self.planned_requests(repo_names))
+            self._check_travis_ids()
+        repos = [
+            repo
+            for repo in self.conn.execute("SELECT * FROM repos").fetchall()
+            if repo["travis_id"] is not None
+            and (repo_names is None or repo["name"] in repo_names)
+        ]
+
+        # all repos share the session and at most `max_connections` requests
+        with instrument.timer("phase", provider="travis", phase="requests"):
+            results = asyncio.run(self._get_all_build_counts_async(repos, full))
+
+        failed = []
+        with instrument.timer("phase", provider="travis", phase="write"):
+            for repo, result in zip(repos, results):
+                name = repo["name"]
+                repo_id = repo["repo_id"]
+
+                if isinstance(result, Exception):
+                    print("error:", name, repr(result))
+                    instrument.count("repo_errors", provider="travis", repo=name)
+                    failed.append(name)
+                    continue
+                if result is None:
+                    print(name, " build_counts:", result)
+                    failed.append(name)
+                    continue
+                build_counts, last_started_at = result
+
+                with self.transaction():
+                    self._upsert_stats(
+                        (repo_id, toordinal(date), {"build_count": build_count})
+                        for date, build_count in build_counts.items()
+                    )
+                    if last_started_at is not None:
+                        self.conn.execute(
+                            "UPDATE repos SET last_build_started_at=? WHERE repo_id=?",
+                            (last_started_at, repo_id),
+                        )
+        return failed
+
+
+def anaconda_org_stats_db():
+    return os.path.join(code_stats_prefix(), "anaconda_org_stats.db")
+
+
+class AnacondaStats(StatsBase):
+    """
+    Daily downloads of conda packages on anaconda.org
+
+    Repos are packages, named "channel/package", i.e. "prisms-center/casm".
+    anaconda.org only gives each file's running total of downloads, so the
+    totals last seen are kept in "snapshot_totals", and the stats "downloads"
+    of a day is the increase since the previous update. The downloads a file
+    had when first seen are counted on the day it was uploaded. Stats are
+    stored in `anaconda_org_stats_db()`.
+    """
+
+    # repos are "channel/package" names
+    github_repos = False
+
+    def __init__(
+        self,
+        domain=None,
+        channels=None,
+        max_connections=8,
+        use_cache=True,
+    ):
+        """
+        :param domain: str, anaconda.org API domain, default
+            `api_url("anaconda", "https://api.anaconda.org")`
+        :param channels: list of str, optional, channels whose packages are
+            all tracked; packages found when a channel is listed are added
+        :param max_connections: int, size of the pooled session, and maximum
+            number of requests in flight at the same time
+        :param use_cache: bool, if True, make conditional requests using the
+            HttpCache at `http_cache_db()`
+        """
+        if domain is None:
+            domain = api_url("anaconda", "https://api.anaconda.org")
+        self.domain = domain
+        self.channels = list(channels or [])
+        self.token = get_config_value(self._shortname(), "token")
+        self.max_connections = max_connections
+        self.use_cache = use_cache
+        self.session = None
+        self.http_cache = None
+        self.rate_limiter = None
+
+    def _connect_session(self):
+        """Create the pooled session, on first request"""
+        if self.session is not None:
+            return
+        import requests
+        from http_cache import CachingAdapter, HttpCache
+        from rate_limit import RateLimiter
+
+        self.http_cache = HttpCache(http_cache_db()) if self.use_cache else None
+        self.rate_limiter = RateLimiter(self._shortname())
+        adapter = CachingAdapter(
+            self.http_cache,
+            limiter=self.rate_limiter,
+            pool_connections=self.max_connections,
+            pool_maxsize=self.max_connections,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        # public channels need no token
+        if self.token is not None:
+            session.headers.update({"Authorization": "token " + str(self.token)})
+        self.session = session
+
+    @staticmethod
+    def _shortname():
+        return "anaconda_org"
+
+    @staticmethod
+    def _repos_colinfo():
+        return ["name TEXT UNIQUE"]
+
+    @staticmethod
+    def _stats_colinfo():
+        return ["repo_id INT", "day INT", "downloads INT"]
+
+    def _get(self, href):
+        self._connect_session()
+        return self.session.get(self.domain + href)
+
+    async def _get_json_async(self, href, semaphore):
+        """
+        Run `_get` in a worker thread, at most `semaphore` at a time
+
+        :return: the response JSON, or None if the request failed
+        """
+        import asyncio
+
+        async with semaphore:
+            r = await asyncio.to_thread(self._get, href)
+        if r.status_code != 200:
+            print("error:", self._shortname(), href, r.status_code)
+            return None
+        return r.json()
+
+    async def _get_packages_async(self, channels, repo_names):
+        """
+        List each channel's packages in one request, and request the packages
+        of `repo_names` whose files the listing did not include
+
+        :param channels: list of str, channels listed
+        :param repo_names: list of str, "channel/package" names
+        :return (files, listed, unlisted): dict of {repo_name: list of file
+            dict, or None if the request failed}, list of str, the packages
+            found in the channel listings, and list of str, the channels
+            whose listing failed
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.max_connections)
+        listings = await asyncio.gather(
+            *[
+                self._get_json_async("/packages/" + urllib.parse.quote(c), semaphore)
+                for c in channels
+            ]
+        )
+        files = {}
+        listed = []
+        unlisted = [c for c, listing in zip(channels, listings) if listing is None]
+        for channel, listing in zip(channels, listings):
+            for package in listing or []:
+                repo_name = channel + "/" + package["name"]
+                listed.append(repo_name)
+                if "files" in package:
+                    files[repo_name] = package["files"]
+
+        todo = [repo_name for repo_name in repo_names if repo_name not in files]
+        packages = await asyncio.gather(
+            *[
+                self._get_json_async(
+                    "/package/" + urllib.parse.quote(repo_name), semaphore
+                )
+                for repo_name in todo
+            ]
+        )
+        for repo_name, package in zip(todo, packages):
+            files[repo_name] = None if package is None else package.get("files", [])
+        return files, listed, unlisted
+
+    def _add_listed(self, listed):
+        """
+        Add the packages of `channels` in `listed`, only those of `shard` if set
+
+        :param listed: list of str, packages found in channel listings
+        :return: list of str, the repos that were added
+        """
+        found = [name for name in listed if name.split("/")[0] in self.channels]
+        if self.shard is not None:
+            import shards
+
+            found = shards.select_shard(found, self.shard)
+        added = self.add_repos(found)
+        for repo_name in added:
+            print(self._shortname() + ": added", repo_name)
+        return added
+
+    def discover_repos(self):
+        """
+        List `channels`, and add their packages not yet tracked, only those of
+        `shard` if set
+
+        :return: list of str, the repos that were added
+        """
+        import asyncio
+
+        self._connect_session()
+        files, listed, unlisted = asyncio.run(
+            self._get_packages_async(self.channels, [])
+        )
+        return self._add_listed(listed)
+
+    @staticmethod
+    def _count_downloads(files, totals, today):
+        """
+        :param files: list of dict, anaconda.org package "files"
+        :param totals: dict of {basename: total}, as last seen
+        :param today: datetime.date
+        :return (downloads, seen): dict of {datetime.date: downloads} since
+            `totals`, and list of (basename, version, total) of every file
+        """
+        import dateutil.parser
+
+        downloads = {}
+        seen = []
+        for f in files:
+            total = f.get("ndownloads") or 0
+            seen.append((f["basename"], f.get("version"), total))
+            previous = totals.get(f["basename"])
+            if previous is None:
+                day = today
+                if f.get("upload_time"):
+                    day = min(today, dateutil.parser.parse(f["upload_time"]).date())
+                delta = total
             else:
-                href = res["@pagination"]["next"]["@href"]
-        return build_counts
+                day = today
+                # a total that went down was reset, it is the new baseline
+                delta = max(total - previous, 0)
+            if delta:
+                downloads[day] = downloads.get(day, 0) + delta
+        return downloads, seen
+
+    def planned_requests(self, repo_names=None):
+        """
+        :param repo_names: list of str, optional, the repos updated, default all
+        :return: int, minimum number of requests `update_stats` makes: one
+            listing per channel
+        """
+        channels = set(self.channels)
+        for repo_name in self.list_repo_names():
+            if repo_names is None or repo_name in repo_names:
+                channels.add(repo_name.split("/")[0])
+        return len(channels)
 
     def update_stats(self):
-        self._check_travis_ids()
-        repos = [repo for repo in self.conn.execute("SELECT * FROM repos").fetchall()]
+        """
+        Request downloads for all packages, and of `channels`, see
+        `update_repos`; if any failed, an Exception listing them is raised
+        at the end
+        """
+        failed = self.update_repos()
+        if len(failed):
+            raise Exception("Failed to update anaconda.org stats for: " + ", ".join(failed))
 
-        for repo in repos:
-            name = repo["name"]
-            repo_id = repo["repo_id"]
-            travis_id = repo["travis_id"]
+    def update_repos(self, repo_names=None):
+        """
+        Request download totals and write the downloads since the last update
+        to the "stats" table, each package in one transaction with its totals
+
+        Each channel's packages are listed with one request, and packages are
+        only requested one by one if the listing lacks their files. All
+        requests share one session and at most `max_connections` are in
+        flight.
+
+        :param repo_names: list of str, optional, only update these repos,
+            otherwise all; packages of `channels` not yet tracked are added,
+            only those of `shard` if set, and updated if `repo_names` is None
+        :return: list of str, the repos that failed, and the `channels` whose
+            listing failed
+        """
+        import asyncio
+
+        with instrument.timer("phase", provider="anaconda_org", phase="setup"):
+            self._connect_session()
+            self.rate_limiter.report(self.planned_requests(repo_names))
+        names = [
+            repo_name
+            for repo_name in self.list_repo_names()
+            if repo_names is None or repo_name in repo_names
+        ]
+        channels = sorted(
+            set(repo_name.split("/")[0] for repo_name in names) | set(self.channels)
+        )
 
-            if travis_id is None:
-                continue
+        with instrument.timer("phase", provider="anaconda_org", phase="requests"):
+            files, listed, unlisted = asyncio.run(
+                self._get_packages_async(channels, names)
+            )
+        for repo_name in self._add_listed(listed):
+            if repo_names is None:
+                names.append(repo_name)
+
+        # other channels' packages were requested one by one
+        failed = [channel for channel in unlisted if channel in self.channels]
+        today = datetime.date.today()
+        with instrument.timer("phase", provider="anaconda_org", phase="write"):
+            for repo_name in names:
+                if files.get(repo_name) is None:
+                    failed.append(repo_name)
+                    continue
+                repo_id = self.get_repo_id(repo_name)
+                with self.transaction():
+                    totals = {
+                        r["item"]: r["total"]
+                        for r in self.conn.execute(
+                            "SELECT item, total FROM snapshot_totals WHERE repo_id=?",
+                            (repo_id,),
+                        )
+                    }
+                    downloads, seen = self._count_downloads(
+                        files[repo_name], totals, today
+                    )
+                    # add to the downloads already recorded for the day
+                    recorded = {}
+                    for day in downloads:
+                        r = self.conn.execute(
+                            "SELECT downloads FROM stats WHERE repo_id=? AND day=?",
+                            (repo_id, toordinal(day)),
+                        ).fetchone()
+                        recorded[day] = 0 if r is None else r["downloads"] or 0
+                    self._upsert_stats(
+                        (repo_id, toordinal(day), {"downloads": recorded[day] + n})
+                        for day, n in sorted(downloads.items())
+                    )
+                    self.conn.executemany(
+                        "INSERT INTO snapshot_totals (repo_id, item, version, total)"
+                        " VALUES (?, ?, ?, ?) ON CONFLICT (repo_id, item) DO UPDATE"
+                        " SET version=excluded.version, total=excluded.total",
+                        [(repo_id,) + item for item in seen],
+                    )
+        return failed
+
+
+providers = {"anaconda_org": AnacondaStats, "github": GithubStats, "travis": TravisStats}
+
+# (module name, seconds) of the imports made by `timed_import`
+import_times = []
+
+
+def timed_import(name):
+    """
+    Import a module, recording how long the first import took in `import_times`
+    """
+    import importlib
 
-            build_counts = self.get_build_counts(repo["travis_id"])
-            if build_counts is None:
-                print(name, " build_counts:", build_counts)
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times.append((name, time.perf_counter() - start))
+    return module
+
+
+def _provider_classes(provider):
+    if provider == "all":
+        return [providers[name] for name in sorted(providers)]
+    return [providers[provider]]
+
+
+def _discover(args):
+    """
+    :return: list of str, repos of the owners in `args.discover`, as from
+        `discover_github_repos` using the command line filters
+    """
+    from http_cache import HttpCache
+
+    cache = None if getattr(args, "no_cache", False) else HttpCache(http_cache_db())
+    g = github_client(get_config_value("github", "token"), cache=cache)
+    try:
+        with instrument.timer("phase", provider="github", phase="discover"):
+            repo_names = discover_github_repos(
+                g,
+                args.discover,
+                include=args.include,
+                exclude=args.exclude,
+                archived=args.archived,
+                forks=args.forks,
+            )
+    finally:
+        g.close()
+        if cache is not None:
+            cache.close()
+    print("Discovered", len(repo_names), "repos of", ", ".join(args.discover))
+    return repo_names
+
+
+def _sync_discovered(db, repo_names, args):
+    added, removed = db.sync_repos(repo_names, args.discover, prune=args.prune)
+    for repo_name in added:
+        print(db._shortname() + ": added", repo_name)
+    for repo_name in removed:
+        if args.prune:
+            print(db._shortname() + ": removed", repo_name)
+        else:
+            print(
+                db._shortname() + ": not found, use --prune to remove:", repo_name
+            )
+
+
+def _cmd_update(args):
+    for name in ["asyncio", "dateutil.parser", "requests", "github"]:
+        timed_import(name)
+    update_all = timed_import("update_all")
+    discovered = None
+    if args.discover:
+        discovered = _discover(args)
+    shard = None
+    assignments = None
+    if args.shard is not None:
+        import shards
+
+        shard = shards.parse_shard(args.shard)
+        if args.shard_file is not None:
+            assignments = shards.read_shard_file(args.shard_file, shard[1])
+    elif args.shard_file is not None:
+        raise Exception("--shard-file requires --shard")
+
+    # a provider that fails does not stop the others
+    failed = []
+    for db_cls in _provider_classes(args.provider):
+        try:
+            _update_provider(db_cls, args, update_all, discovered, shard, assignments)
+        except Exception as e:
+            print("error:", db_cls._shortname(), "update:", repr(e))
+            failed.append(db_cls._shortname())
+    if len(failed):
+        raise Exception("Failed to update: " + ", ".join(failed))
+
+
+def _update_provider(db_cls, args, update_all, discovered, shard, assignments):
+    """
+    Update one provider, for `_cmd_update`
+
+    :param discovered: list of str, optional, GitHub repos discovered
+    :param shard: (index, n_shards), optional
+    :param assignments: dict of {repo_name: int}, optional, for `shard`
+    """
+    repos = list(update_all.provider_repos(db_cls))
+    # GitHub repos are not conda packages
+    discovered_repos = discovered if db_cls.github_repos else None
+    if shard is not None:
+        # a shard covers all repos tracked by the canonical database
+        db = db_cls()
+        if os.path.isfile(db._db()):
+            db.connect(readonly=True)
+            repos += [r for r in db.list_repo_names() if r not in repos]
+            db.close()
+    if discovered_repos is not None:
+        repos += [r for r in discovered_repos if r not in repos]
+    if shard is not None:
+        import shards
+
+        repos = shards.select_shard(repos, shard, assignments)
+        print(
+            db_cls._shortname() + ": shard", args.shard + ":",
+            len(repos), "repos",
+        )
+    if discovered_repos is not None:
+        # repos listed in update_all are kept, even if not discovered
+        db = db_cls()
+        db.shard = shard
+        db.connect()
+        _sync_discovered(db, repos, args)
+        db.close()
+    if db_cls is GithubStats:
+        update_all.update_all(
+            db_cls,
+            repos,
+            shard=shard,
+            max_workers=args.workers,
+            use_cache=not args.no_cache,
+        )
+    elif db_cls is AnacondaStats:
+        update_all.update_all(
+            db_cls,
+            repos,
+            db_kwargs={
+                "channels": update_all.anaconda_channels,
+                "use_cache": not args.no_cache,
+            },
+            shard=shard,
+        )
+    else:
+        update_all.update_all(
+            db_cls,
+            repos,
+            db_kwargs={"use_cache": not args.no_cache},
+            shard=shard,
+            full=args.full,
+        )
+
+
+def _cmd_daemon(args):
+    for name in ["asyncio", "dateutil.parser", "requests", "github"]:
+        timed_import(name)
+    update_all = timed_import("update_all")
+    daemon = timed_import("daemon")
+    schedulers = []
+    for db_cls in _provider_classes(args.provider):
+        if db_cls is GithubStats:
+            db_kwargs = {}
+            update_kwargs = {"max_workers": args.workers, "use_cache": not args.no_cache}
+        elif db_cls is AnacondaStats:
+            db_kwargs = {
+                "channels": update_all.anaconda_channels,
+                "use_cache": not args.no_cache,
+            }
+            update_kwargs = {}
+        else:
+            db_kwargs = {"use_cache": not args.no_cache}
+            update_kwargs = {}
+        schedulers.append(
+            daemon.Scheduler(
+                db_cls,
+                db_kwargs=db_kwargs,
+                update_kwargs=update_kwargs,
+                repos=update_all.provider_repos(db_cls),
+                interval=args.interval_hours * 3600.0,
+                tick=args.tick,
+                max_requests_per_hour=args.max_requests_per_hour,
+            )
+        )
+    daemon.run(
+        schedulers,
+        tick=args.tick,
+        report=not args.no_report,
+        once=args.once,
+        run_log=args.run_log,
+        prometheus=args.prometheus,
+    )
+
+
+def _cmd_merge(args):
+    rules = {}
+    for value in args.rule or []:
+        col, _, rule = value.partition("=")
+        rules[col] = rule
+    for db_cls in _provider_classes(args.provider):
+        db = db_cls()
+        if args.shards:
+            # with --provider all, shards are matched by file name
+            paths = [
+                path for path in args.shards
+                if args.provider != "all"
+                or os.path.basename(path).startswith(db._shortname() + "_")
+            ]
+        else:
+            paths = sorted(
+                glob.glob(
+                    os.path.join(code_stats_prefix(), db._shortname() + "_stats.shard-*.db")
+                )
+            )
+        if not len(paths):
+            continue
+        db.connect()
+        for path in paths:
+            start = time.perf_counter()
+            counts = db.merge_shard(path, rules=rules)
+            print(
+                db._shortname() + ": merged", path + ":", counts,
+                str(round(time.perf_counter() - start, 3)) + "s",
+            )
+        db.close()
+
+
+def run_log_path():
+    return os.path.join(code_stats_prefix(), "run_log.jsonl")
+
+
+def _run_instrumented(args):
+    """
+    Run a command, then append its metrics to the run log, and write them to
+    the Prometheus textfile, if requested, also if the command fails
+    """
+    instrument.reset()
+    ok = False
+    try:
+        with instrument.profile(
+            cprofile_path=args.profile, tracemalloc_top=args.tracemalloc
+        ):
+            args.func(args)
+        ok = True
+    finally:
+        instrument.gauge("run_success", int(ok), command=args.command)
+        run_log = args.run_log if args.run_log is not None else run_log_path()
+        instrument.write_run_log(run_log, command=args.command, ok=ok)
+        if args.prometheus is not None:
+            instrument.write_prometheus(args.prometheus)
+
+
+def _cmd_import_legacy(args):
+    legacy = timed_import("create_from_legacy_data")
+    for orgname in args.org:
+        org = legacy.orgs[orgname]
+        path = args.file if args.file is not None else org["file"]
+        with legacy.open_legacy_file(path) as f:
+            legacy.create_from_legacy(orgname, org["repos"], f)
+
+
+def _cmd_plot(args):
+    for name in ["numpy", "pandas", "matplotlib.pyplot"]:
+        timed_import(name)
+    timed_import("plot").main()
+
+
+def _skip_missing(db):
+    """:return: bool, True, after saying so, if `db` has no database file yet"""
+    if os.path.isfile(db._db()):
+        return False
+    print(db._shortname() + ": no database,", db._db())
+    return True
+
+
+def _cmd_report(args):
+    for db_cls in _provider_classes(args.provider):
+        db = db_cls()
+        if _skip_missing(db):
+            continue
+        db.connect(readonly=True)
+        snapshot_cols = db.snapshot_cols()
+        cols = [col for col in db.metric_cols() if col not in snapshot_cols]
+        print(db._shortname())
+        print("~" * len(db._shortname()))
+        for record in db.conn.execute(
+            "SELECT repo_id, name, "
+            + "".join("TOTAL(" + col + ") AS " + col + ", " for col in cols)
+            + "MIN(week_end) AS first_week, MAX(week_end) AS last_week"
+            " FROM repos LEFT JOIN stats_weekly USING (repo_id)"
+            " GROUP BY repos.repo_id ORDER BY name"
+        ):
+            weeks = ""
+            if record["first_week"] is not None:
+                weeks = (
+                    " (weeks " + str(fromordinal(record["first_week"]))
+                    + " to " + str(fromordinal(record["last_week"])) + ")"
+                )
+            print(record["name"] + weeks)
+            for col in cols:
+                print("    " + col + ":", int(record[col]))
+            for col in snapshot_cols:
+                latest = db.conn.execute(
+                    "SELECT " + col + " FROM stats WHERE repo_id=? AND "
+                    + col + " IS NOT NULL ORDER BY day DESC LIMIT 1",
+                    (record["repo_id"],),
+                ).fetchone()
+                print("    " + col + ":", None if latest is None else latest[0])
+        print()
+        db.close()
+
+
+def _cmd_export(args):
+    timed_import("pyarrow")
+    for db_cls in _provider_classes(args.provider):
+        db = db_cls()
+        if _skip_missing(db):
+            continue
+        db.connect(readonly=True)
+        counts = db.export_tables(args.dir, fmt=args.format, chunk_size=args.chunk_size)
+        print(db._shortname() + ":", counts)
+        db.close()
+
+
+def _cmd_import(args):
+    timed_import("pyarrow")
+    for db_cls in _provider_classes(args.provider):
+        db = db_cls()
+        db.connect()
+        counts = db.import_tables(args.dir, chunk_size=args.chunk_size)
+        print(db._shortname() + ":", counts)
+        db.close()
+
+
+def _cmd_repos(args):
+    discovered = None
+    if args.action == "discover":
+        args.discover = args.names
+        discovered = _discover(args)
+    for db_cls in _provider_classes(args.provider):
+        if args.action != "list" and not db_cls.github_repos:
+            # GitHub repos are not conda packages: packages are only added or
+            # removed if their provider is named, and never discovered
+            if args.action == "discover" or args.provider != db_cls._shortname():
                 continue
+        db = db_cls()
+        if args.action == "list" and _skip_missing(db):
+            continue
+        db.connect(readonly=args.action == "list")
+        if args.action == "add":
+            db.add_repos(args.names)
+        elif args.action == "discover":
+            _sync_discovered(db, discovered, args)
+        elif args.action == "remove":
+            for repo_name in args.names:
+                db.remove_repo(repo_name)
+        else:
+            print(db._shortname() + ":")
+            for repo_name in db.list_repo_names():
+                print("    " + repo_name)
+        db.close()
 
-            for date in build_counts:
-                build_count = build_counts[date]
-                day = toordinal(date)
-                self._insert_or_update_stats(repo_id, day, {"build_count": build_count})
-            self.conn.commit()
+
+def add_discover_arguments(p):
+    p.add_argument(
+        "--include", nargs="+", metavar="PATTERN", help="discover only matching repos"
+    )
+    p.add_argument(
+        "--exclude", nargs="+", metavar="PATTERN", help="do not discover matching repos"
+    )
+    p.add_argument("--archived", action="store_true", help="discover archived repos")
+    p.add_argument("--forks", action="store_true", help="discover forks")
+    p.add_argument(
+        "--prune",
+        action="store_true",
+        help="remove repos of the discovered owners that were not found, "
+        "and their stats",
+    )
 
 
-def anaconda_org_stats_db():
-    return os.path.join(code_stats_prefix(), "anaconda_org_stats.db")
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Collect, store and plot open source project stats"
+    )
+    parser.add_argument(
+        "--import-times",
+        action="store_true",
+        help="print how long importing each dependency of the subcommand took,"
+        " after code_stats itself was imported",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # options of the commands run with `_run_instrumented`
+    metrics_parser = argparse.ArgumentParser(add_help=False)
+    metrics_parser.add_argument(
+        "--run-log", help="JSON lines run log appended to, default data/run_log.jsonl"
+    )
+    metrics_parser.add_argument("--prometheus", help="Prometheus textfile to write")
+    metrics_parser.add_argument("--profile", help="cProfile stats file to write")
+    metrics_parser.add_argument(
+        "--tracemalloc",
+        type=int,
+        default=0,
+        metavar="N",
+        help="trace memory allocations and print the top N lines",
+    )
+
+    p = subparsers.add_parser(
+        "update", help="request new stats for all repos", parents=[metrics_parser]
+    )
+    p.add_argument("--provider", choices=["all"] + sorted(providers), default="all")
+    p.add_argument("--workers", type=int, default=8, help="github repos in parallel")
+    p.add_argument("--full", action="store_true", help="recount all travis builds")
+    p.add_argument("--no-cache", action="store_true", help="do not use the HTTP cache")
+    p.add_argument(
+        "--discover",
+        nargs="+",
+        metavar="OWNER",
+        help="also track all repos of these GitHub orgs or users",
+    )
+    add_discover_arguments(p)
+    p.add_argument(
+        "--shard",
+        metavar="I/N",
+        help="only update shard I of N (0 <= I < N) of the repos, in its own "
+        "shard database, i.e. data/github_stats.shard-0-of-4.db",
+    )
+    p.add_argument(
+        "--shard-file",
+        help="JSON file of {repo name: shard index}, for repos not assigned "
+        "by consistent hash",
+    )
+    p.set_defaults(func=_cmd_update)
+
+    p = subparsers.add_parser(
+        "daemon",
+        help="keep updating repos, each about once per interval, spread over the day",
+    )
+    p.add_argument("--provider", choices=["all"] + sorted(providers), default="all")
+    p.add_argument(
+        "--interval-hours", type=float, default=24.0, help="time between updates of a repo"
+    )
+    p.add_argument("--tick", type=float, default=300.0, help="seconds between ticks")
+    p.add_argument(
+        "--max-requests-per-hour", type=int, help="request budget, per provider"
+    )
+    p.add_argument("--workers", type=int, default=8, help="github repos in parallel")
+    p.add_argument("--no-cache", action="store_true", help="do not use the HTTP cache")
+    p.add_argument(
+        "--no-report", action="store_true", help="do not rebuild plots when stats change"
+    )
+    p.add_argument("--once", action="store_true", help="run one tick and exit")
+    p.add_argument(
+        "--run-log",
+        help="JSON lines run log appended to each tick, default data/run_log.jsonl",
+    )
+    p.add_argument("--prometheus", help="Prometheus textfile written each tick")
+    p.set_defaults(func=_cmd_daemon, instrumented=False)
+
+    p = subparsers.add_parser(
+        "merge", help="merge shard databases into the canonical databases"
+    )
+    p.add_argument(
+        "shards",
+        nargs="*",
+        help="shard database files, in merge order, default all in data/; "
+        "with --provider all, matched by name, i.e. github_stats.shard-0-of-4.db",
+    )
+    p.add_argument("--provider", choices=["all"] + sorted(providers), default="all")
+    p.add_argument(
+        "--rule",
+        nargs="+",
+        metavar="COLUMN=RULE",
+        help="value kept when both databases have one: 'max' (default), or "
+        "'latest', the last merged",
+    )
+    p.set_defaults(func=_cmd_merge)
+
+    p = subparsers.add_parser("import-legacy", help="import clone-scraper data")
+    p.add_argument("--org", nargs="+", default=["dftfeDevelopers"])
+    p.add_argument(
+        "--file",
+        help="legacy data file, instead of the org's default; '-' for stdin, "
+        "or gzip compressed if it ends with '.gz'",
+    )
+    p.set_defaults(func=_cmd_import_legacy)
+
+    p = subparsers.add_parser(
+        "plot", help="plot weekly stats to images/", parents=[metrics_parser]
+    )
+    p.set_defaults(func=_cmd_plot)
+
+    p = subparsers.add_parser("report", help="print total stats per repo")
+    p.add_argument("--provider", choices=["all"] + sorted(providers), default="all")
+    p.set_defaults(func=_cmd_report)
+
+    p = subparsers.add_parser(
+        "export", help="write tables to Arrow IPC or Parquet files, by year"
+    )
+    p.add_argument("dir", help="export directory")
+    p.add_argument("--provider", choices=["all"] + sorted(providers), default="all")
+    p.add_argument("--format", choices=["arrow", "parquet"], default="arrow")
+    p.add_argument("--chunk-size", type=int, default=65536, help="rows per batch")
+    p.set_defaults(func=_cmd_export)
+
+    p = subparsers.add_parser("import", help="insert or update stats from an export")
+    p.add_argument("dir", help="export directory")
+    p.add_argument("--provider", choices=["all"] + sorted(providers), default="all")
+    p.add_argument("--chunk-size", type=int, default=65536, help="rows per batch")
+    p.set_defaults(func=_cmd_import)
+
+    p = subparsers.add_parser(
+        "repos", help="list, add, remove, or discover the repos of orgs or users"
+    )
+    p.add_argument(
+        "action", choices=["list", "add", "remove", "discover"], nargs="?", default="list"
+    )
+    p.add_argument(
+        "names",
+        nargs="*",
+        help="i.e. prisms-center/CASMcode, or for discover, i.e. prisms-center",
+    )
+    p.add_argument(
+        "--provider",
+        choices=["all"] + sorted(providers),
+        default="all",
+        help="add and remove only change anaconda_org if it is named",
+    )
+    add_discover_arguments(p)
+    p.set_defaults(func=_cmd_repos)
+
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    # the daemon writes the metrics of each tick itself
+    if hasattr(args, "run_log") and getattr(args, "instrumented", True):
+        _run_instrumented(args)
+    else:
+        args.func(args)
+    if args.import_times:
+        # code_stats and its module level imports are loaded before `start`,
+        # see `python -X importtime` for them
+        print("subcommand import times:")
+        for name, seconds in import_times:
+            print("    " + name + ":", str(round(seconds * 1000, 1)) + "ms")
+        print(
+            "subcommand total:",
+            str(round((time.perf_counter() - start) * 1000, 1)) + "ms",
+        )
+
+
+if __name__ == "__main__":
+    # run the command line in the "code_stats" module, not in "__main__", so
+    # there is one copy of each class, the one other modules import
+    import code_stats
+
+    code_stats.main()
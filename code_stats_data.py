@@ -1,11 +1,11 @@
 import code_stats as cs
 import datetime
+import fnmatch
+import instrument
+import json
 import numpy as np
-import pandas
-
-import pandas.plotting
-
-pandas.plotting.register_matplotlib_converters()
+import os
+from stats_cube import StatsCube
 
 
 def fromisoformat(d):
@@ -36,88 +36,43 @@ area_plot_fmt = [
 legend_values = [val[1] for val in area_plot_fmt]
 legend_values.reverse()
 
-reference_weeks = [
-    fromisoformat(x)
-    for x in [
-        "2020-08-28",  # before
-        "2020-09-04",
-        "2020-09-11",
-        "2020-09-18",
-        "2020-09-25",
-        "2020-10-02",
-        "2020-10-09",
-        "2020-10-16",
-        "2021-05-28",  # after
-        "2021-06-04",
-        "2021-06-11",
-        "2021-06-18",
-        "2021-06-25",
-        "2021-07-02",
-        "2021-07-09",
-        "2021-07-16",
-    ]
-]
-replacement_weeks_first = fromisoformat("2020-10-23")
-replacement_weeks_last = fromisoformat("2021-05-21")
-
-reference_weeks_2 = [
-    fromisoformat(x)
-    for x in [
-        "2022-04-08",  # before
-        "2022-04-15",
-        "2022-04-22",
-        "2022-04-29",
-        "2022-05-06",
-        "2022-05-13",
-        "2022-05-20",
-        "2022-05-27",
-    ]
-]
-replacement_repos_2 = [
-    "prisms-center/phaseField",
-    "prisms-center/plasticity",
-    "prisms-center/pbs",
-    "prisms-center/prisms_jobs",
-    "prisms-center/IntegrationTools",
-]
-replacement_weeks_2_first = fromisoformat("2022-06-03")
-replacement_weeks_2_last = fromisoformat("2022-09-09")
-
-# estimate missing data due to failure of clonescraper
-replacement_repos_3 = ["dftfeDevelopers/dftfe"]
-replacement_weeks_3_mean = {
-    "views": 150,
-    "unique_views": 15,
-    "clones": 5,
-    "unique_clones": 4,
-    "build_count": 0,
-}
-replacement_weeks_3_first = fromisoformat("2021-04-02")
-replacement_weeks_3_last = fromisoformat("2021-09-17")
-
-# estimate missing data due to bug in code_stats
-replacement_repos_4 = ["dftfeDevelopers/dftfe"]
-replacement_weeks_4_mean = {
-    "views": 300,
-    "unique_views": 30,
-    "clones": 10,
-    "unique_clones": 8,
-    "build_count": 0,
-}
-replacement_weeks_4_first = fromisoformat("2021-10-29")
-replacement_weeks_4_last = fromisoformat("2022-09-23")
-
-# estimate missing data due to bug in code_stats, using last 2 weeks data
-replacement_repos_5 = ["prisms-center/Fatigue"]
-replacement_weeks_5_mean = {
-    "views": 150,
-    "unique_views": 15,
-    "clones": 5.5,
-    "unique_clones": 3.5,
-    "build_count": 0,
-}
-replacement_weeks_5_first = fromisoformat("2021-10-29")
-replacement_weeks_5_last = fromisoformat("2022-09-23")
+# rules for estimating missing data, see `read_missing_data_rules`
+missing_data_rules_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "missing_data_rules.json"
+)
+
+
+def read_missing_data_rules(path=None):
+    """
+    Read rules for estimating weeks with missing data
+
+    The file holds a JSON list of rules, applied in order. Each rule has:
+        "repos": list of str, repo name glob patterns, i.e. ["prisms-center/*"]
+        "first", "last": str, ISO dates of the first and last week replaced
+        "method": "reference_mean" to replace with the mean of each repo's
+            "reference_weeks" (list of str, ISO dates), or "fixed" to replace
+            with "values" (dict of {col: value}; cols not included are kept)
+        "description": str, optional
+
+    :param path: str, defaults to `missing_data_rules_path`
+    :return: list of dict, with dates converted to datetime.date
+    """
+    if path is None:
+        path = missing_data_rules_path
+    with open(path, "r") as f:
+        rules = json.load(f)
+    for rule in rules:
+        rule["first"] = fromisoformat(rule["first"])
+        rule["last"] = fromisoformat(rule["last"])
+        if rule["method"] == "reference_mean":
+            rule["reference_weeks"] = [
+                fromisoformat(x) for x in rule["reference_weeks"]
+            ]
+        elif rule["method"] != "fixed":
+            raise Exception(
+                "Unknown missing data rule method: '" + str(rule["method"]) + "'"
+            )
+    return rules
 
 
 def sql_iter(curs, fetchsize=1000):
@@ -132,11 +87,11 @@ def sql_iter(curs, fetchsize=1000):
 
 
 def get_first_day(db):
-    return db.conn.execute("SELECT day FROM stats ORDER BY day").fetchone()["day"]
+    return db.conn.execute("SELECT MIN(day) AS day FROM stats").fetchone()["day"]
 
 
 def get_last_day(db):
-    return db.conn.execute("SELECT day FROM stats ORDER BY day DESC").fetchone()["day"]
+    return db.conn.execute("SELECT MAX(day) AS day FROM stats").fetchone()["day"]
 
 
 def get_weekly_dates(db, day_index=4):
@@ -181,57 +136,199 @@ def get_weekly_stats(curs, dates, col):
     return result
 
 
-def get_all_weekly_stats(db, dates, col, estimate_missing=True):
-    repo_names = [entry[0] for entry in area_plot_fmt]
-    df = pandas.DataFrame(index=dates, columns=db.list_repo_names())
-    for repo_name in db.list_repo_names():
-        curs = db.conn.cursor()
-        curs.execute(
-            "SELECT day, " + col + " FROM stats WHERE repo_id=? ORDER BY day",
-            (db.get_repo_id(repo_name),),
+def get_repos(db):
+    """:return: list of sqlite3.Row, (repo_id, name) of all repos, by repo_id"""
+    return db.conn.execute("SELECT repo_id, name FROM repos ORDER BY repo_id").fetchall()
+
+
+def week_index_sql(dates, day="day"):
+    """
+    :param dates: list of datetime.date, one week apart, as from `get_weekly_dates`
+    :param day: str, SQL expression for an ordinal day
+    :return: str, SQL expression for the index in `dates` of the week `day`
+        is in, counting days up to and including dates[i] in week i
+    """
+    for i in range(1, len(dates)):
+        if (dates[i] - dates[i - 1]).days != 7:
+            raise Exception("dates must be one week apart")
+    first_day = str(cs.toordinal(dates[0]))
+    return (
+        "(CASE WHEN " + day + " <= " + first_day + " THEN 0"
+        " ELSE (" + day + " - " + first_day + " + 6) / 7 END)"
+    )
+
+
+def get_weekly_arrays(db, dates, cols, first_week=0):
+    """
+    Sum stats into weeks for all repos and cols with one GROUP BY query
+
+    As in `get_weekly_stats`, week i includes the days after dates[i-1] up to
+    and including dates[i], and week 0 all days up to dates[0]. Days after
+    dates[-1] are not included, NULL is counted as 0. If `dates` end on the
+    database's `rollup_day_index` weekday, the "stats_weekly" rollup is read
+    instead of the daily stats.
+
+    :param db: StatsBase, connected
+    :param dates: list of datetime.date, one week apart, as from `get_weekly_dates`
+    :param cols: list of str, stats columns
+    :param first_week: int, only sum weeks from dates[first_week] on
+    :return (repo_names, values): list of str, as from `get_repos`, and
+        numpy.ndarray of float64 with shape
+        (len(repo_names), len(dates) - first_week, len(cols))
+    """
+    repos = get_repos(db)
+    repo_names = [r["name"] for r in repos]
+    repo_index = {r["repo_id"]: i for i, r in enumerate(repos)}
+    values = np.zeros(
+        (len(repo_names), max(len(dates) - first_week, 0), len(cols)), dtype=np.float64
+    )
+    if first_week >= len(dates):
+        return repo_names, values
+
+    if dates[0].weekday() == db.rollup_day_index:
+        table, day = "stats_weekly", "week_end"
+    else:
+        table, day = "stats", "day"
+    week = week_index_sql(dates, day)
+    sumstr = ", ".join("TOTAL(" + col + ")" for col in cols)
+    where = day + " <= ?"
+    params = (cs.toordinal(dates[-1]),)
+    if first_week > 0:
+        where += " AND " + day + " > ?"
+        params += (cs.toordinal(dates[first_week - 1]),)
+    with instrument.timer("aggregate", db=db._shortname(), table=table):
+        rows = db.conn.execute(
+            "SELECT repo_id, " + week + " AS week, " + sumstr + " FROM " + table
+            + " WHERE " + where + " GROUP BY repo_id, week",
+            params,
+        ).fetchall()
+    for row in rows:
+        if row[0] in repo_index:
+            values[repo_index[row[0]], row[1] - first_week, :] = tuple(row)[2:]
+    return repo_names, values
+
+
+def get_monthly_arrays(db, cols):
+    """
+    Read monthly sums for all repos and cols from the "stats_monthly" rollup
+
+    :param db: StatsBase, connected
+    :param cols: list of str, stats columns
+    :return (repo_names, months, values): list of str, as from
+        `get_repos`, list of datetime.date, the first day of every
+        month from the first to the last with stats, and numpy.ndarray of
+        float64 with shape (len(repo_names), len(months), len(cols))
+    """
+    repos = get_repos(db)
+    repo_names = [r["name"] for r in repos]
+    repo_index = {r["repo_id"]: i for i, r in enumerate(repos)}
+    bounds = db.conn.execute(
+        "SELECT MIN(month) AS first, MAX(month) AS last FROM stats_monthly"
+    ).fetchone()
+    months = []
+    if bounds["first"] is not None:
+        year, month = divmod(bounds["first"], 100)
+        while year * 100 + month <= bounds["last"]:
+            months.append(datetime.date(year, month, 1))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    month_index = {date.year * 100 + date.month: i for i, date in enumerate(months)}
+
+    values = np.zeros((len(repo_names), len(months), len(cols)), dtype=np.float64)
+    colstr = ", ".join(cols)
+    for row in db.conn.execute("SELECT repo_id, month, " + colstr + " FROM stats_monthly"):
+        if row[0] in repo_index:
+            values[repo_index[row[0]], month_index[row[1]], :] = tuple(row)[2:]
+    return repo_names, months, values
+
+
+def estimate_missing_cube(cube, rules=None):
+    """
+    Replace weeks with missing data by estimates, in place
+
+    Each rule replaces all its weeks for all its repos and metrics with one
+    masked assignment.
+
+    :param cube: StatsCube, weekly stats, with float `values`
+    :param rules: list of dict, as from `read_missing_data_rules`, read from
+        the default file if None
+    """
+    if rules is None:
+        rules = read_missing_data_rules()
+    days = np.array([cs.toordinal(date) for date in cube.periods])
+    for rule in rules:
+        repos = [
+            i
+            for i, repo_name in enumerate(cube.repos)
+            if any(fnmatch.fnmatchcase(repo_name, pattern) for pattern in rule["repos"])
+        ]
+        weeks = (days >= cs.toordinal(rule["first"])) & (
+            days <= cs.toordinal(rule["last"])
         )
-        weekly_unique_views = get_weekly_stats(curs, dates, col)
-        curs.close()
-        df.loc[:, repo_name] = weekly_unique_views
+        if not len(repos) or not weeks.any():
+            continue
+        weeks = np.flatnonzero(weeks)
+        if rule["method"] == "reference_mean":
+            reference = [
+                cube.period_index[date]
+                for date in rule["reference_weeks"]
+                if date in cube.period_index
+            ]
+            if not len(reference):
+                continue
+            value = cube.values[np.ix_(repos, sorted(set(reference)))].mean(axis=1)
+            cube.values[np.ix_(repos, weeks)] = value[:, np.newaxis, :]
+        else:
+            metrics = [
+                k for k, col in enumerate(cube.metrics) if col in rule["values"]
+            ]
+            if not len(metrics):
+                continue
+            cube.values[np.ix_(repos, weeks, metrics)] = [
+                rule["values"][cube.metrics[k]] for k in metrics
+            ]
+
 
+def get_weekly_cube(db, dates, cols, estimate_missing=True, rules=None, cache=False):
+    """
+    :param db: StatsBase, connected
+    :param dates: list of datetime.date, one week apart, as from `get_weekly_dates`
+    :param cols: list of str, stats columns
+    :param rules: list of dict, as from `read_missing_data_rules`, used if
+        `estimate_missing`; read from the default file if None
+    :param cache: bool, read the weekly sums from `weekly_cache`, updating
+        it if needed. Without `estimate_missing` the cube's values are the
+        read-only memory-mapped cache file.
+    :return: StatsCube, float64 weekly stats, all from one `get_weekly_arrays`
+        query
+    """
+    if cache:
+        import weekly_cache
+
+        repo_names, values = weekly_cache.get_weekly_arrays(db, dates, cols)
         if estimate_missing:
-            reference_weeks_mean = np.mean(df.loc[reference_weeks, repo_name])
-
-            for index, row in df.iterrows():
-                if index >= replacement_weeks_first and index <= replacement_weeks_last:
-                    df.loc[index, repo_name] = reference_weeks_mean
-
-            reference_weeks_2_mean = np.mean(df.loc[reference_weeks_2, repo_name])
-            if repo_name in replacement_repos_2:
-                for index, row in df.iterrows():
-                    if (
-                        index >= replacement_weeks_2_first
-                        and index <= replacement_weeks_2_last
-                    ):
-                        df.loc[index, repo_name] = reference_weeks_2_mean
-
-            if repo_name in replacement_repos_3:
-                for index, row in df.iterrows():
-                    if (
-                        index >= replacement_weeks_3_first
-                        and index <= replacement_weeks_3_last
-                    ):
-                        df.loc[index, repo_name] = replacement_weeks_3_mean[col]
-
-            if repo_name in replacement_repos_4:
-                for index, row in df.iterrows():
-                    if (
-                        index >= replacement_weeks_4_first
-                        and index <= replacement_weeks_4_last
-                    ):
-                        df.loc[index, repo_name] = replacement_weeks_4_mean[col]
-
-            if repo_name in replacement_repos_5:
-                for index, row in df.iterrows():
-                    if (
-                        index >= replacement_weeks_5_first
-                        and index <= replacement_weeks_5_last
-                    ):
-                        df.loc[index, repo_name] = replacement_weeks_5_mean[col]
-
-    return df
+            values = np.array(values)
+    else:
+        repo_names, values = get_weekly_arrays(db, dates, cols)
+    cube = StatsCube(values, repo_names, dates, cols)
+    if estimate_missing:
+        with instrument.timer("estimate_missing", db=db._shortname()):
+            estimate_missing_cube(cube, rules)
+    return cube
+
+
+def get_all_weekly_stats_frames(db, dates, cols, estimate_missing=True, rules=None):
+    """
+    :param rules: list of dict, as from `read_missing_data_rules`, used if
+        `estimate_missing`; read from the default file if None
+    :return: dict of {col: pandas.DataFrame}, float64 weekly stats with dates
+        index and repo name columns, views of one `get_weekly_cube`
+    """
+    return get_weekly_cube(
+        db, dates, cols, estimate_missing=estimate_missing, rules=rules
+    ).frames()
+
+
+def get_all_weekly_stats(db, dates, col, estimate_missing=True, rules=None):
+    return get_all_weekly_stats_frames(
+        db, dates, [col], estimate_missing=estimate_missing, rules=rules
+    )[col]
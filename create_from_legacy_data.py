@@ -2,10 +2,11 @@
 # before running:
 # wget -O dftfeDevelopers_github_stats.txt https://raw.githubusercontent.com/dftfeDevelopers/clone-scrapper/clone-scrapper/github_stats.txt
 
-import dateutil.parser
+import datetime
+import gzip
 import re
-from code_stats import toordinal, GithubStats, TravisStats
-from github import Github
+import sys
+from code_stats import toordinal, GithubStats
 
 orgs = {
     "prisms-center": {
@@ -25,64 +26,112 @@ orgs = {
     }
 }
 
+# "<repo> Daily Statistics:" starts each repository's section
+header_re = re.compile(r"(.*) Daily Statistics:")
+
+# the first word of a data line starts with the date, either of:
+# type 1:
+# 2016-02-02 19:00:00 -0500	2	2	0	0
+# type 2:
+# 2018-10-27T00	0		0		0		0
+date_re = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})")
+
+
+def open_legacy_file(path):
+    """
+    :param path: str, legacy data file, "-" for stdin, or gzip compressed if
+        it ends with ".gz"
+    :return: file object, to be used as a context manager
+    """
+    if path == "-":
+        # do not close stdin on leaving the "with" block
+        return open(sys.stdin.fileno(), "r", closefd=False)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def parse_legacy(lines):
+    """
+    Parse legacy data lines lazily
+
+    :param lines: iterable of str, i.e. an open file
+    :return: generator of (lineno, repo, date, record), where repo is the name
+        from the last "Daily Statistics:" header, without the org, or None
+        before the first header
+    """
+    repo = None
+    for lineno, line in enumerate(lines, 1):
+        m = header_re.match(line)
+        if m:
+            repo = m.group(1)
+
+        words = line.split()
+        if not len(words):
+            continue
+        m = date_re.match(words[0])
+        if not m:
+            continue
+        try:
+            date = datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            if len(words) == 7:
+                words = [words[0]] + words[3:7]
+            if words[1:5] == ["0"] * 4:
+                continue
+            record = {
+                "views": int(words[1]),
+                "unique_views": int(words[2]),
+                "clones": int(words[3]),
+                "unique_clones": int(words[4]),
+            }
+        except (ValueError, IndexError) as e:
+            raise Exception(
+                "parse legacy data error, line " + str(lineno) + ": "
+                + repr(line.rstrip("\n")) + ": " + str(e)
+            )
+        yield (lineno, repo, date, record)
+
+
 def create_from_legacy(orgname, repos, f):
+    """
+    Import legacy data for one org, streaming `f` into a single transaction
+
+    :param orgname: str, i.e. "prisms-center"
+    :param repos: list of str, repository names to add, i.e. "prisms-center/pbs"
+    :param f: iterable of str, legacy data lines, i.e. from `open_legacy_file`
+    """
     print("Working on:", orgname)
     db = GithubStats()
     db.connect()
-    for repo_name in repos:
-        db.add_repo(repo_name)
+    db.add_repos(repos)
     print(db.list_repo_names())
 
-    repo_name = None
-    repo_id = None
-    for line in f.readlines():
-        m = re.match("(.*) Daily Statistics:", line)
-        if m:
-            repo_name = orgname + "/" + m.group(1)
-            repo_id = db.get_repo_id(repo_name)
-            # print(repo_name, repo_id)
-
-        # type 1:
-        # 2016-02-02 19:00:00 -0500	2	2	0	0
-        # type 2:
-        # 2018-10-27T00	0		0		0		0
-        words = line.split()
-        if not len(words):
-            continue
-        res = None
-        m = re.match("[0-9]{4}-[0-9]{2}-[0-9]{2}", words[0])
-        if m:
-            res = dateutil.parser.parse(words[0])
-        m = re.match("[0-9]{4}-[0-9]{2}-[0-9]{2}T00", words[0])
-        if m:
-            res = dateutil.parser.parse(words[0])
-        if res:
-            try:
-                day = toordinal(res.date())
-                if len(words) == 7:
-                    words = [words[0]] + words[3:7]
-                if words[1:5] == ["0"]*4:
-                    continue
-                record = {
-                    'views': int(words[1]),
-                    'unique_views': int(words[2]),
-                    'clones': int(words[3]),
-                    'unique_clones': int(words[4])
-                }
-                # print(res.date(), repo_id, day, record, words)
-                db._insert_or_update_stats(repo_id, day, record)
-                db.conn.commit()
-            except:
-                print(line)
-                print(words)
-                raise Exception("parse legacy data error")
+    repo_ids = {}
+    skipped = set()
+
+    def rows():
+        for lineno, repo, date, record in parse_legacy(f):
+            if repo not in repo_ids:
+                repo_name = None if repo is None else orgname + "/" + repo
+                repo_ids[repo] = None if repo_name is None else db.get_repo_id(repo_name)
+            repo_id = repo_ids[repo]
+            if repo_id is None:
+                if repo not in skipped:
+                    print("Skipping data, line", lineno, "for unknown repo:", repo)
+                    skipped.add(repo)
+                continue
+            yield (repo_id, toordinal(date), record)
+
+    count = db.upsert_stats(rows())
+    print("Imported", count, "records")
 
     # for repo_name in db.list_repo_names():
     #     print("Repository:", repo_name)
     #     db.print_stats(repo_name)
     db.close()
 
-for orgname in ["dftfeDevelopers"]:
-    org = orgs[orgname]
-    with open(org["file"], 'r') as f:
-        create_from_legacy(orgname, org["repos"], f)
+if __name__ == "__main__":
+    for orgname in ["dftfeDevelopers"]:
+        org = orgs[orgname]
+        with open_legacy_file(org["file"]) as f:
+            create_from_legacy(orgname, org["repos"], f)
@@ -0,0 +1,378 @@
+"""
+Keep stats up to date with a long running process
+
+Rather than updating every repo at once, each repo is requested about once
+per `interval`, at its own time of day given by a hash of its name, so that
+requests are spread evenly over the day. The schedule is kept in each stats
+database's "schedule" table:
+
+    next_due: when the repo is next requested
+    last_attempt, last_success: when it was last requested, and succeeded
+    failures: failed attempts since the last success
+    last_error: why the last attempt failed
+
+Every `tick` seconds the due repos are updated, the most stale first, where
+staleness is the time since the last success relative to the provider's
+`history_days`: GitHub traffic not requested within 14 days is lost. One
+tick updates at most `catch_up` times the repos due per tick, and no more
+than `max_requests_per_hour` allows. A repo that fails is retried with
+exponential backoff, but always well before its history window runs out.
+
+After a tick that changed stats, the plots are rebuilt; charts whose data
+did not change are not rendered again, see `plot.render_charts`.
+"""
+
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import signal
+import threading
+import time
+
+import code_stats as cs
+import instrument
+
+
+def slot_offset(repo_name, interval):
+    """
+    :return: float, seconds into each interval the repo is requested at,
+        from a hash of its name, in [0, interval)
+    """
+    h = int.from_bytes(hashlib.sha1(repo_name.encode()).digest()[:8], "big")
+    return h / 2.0**64 * interval
+
+
+def next_slot(repo_name, after, interval):
+    """
+    :return: float, epoch seconds of the repo's first slot after `after`
+    """
+    offset = slot_offset(repo_name, interval)
+    return (math.floor((after - offset) / interval) + 1) * interval + offset
+
+
+class Scheduler(object):
+    """
+    Update the due repos of one provider, and keep their schedule
+    """
+
+    def __init__(
+        self,
+        db_cls,
+        db_kwargs=None,
+        update_kwargs=None,
+        repos=None,
+        interval=86400.0,
+        tick=300.0,
+        catch_up=2.0,
+        max_requests_per_hour=None,
+        retry=300.0,
+        max_backoff=6 * 3600.0,
+    ):
+        """
+        :param db_cls: StatsBase subclass, i.e. GithubStats
+        :param db_kwargs: dict, passed to `db_cls` when constructed
+        :param update_kwargs: dict, passed to `db_cls.update_repos`
+        :param repos: list of str, repos added to the database if missing,
+            i.e. `update_all.repos`
+        :param interval: float, seconds between updates of each repo
+        :param tick: float, seconds between ticks
+        :param catch_up: float, a tick updates at most this many times the
+            repos due per tick, so missed slots are caught up gradually
+        :param max_requests_per_hour: int, optional, request budget
+        :param retry: float, seconds before the first retry of a failed repo
+        :param max_backoff: float, maximum seconds between retries
+        """
+        self.db_cls = db_cls
+        self.db_kwargs = db_kwargs or {}
+        self.update_kwargs = update_kwargs or {}
+        self.repos = repos or []
+        self.interval = interval
+        self.tick = tick
+        self.catch_up = catch_up
+        self.max_requests_per_hour = max_requests_per_hour
+        self.retry = retry
+        self.max_backoff = max_backoff
+        # time of the next `discover_repos`, every `interval`
+        self.next_discover = None
+
+    def window(self):
+        """:return: float, seconds of history the provider keeps, or the interval"""
+        if self.db_cls.history_days is None:
+            return self.interval
+        return self.db_cls.history_days * 86400.0
+
+    def staleness(self, last_success, now):
+        """
+        :return: float, time since the last success as a fraction of the
+            history window; inf if never updated
+        """
+        if last_success is None:
+            return float("inf")
+        return (now - last_success) / self.window()
+
+    def schedule_new_repos(self, db, now):
+        """
+        Add repos missing from the "schedule" table: due now if they have no
+        stats yet, and otherwise at their next slot
+        """
+        new = db.conn.execute(
+            "SELECT repo_id, name,"
+            " EXISTS (SELECT 1 FROM stats WHERE stats.repo_id = repos.repo_id)"
+            " AS has_stats"
+            " FROM repos WHERE repo_id NOT IN (SELECT repo_id FROM schedule)"
+        ).fetchall()
+        with db.transaction():
+            db.conn.executemany(
+                "INSERT INTO schedule (repo_id, next_due) VALUES (?, ?)",
+                [
+                    (
+                        repo["repo_id"],
+                        next_slot(repo["name"], now, self.interval)
+                        if repo["has_stats"]
+                        else now,
+                    )
+                    for repo in new
+                ],
+            )
+
+    def due(self, db, now):
+        """:return: list of sqlite3.Row, due repos and their schedule, most stale first"""
+        rows = db.conn.execute(
+            "SELECT repos.name, schedule.* FROM schedule JOIN repos USING (repo_id)"
+            " WHERE next_due <= ?",
+            (now,),
+        ).fetchall()
+        return sorted(
+            rows, key=lambda r: (-self.staleness(r["last_success"], now), r["next_due"])
+        )
+
+    def tick_limit(self, db, n_repos):
+        """:return: int, maximum number of repos updated in one tick"""
+        limit = max(1, int(math.ceil(n_repos * self.tick / self.interval * self.catch_up)))
+        if self.max_requests_per_hour is not None and n_repos > 0:
+            per_repo = db.planned_requests() / float(n_repos)
+            if per_repo > 0:
+                budget = self.max_requests_per_hour * self.tick / 3600.0
+                limit = min(limit, max(1, int(budget / per_repo)))
+        return limit
+
+    def retry_delay(self, failures, last_success, now):
+        """
+        :return: float, seconds until a repo that failed `failures` times in
+            a row is retried
+        """
+        delay = min(self.max_backoff, self.retry * 2 ** (failures - 1))
+        delay *= 0.5 + random.random() / 2
+        if last_success is not None and self.db_cls.history_days is not None:
+            # retry at least four times before the history window runs out
+            left = last_success + self.window() - now
+            if left > 0:
+                delay = min(delay, max(self.retry, left / 4))
+        return delay
+
+    def run_tick(self, now=None):
+        """
+        Update the due repos
+
+        :param now: float, optional, epoch seconds, default time.time()
+        :return: dict, "due", "updated" and "failed" repo counts, and
+            "changed", True if stats changed
+        """
+        if now is None:
+            now = time.time()
+        provider = self.db_cls._shortname()
+        db = self.db_cls(**self.db_kwargs)
+        db.connect()
+        try:
+            if len(self.repos):
+                db.add_repos(self.repos)
+            if self.next_discover is None or now >= self.next_discover:
+                try:
+                    db.discover_repos()
+                except Exception as e:
+                    print("error:", provider, "discover:", repr(e))
+                self.next_discover = now + self.interval
+            self.schedule_new_repos(db, now)
+            n_repos = len(db.list_repo_names())
+            due = self.due(db, now)
+            batch = due[: self.tick_limit(db, n_repos)]
+            self.warn_at_risk(db, now)
+            instrument.gauge("daemon_repos_due", len(due), provider=provider)
+            result = {"due": len(due), "updated": 0, "failed": 0, "changed": False}
+            if not len(batch):
+                return result
+
+            names = [repo["name"] for repo in batch]
+            print(
+                datetime.datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+                provider + ": updating", len(names), "of", len(due), "due repos",
+            )
+            version = db.stats_version()
+            try:
+                failed = db.update_repos(names, **self.update_kwargs)
+                error = "update failed"
+            except Exception as e:
+                print("error:", provider, "update:", repr(e))
+                failed = names
+                error = repr(e)
+
+            with db.transaction():
+                for repo in batch:
+                    if repo["name"] in failed:
+                        failures = repo["failures"] + 1
+                        db.conn.execute(
+                            "UPDATE schedule SET last_attempt=?, failures=?,"
+                            " last_error=?, next_due=? WHERE repo_id=?",
+                            (
+                                now,
+                                failures,
+                                error,
+                                now + self.retry_delay(failures, repo["last_success"], now),
+                                repo["repo_id"],
+                            ),
+                        )
+                    else:
+                        db.conn.execute(
+                            "UPDATE schedule SET last_attempt=?, last_success=?,"
+                            " failures=0, last_error=NULL, next_due=? WHERE repo_id=?",
+                            (
+                                now,
+                                now,
+                                next_slot(repo["name"], now + self.interval / 2, self.interval),
+                                repo["repo_id"],
+                            ),
+                        )
+            result["failed"] = len([name for name in names if name in failed])
+            result["updated"] = len(names) - result["failed"]
+            result["changed"] = db.stats_version() != version
+            instrument.count("daemon_repos_updated", result["updated"], provider=provider)
+            instrument.count("daemon_repos_failed", result["failed"], provider=provider)
+            return result
+        finally:
+            db.close()
+
+    def warn_at_risk(self, db, now):
+        """Print how many repos will lose history within two days if not updated"""
+        if self.db_cls.history_days is None:
+            return
+        at_risk = db.conn.execute(
+            "SELECT repos.name FROM schedule JOIN repos USING (repo_id)"
+            " WHERE last_success < ? ORDER BY last_success",
+            (now - self.window() + 2 * 86400.0,),
+        ).fetchall()
+        instrument.gauge("daemon_repos_at_risk", len(at_risk), provider=db._shortname())
+        if len(at_risk):
+            print(
+                "warning:", db._shortname() + ":", len(at_risk),
+                "repos not updated for", self.db_cls.history_days - 2, "days or more:",
+                ", ".join(repo["name"] for repo in at_risk[:5])
+                + (", ..." if len(at_risk) > 5 else ""),
+            )
+
+
+def state_path():
+    return os.path.join(cs.code_stats_prefix(), "daemon_state.json")
+
+
+def read_state():
+    if not os.path.isfile(state_path()):
+        return {}
+    with open(state_path(), "r") as f:
+        return json.load(f)
+
+
+def write_state(state):
+    tmp = state_path() + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, state_path())
+
+
+def rebuild_report(db_classes):
+    """
+    Rebuild the plots if stats changed since they were last built, by this
+    or another process
+
+    :param db_classes: list of StatsBase subclasses
+    :return: bool, True if rebuilt
+    """
+    versions = {}
+    for db_cls in db_classes:
+        if not os.path.isfile(db_cls.db_path()):
+            continue
+        db = db_cls()
+        db.connect(readonly=True)
+        versions[db._shortname()] = db.stats_version()
+        db.close()
+    if not len(versions):
+        return False
+    state = read_state()
+    if state.get("report_versions") == versions:
+        return False
+    with instrument.timer("report"):
+        cs.timed_import("plot").main()
+    # versions read before plotting, so changes made meanwhile rebuild again
+    state["report_versions"] = versions
+    write_state(state)
+    return True
+
+
+def run(
+    schedulers,
+    tick=300.0,
+    report=True,
+    once=False,
+    run_log=None,
+    prometheus=None,
+):
+    """
+    Run ticks until stopped by SIGINT or SIGTERM, appending each tick's
+    metrics to the run log
+
+    :param schedulers: list of Scheduler
+    :param tick: float, seconds between the starts of ticks
+    :param report: bool, rebuild the plots after ticks that changed stats
+    :param once: bool, run one tick and return
+    :param run_log: str, JSON lines run log, default data/run_log.jsonl
+    :param prometheus: str, optional, Prometheus textfile written each tick
+    """
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        print("Stopping after this tick")
+        stop.set()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+
+    while not stop.is_set():
+        start = time.time()
+        instrument.reset()
+        ok = True
+        for scheduler in schedulers:
+            try:
+                scheduler.run_tick(now=start)
+            except Exception as e:
+                print("error:", scheduler.db_cls._shortname(), "tick:", repr(e))
+                ok = False
+        if report:
+            try:
+                rebuild_report([scheduler.db_cls for scheduler in schedulers])
+            except Exception as e:
+                print("error: report:", repr(e))
+                ok = False
+        instrument.gauge("run_success", int(ok), command="daemon")
+        instrument.write_run_log(
+            run_log if run_log is not None else cs.run_log_path(),
+            command="daemon",
+            ok=ok,
+        )
+        if prometheus is not None:
+            instrument.write_prometheus(prometheus)
+        if once:
+            break
+        stop.wait(max(0.0, tick - (time.time() - start)))
@@ -0,0 +1,187 @@
+"""
+Persistent HTTP cache for conditional GET requests (ETag / Last-Modified)
+
+Responses are stored in an sqlite database. Later requests for the same URL
+are sent with If-None-Match / If-Modified-Since, and a 304 Not Modified reply
+is answered from the stored body. GitHub does not count 304 replies against
+the rate limit.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+import requests.structures
+
+import instrument
+from rate_limit import RateLimitedAdapter
+
+# headers describing the stored body that do not apply to a cached copy
+_unstored_headers = ["Content-Encoding", "Content-Length", "Transfer-Encoding"]
+
+
+class HttpCache(object):
+    """
+    sqlite table of GET responses, keyed by URL
+
+    The database is opened on first use, and may be used from multiple threads.
+    """
+
+    def __init__(self, path, max_bytes=100 * 2**20, max_age=30 * 24 * 3600):
+        """
+        :param path: str, sqlite database file
+        :param max_bytes: int, total body size kept by `evict`
+        :param max_age: float, seconds since last use after which `evict` drops an entry
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            if self.conn is not None:
+                return
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, "
+                "etag TEXT, last_modified TEXT, status INT, headers TEXT, "
+                "body BLOB, size INT, fetched_at REAL, used_at REAL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)"
+            )
+            self.conn.commit()
+        self.evict()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def lookup(self, url):
+        """
+        :return: sqlite3.Row, or None if `url` is not cached
+        """
+        self.connect()
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM responses WHERE url=?", (url,)
+            ).fetchone()
+
+    def store(self, url, response):
+        """
+        Store a 200 response, if it has an ETag or Last-Modified header
+
+        :param url: str
+        :param response: requests.Response, with content already read
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+        headers = {
+            key: value
+            for key, value in response.headers.items()
+            if key not in _unstored_headers
+        }
+        now = time.time()
+        self.connect()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (url, etag, last_modified, status, "
+                "headers, body, size, fetched_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    etag,
+                    last_modified,
+                    response.status_code,
+                    json.dumps(headers),
+                    response.content,
+                    len(response.content),
+                    now,
+                    now,
+                ),
+            )
+
+    def touch(self, url):
+        """Mark `url` as used, after a 304 Not Modified"""
+        self.connect()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE responses SET used_at=? WHERE url=?", (time.time(), url)
+            )
+
+    def evict(self):
+        """
+        Delete entries not used within `max_age` seconds, then least recently
+        used entries until the total body size is at most `max_bytes`
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM responses WHERE used_at < ?",
+                (time.time() - self.max_age,),
+            )
+            self.conn.execute(
+                "DELETE FROM responses WHERE url IN ("
+                "SELECT url FROM (SELECT url, SUM(size) OVER "
+                "(ORDER BY used_at DESC, url) AS total FROM responses) "
+                "WHERE total > ?)",
+                (self.max_bytes,),
+            )
+
+
+class CachingAdapter(RateLimitedAdapter):
+    """
+    Transport adapter that makes GET requests conditional using an `HttpCache`
+
+    A 304 reply is returned to the caller as the cached response, with the
+    headers of the 304 reply (i.e. rate limit headers) merged in, and with
+    `from_cache` set to True. Requests, including conditional ones, are
+    paced by the `limiter` keyword argument, if given.
+    """
+
+    def __init__(self, cache, **kwargs):
+        """
+        :param cache: HttpCache, or None to not cache
+        :param kwargs: passed to rate_limit.RateLimitedAdapter
+        """
+        self.cache = cache
+        super(CachingAdapter, self).__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        if self.cache is None or request.method != "GET" or stream:
+            return super(CachingAdapter, self).send(request, stream=stream, **kwargs)
+
+        entry = self.cache.lookup(request.url)
+        if entry is not None:
+            if entry["etag"] is not None:
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = super(CachingAdapter, self).send(request, stream=stream, **kwargs)
+        response.from_cache = False
+
+        if response.status_code == 304 and entry is not None:
+            headers = requests.structures.CaseInsensitiveDict(
+                json.loads(entry["headers"])
+            )
+            headers.update(response.headers)
+            for key in _unstored_headers:
+                headers.pop(key, None)
+            response.headers = headers
+            response.status_code = entry["status"]
+            response._content = entry["body"]
+            response.from_cache = True
+            self.cache.touch(request.url)
+            instrument.count("http_cache_hits")
+        elif response.status_code == 200:
+            self.cache.store(request.url, response)
+            instrument.count("http_cache_misses")
+        return response
@@ -0,0 +1,268 @@
+"""
+Lightweight run metrics: counters, gauges and timers, shared by all threads
+
+Code under measurement calls the module functions, i.e.
+
+    with instrument.timer("repo", provider="github", repo=repo_name):
+        ...
+    instrument.count("rows_written", len(rows), db="github")
+
+which add to the module's `Metrics`. At the end of a run, `write_run_log`
+appends them to a JSON lines run log, and `write_prometheus` writes them in
+the Prometheus text format, i.e. for the node_exporter textfile collector.
+Labels in `run_log_labels`, like "repo", are only kept in the run log: in
+Prometheus they would make one series per repo, so they are summed over.
+`profile` optionally captures cProfile stats and tracemalloc allocations.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+class Metrics(object):
+    """
+    Counters, gauges and timers, each identified by a name and labels
+
+    Timers keep the count, total and maximum of their observations.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+            self.info = {}
+
+    def count(self, name, n=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in a "with" block, also if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """:return: dict, JSON serializable copy of all metrics"""
+
+        def entry(key, **values):
+            d = {"name": key[0], "labels": dict(key[1])}
+            d.update(values)
+            return d
+
+        with self.lock:
+            return {
+                "start": datetime.datetime.fromtimestamp(self.start).isoformat(),
+                "seconds": time.time() - self.start,
+                "info": dict(self.info),
+                "counters": [
+                    entry(key, value=value) for key, value in sorted(self.counters.items())
+                ],
+                "gauges": [
+                    entry(key, value=value) for key, value in sorted(self.gauges.items())
+                ],
+                "timers": [
+                    entry(key, count=t[0], seconds=t[1], max_seconds=t[2])
+                    for key, t in sorted(self.timers.items())
+                ],
+            }
+
+
+# metrics of the current run
+metrics = Metrics()
+
+
+def reset():
+    metrics.reset()
+
+
+def count(name, n=1, **labels):
+    metrics.count(name, n, **labels)
+
+
+def gauge(name, value, **labels):
+    metrics.gauge(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    metrics.observe(name, seconds, **labels)
+
+
+def timer(name, **labels):
+    return metrics.timer(name, **labels)
+
+
+def write_run_log(path, **info):
+    """
+    Append the current metrics, and `info`, as one JSON line
+
+    :param path: str, run log file
+    :param info: JSON serializable values, i.e. command="update", ok=True
+    """
+    record = metrics.snapshot()
+    record["info"].update(info)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+# labels with too many values for Prometheus series, see module docstring
+run_log_labels = ("repo",)
+
+
+def _without_run_log_labels(items, combine):
+    """
+    :param items: list of ((name, labels), value)
+    :param combine: function of two values, for values whose keys become
+        equal once `run_log_labels` are removed
+    :return: list of ((name, labels), value), sorted
+    """
+    combined = {}
+    for (name, labels), value in items:
+        key = (name, tuple((k, v) for k, v in labels if k not in run_log_labels))
+        combined[key] = combine(combined[key], value) if key in combined else value
+    return sorted(combined.items())
+
+
+def _prometheus_labels(labels):
+    if not len(labels):
+        return ""
+    return (
+        "{"
+        + ",".join(
+            k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+            for k, v in labels
+        )
+        + "}"
+    )
+
+
+def prometheus_text(prefix="code_stats_"):
+    """:return: str, the current metrics in the Prometheus text format"""
+    with metrics.lock:
+        counters = list(metrics.counters.items())
+        gauges = list(metrics.gauges.items())
+        timers = list(metrics.timers.items())
+        start = metrics.start
+    counters = _without_run_log_labels(counters, lambda a, b: a + b)
+    gauges = _without_run_log_labels(gauges, max)
+    timers = _without_run_log_labels(
+        timers, lambda a, b: (a[0] + b[0], a[1] + b[1], max(a[2], b[2]))
+    )
+
+    lines = []
+    typed = set()
+
+    def sample(name, kind, labels, value):
+        if name not in typed:
+            lines.append("# TYPE " + name + " " + kind)
+            typed.add(name)
+        lines.append(name + _prometheus_labels(labels) + " " + repr(float(value)))
+
+    for (name, labels), value in counters:
+        sample(prefix + name + "_total", "counter", labels, value)
+    for (name, labels), value in gauges:
+        sample(prefix + name, "gauge", labels, value)
+    for (name, labels), (n, total, max_seconds) in timers:
+        sample(prefix + name + "_seconds_count", "counter", labels, n)
+        sample(prefix + name + "_seconds_sum", "counter", labels, total)
+        sample(prefix + name + "_seconds_max", "gauge", labels, max_seconds)
+    sample(prefix + "run_start_timestamp_seconds", "gauge", (), start)
+    sample(prefix + "run_seconds", "gauge", (), time.time() - start)
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, prefix="code_stats_"):
+    """
+    Write the current metrics to a Prometheus textfile, replacing it atomically
+    so the textfile collector never reads a partial file
+    """
+    tmp = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text(prefix=prefix))
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def profile(cprofile_path=None, tracemalloc_top=0):
+    """
+    Optionally profile a "with" block
+
+    :param cprofile_path: str, optional, write cProfile stats here, for
+        `python -m pstats` or snakeviz
+    :param tracemalloc_top: int, if > 0, trace allocations, print the lines
+        allocating the most memory, and record them and the peak in
+        `metrics.info["tracemalloc"]`
+    """
+    profiler = None
+    if cprofile_path is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+    if tracemalloc_top > 0:
+        import tracemalloc
+
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+            print("Wrote cProfile stats:", cprofile_path)
+        if tracemalloc_top > 0:
+            current, peak = tracemalloc.get_traced_memory()
+            stats = tracemalloc.take_snapshot().statistics("lineno")[:tracemalloc_top]
+            tracemalloc.stop()
+            print("tracemalloc peak:", peak, "bytes, top allocations:")
+            for stat in stats:
+                print("   ", stat)
+            gauge("tracemalloc_peak_bytes", peak)
+            with metrics.lock:
+                metrics.info["tracemalloc"] = {
+                    "peak_bytes": peak,
+                    "top": [
+                        {
+                            "location": str(stat.traceback[0]),
+                            "bytes": stat.size,
+                            "count": stat.count,
+                        }
+                        for stat in stats
+                    ],
+                }
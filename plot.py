@@ -1,16 +1,21 @@
-import copy
+import concurrent.futures
+import hashlib
+import json
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import pandas
-from code_stats import GithubStats, TravisStats
+import instrument
+from code_stats import AnacondaStats, GithubStats, TravisStats
 from code_stats_data import (
     area_plot_fmt,
-    get_all_weekly_stats,
+    get_weekly_cube,
     get_weekly_dates,
     get_weekly_stats,
     legend_values,
 )
+from stats_cube import StatsCube
 
 import pandas.plotting
 
@@ -28,13 +33,13 @@ def area_plot(df, title, fontsize=None, saveas=None):
     for val in area_plot_fmt:
         repo_name = val[0]
         facecolor = val[2]
-        cumsum_top = cumsum_bottom + np.array(df.loc[:, repo_name], dtype=np.float64)
+        cumsum_top = cumsum_bottom + df[repo_name].to_numpy(dtype=np.float64)
 
         h1 = ax.fill_between(date, cumsum_bottom, cumsum_top, facecolor=facecolor)
         h2 = ax.plot(date, cumsum_top, color="black", linewidth=1)
-        h3 = ax.fill(np.NaN, np.NaN, facecolor=facecolor, linewidth=0.0)
+        h3 = ax.fill(np.nan, np.nan, facecolor=facecolor, linewidth=0.0)
         legend_handles.append((h3[0],))
-        cumsum_bottom = copy.deepcopy(cumsum_top)
+        cumsum_bottom = cumsum_top
     ax.plot(date, np.zeros(df.shape[0]), color="black", linewidth=1, label=None)
     # ax.set_title(title, fontsize=fontsize)
     ax.set_ylabel(title, fontsize=fontsize)
@@ -46,12 +51,141 @@ def area_plot(df, title, fontsize=None, saveas=None):
     return ax
 
 
-def make_plots(db, dates, colname, title, fontsize=None, estimate_missing=True):
-    df = get_all_weekly_stats(db, dates, colname, estimate_missing=estimate_missing)
-    df.loc[:, "prisms-center/prisms_jobs"] += df.loc[:, "prisms-center/pbs"]
-    df = df.drop(axis="columns", labels="prisms-center/pbs")
-    area_plot(df, title, fontsize=fontsize, saveas="images/" + colname + ".png")
-    dfc = df.cumsum()
+# manifest of the chart hash each image in "images" was rendered from
+manifest_path = os.path.join("images", "manifest.json")
+
+
+def chart_hash(df, title, fontsize):
+    """
+    :return: str, hash of everything `area_plot` output depends on: the data,
+        `area_plot_fmt`, `legend_values`, title and fontsize
+    """
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(df.to_numpy(dtype=np.float64)).tobytes())
+    h.update(
+        json.dumps(
+            [
+                [str(x) for x in df.index],
+                [str(x) for x in df.columns],
+                area_plot_fmt,
+                legend_values,
+                title,
+                fontsize,
+                matplotlib.__version__,
+            ]
+        ).encode()
+    )
+    return h.hexdigest()
+
+
+def render_chart(chart):
+    """
+    :param chart: tuple, (df, title, fontsize, saveas), `area_plot` arguments
+    """
+    df, title, fontsize, saveas = chart
+    # as in `main`, also for worker processes that did not inherit it
+    matplotlib.use("Agg")
+    ax = area_plot(df, title, fontsize=fontsize, saveas=saveas)
+    plt.close(ax.figure)
+    return saveas
+
+
+def render_charts(charts, max_workers=None):
+    """
+    Render charts in a process pool, skipping charts whose image exists and
+    was rendered from the same `chart_hash`, as recorded in `manifest_path`
+
+    :param charts: list of (df, title, fontsize, saveas) tuples
+    :param max_workers: int, number of processes, defaults to the number of CPUs
+    """
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    todo = []
+    for chart in charts:
+        df, title, fontsize, saveas = chart
+        h = chart_hash(df, title, fontsize)
+        if os.path.isfile(saveas) and manifest.get(saveas) == h:
+            continue
+        todo.append((chart, h))
+    print("Rendering", len(todo), "of", len(charts), "charts")
+    instrument.count("charts_rendered", len(todo))
+    instrument.count("charts_skipped", len(charts) - len(todo))
+
+    if len(todo):
+        with instrument.timer("render_charts"), \
+                concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(render_chart, chart): h for chart, h in todo
+            }
+            for future in concurrent.futures.as_completed(futures):
+                manifest[future.result()] = futures[future]
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+# repos plotted as one, {name: repos summed into it}
+merged_repos = {
+    "prisms-center/prisms_jobs": ["prisms-center/prisms_jobs", "prisms-center/pbs"]
+}
+
+
+# conda packages plotted with each repo, {repo name: "channel/package" list}
+conda_packages = {
+    "prisms-center/CASMcode": [
+        "prisms-center/casm",
+        "prisms-center/casm-cpp",
+        "prisms-center/casm-python",
+    ],
+    "prisms-center/prisms_jobs": ["prisms-center/prisms-jobs"],
+}
+
+
+def get_conda_cube(dates):
+    """
+    :param dates: list of datetime.date, the weeks plotted
+    :return: StatsCube, weekly "downloads" of the packages in
+        `conda_packages`, summed into the repos of `area_plot_fmt`, or None
+        if there are no anaconda.org stats
+    """
+    db = AnacondaStats()
+    if not os.path.isfile(db._db()):
+        return None
+    db.connect(readonly=True)
+    packages = get_weekly_cube(
+        db, dates, ["downloads"], estimate_missing=False, cache=True
+    ).merge(conda_packages)
+    db.close()
+
+    cube = StatsCube.zeros([val[0] for val in area_plot_fmt], dates, ["downloads"])
+    for i, repo_name in enumerate(cube.repos):
+        if repo_name in packages.repo_index:
+            cube.values[i] = packages.values[packages.repo_index[repo_name]]
+    return cube
+
+
+def print_cumulative(header, dfc):
+    print(header)
+    print("~" * len(header))
+    for col in dfc.columns:
+        print(f"{col}: ", dfc[col].iloc[-1])
+    print("--> Sum:", sum(dfc.iloc[-1, :]))
+    print()
+
+
+def make_plots(cube, colname, title, fontsize=None):
+    """
+    :param cube: StatsCube, weekly stats, as from `get_weekly_cube`, with
+        `merged_repos` merged
+    :return: list of (df, title, fontsize, saveas), for `render_charts`
+    """
+    cube = cube.select(metrics=[colname])
+    df = cube.frame(colname)
+    dfc = cube.cumsum().frame(colname)
+    charts = [(df, title, fontsize, "images/" + colname + ".png")]
 
     # print(title, colname)
     # for col in dfc.columns:
@@ -61,62 +195,47 @@ def make_plots(db, dates, colname, title, fontsize=None, estimate_missing=True):
     #         print(dfc.index[i], df[col][i], sum(df[col][:i]))
     #     print()
 
-    header = f"Cumulative {title} {dfc.index[-1]}"
-    print(header)
-    print("~" * len(header))
-    for col in dfc.columns:
-        print(f"{col}: ", dfc[col].iloc[-1])
-    print("--> Sum:", sum(dfc.iloc[-1, :]))
-    print()
+    print_cumulative(f"Cumulative {title} {dfc.index[-1]}", dfc)
 
-    area_plot(
-        df.cumsum(),
-        "Cumulative " + title,
-        fontsize=fontsize,
-        saveas="images/" + colname + "_cumulative.png",
+    charts.append(
+        (dfc, "Cumulative " + title, fontsize, "images/" + colname + "_cumulative.png")
     )
+    return charts
 
 
-def make_plots_excluding_travis_builds(
-    db, dates, colname, title, fontsize=None, estimate_missing=True
-):
-    df = get_all_weekly_stats(db, dates, colname, estimate_missing=estimate_missing)
-    df.loc[:, "prisms-center/prisms_jobs"] += df.loc[:, "prisms-center/pbs"]
-    df = df.drop(axis="columns", labels="prisms-center/pbs")
-
-    travis_db = TravisStats()
-    travis_db.connect()
-    travis_df = get_all_weekly_stats(travis_db, dates, "build_count")
-    travis_db.close()
+def make_plots_excluding_travis_builds(cube, travis_cube, colname, title, fontsize=None):
+    """
+    :param cube: StatsCube, weekly GitHub stats, as from `get_weekly_cube`,
+        with `merged_repos` merged
+    :param travis_cube: StatsCube, weekly Travis "build_count", for the same weeks
+    :return: list of (df, title, fontsize, saveas), for `render_charts`
+    """
+    cube = cube.select(metrics=[colname]).copy()
 
     # if a >= b: -> max(a-b,0)
-    for repo_name in travis_df.columns:
-        if repo_name in df.columns:
-            df.loc[:, repo_name] = df.loc[:, repo_name] - travis_df.loc[:, repo_name]
-            df.loc[df.loc[:, repo_name] < 0, repo_name] = 0
-
-    area_plot(
-        df,
-        title,
-        saveas="images/" + colname + "_exclude_travis_builds.png",
-        fontsize=fontsize,
-    )
+    repos = [repo_name for repo_name in travis_cube.repos if repo_name in cube.repo_index]
+    if len(repos):
+        i = [cube.repo_index[repo_name] for repo_name in repos]
+        j = [travis_cube.repo_index[repo_name] for repo_name in repos]
+        k = travis_cube.metric_index["build_count"]
+        cube.values[i, :, 0] = np.maximum(
+            cube.values[i, :, 0] - travis_cube.values[j, :, k], 0
+        )
 
-    dfc = df.cumsum()
-    area_plot(
-        dfc,
-        "Cumulative " + title,
-        fontsize=fontsize,
-        saveas="images/" + colname + "_cumulative_exclude_travis_builds.png",
-    )
+    df = cube.frame(colname)
+    dfc = cube.cumsum().frame(colname)
+    charts = [
+        (df, title, fontsize, "images/" + colname + "_exclude_travis_builds.png"),
+        (
+            dfc,
+            "Cumulative " + title,
+            fontsize,
+            "images/" + colname + "_cumulative_exclude_travis_builds.png",
+        ),
+    ]
 
     header = f"Cumulative {title} (Excluding travis builds) {dfc.index[-1]}"
-    print(header)
-    print("~" * len(header))
-    for col in dfc.columns:
-        print(f"{col}: ", dfc[col].iloc[-1])
-    print("--> Sum:", sum(dfc.iloc[-1, :]))
-    print()
+    print_cumulative(header, dfc)
     with open('stats.html', 'w') as f:
         f.write('<div class="software-area">\n')
         f.write('    <img src="assets/code_stats/unique_clones_cumulative_exclude_travis_builds.png">\n')
@@ -129,6 +248,7 @@ def make_plots_excluding_travis_builds(
         total_count = int(sum(dfc.iloc[-1, :]))
         f.write(f"<span>Total: {total_count}</span>\n")
         f.write('</div>\n')
+    return charts
 
 def print_data_by_week(db, repo_name, col):
     dates = get_weekly_dates(db)
@@ -146,28 +266,74 @@ def print_data_by_week(db, repo_name, col):
         print(dates[i], df[repo_name][i], sum(df[repo_name][:i]))
 
 
-db = GithubStats()
-db.connect()
-dates = get_weekly_dates(db)
+def main():
+    # render without a display; set here rather than at import, so importing
+    # this module leaves the backend of the importer alone
+    matplotlib.use("Agg")
 
-if not os.path.exists("images"):
-    os.mkdir("images")
+    # read-only connections from the shared reader pool, so plots can be
+    # made while an update is writing, and the daemon's report after each
+    # tick reuses them; providers without a database yet are skipped
+    db = GithubStats()
+    if not os.path.isfile(db._db()):
+        print("No GitHub stats to plot:", db._db(), "does not exist")
+        return
+    db.connect(readonly=True)
+    dates = get_weekly_dates(db)
 
-fontsize = 14
+    if not os.path.exists("images"):
+        os.mkdir("images")
 
-# prisms-center/CASMcode
-# prisms-center/phaseField
-# dftfeDevelopers/dftfe
-# print_data_by_week(db, "dftfeDevelopers/dftfe", 'unique_clones')
-# print_data_by_week(db, "prisms-center/Fatigue", 'views')
-# exit()
+    fontsize = 14
+
+    # prisms-center/CASMcode
+    # prisms-center/phaseField
+    # dftfeDevelopers/dftfe
+    # print_data_by_week(db, "dftfeDevelopers/dftfe", 'unique_clones')
+    # print_data_by_week(db, "prisms-center/Fatigue", 'views')
+    # exit()
+
+    # all metrics for all repos, from one query
+    cube = get_weekly_cube(
+        db, dates, ["views", "unique_views", "clones", "unique_clones"], cache=True
+    ).merge(merged_repos)
+
+    travis_cube = None
+    travis_db = TravisStats()
+    if os.path.isfile(travis_db._db()):
+        travis_db.connect(readonly=True)
+        travis_cube = get_weekly_cube(travis_db, dates, ["build_count"], cache=True)
+        travis_db.close()
+
+    charts = []
+    charts += make_plots(cube, "views", "Weekly Views", fontsize=fontsize)
+    charts += make_plots(
+        cube, "unique_views", "Weekly Unique Views", fontsize=fontsize
+    )
+    charts += make_plots(cube, "clones", "Weekly Clones", fontsize=fontsize)
+    charts += make_plots(
+        cube,
+        "unique_clones",
+        "Weekly Unique Clones",
+        fontsize=fontsize,
+    )
+    if travis_cube is not None:
+        charts += make_plots_excluding_travis_builds(
+            cube,
+            travis_cube,
+            "unique_clones",
+            "Weekly Unique Clones",
+            fontsize=fontsize,
+        )
+    conda_cube = get_conda_cube(dates)
+    if conda_cube is not None:
+        charts += make_plots(
+            conda_cube, "downloads", "Weekly Conda Downloads", fontsize=fontsize
+        )
+    render_charts(charts)
+
+    db.close()
 
-make_plots(db, dates, "views", "Weekly Views", fontsize=fontsize)
-make_plots(db, dates, "unique_views", "Weekly Unique Views", fontsize=fontsize)
-make_plots(db, dates, "clones", "Weekly Clones", fontsize=fontsize)
-make_plots(db, dates, "unique_clones", "Weekly Unique Clones", fontsize=fontsize)
-make_plots_excluding_travis_builds(
-    db, dates, "unique_clones", "Weekly Unique Clones", fontsize=fontsize
-)
 
-db.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Pace HTTP requests to stay within an API rate limit, and back off when limited
+
+Server errors (5xx) and connection errors are retried separately, by the
+transport, see `server_error_retry`.
+"""
+
+import random
+import threading
+import time
+import urllib.parse
+
+import requests.adapters
+from urllib3.util.retry import Retry
+
+import instrument
+
+# statuses retried by `server_error_retry`
+retry_statuses = (500, 502, 503, 504)
+
+
+def server_error_retry(total=3, backoff_factor=1.0):
+    """
+    :param total: int, times a request is retried
+    :param backoff_factor: float, retries wait backoff_factor * 2 ** (n - 1)
+        seconds before the n-th retry
+    :return: urllib3 Retry, for connection errors and `retry_statuses`
+        responses to any method, since the GraphQL POSTs only read. Rate
+        limited responses are left to `RateLimitedAdapter`, so Retry-After
+        is not respected here. Once retries are used up, the last response
+        is returned rather than raised.
+    """
+    return Retry(
+        total=total,
+        backoff_factor=backoff_factor,
+        status_forcelist=retry_statuses,
+        allowed_methods=None,
+        raise_on_status=False,
+        respect_retry_after_header=False,
+    )
+
+
+class RateLimiter(object):
+    """
+    Request budget for one API, shared by all threads making requests to it
+
+    The budget is read from X-RateLimit-Limit / X-RateLimit-Remaining /
+    X-RateLimit-Reset response headers, or set with `seed`. While plenty of
+    budget remains requests are not delayed. Once fewer than `pace_below` of
+    the limit remain, the rest are spread evenly until the reset time, and
+    if only `reserve` remain, requests wait for the reset.
+    """
+
+    def __init__(
+        self,
+        name,
+        resource="core",
+        reserve=0,
+        pace_below=0.2,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=900.0,
+    ):
+        """
+        :param name: str, i.e. "github", used in messages
+        :param resource: str, X-RateLimit-Resource this budget is for;
+            headers for other resources are ignored
+        :param reserve: int, requests left unused for other clients
+        :param pace_below: float, fraction of the limit below which requests
+            are spread evenly until the reset time
+        :param max_retries: int, times a rate limited request is retried
+        :param backoff: float, initial backoff, in seconds, when a rate limited
+            response does not say how long to wait
+        :param max_backoff: float, maximum backoff, in seconds
+        """
+        self.name = name
+        self.resource = resource
+        self.reserve = reserve
+        self.pace_below = pace_below
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.next_time = 0.0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def seed(self, limit, remaining, reset):
+        """
+        :param limit: int, requests per window
+        :param remaining: int, requests remaining in this window
+        :param reset: float, epoch seconds when the window resets
+        """
+        with self.lock:
+            self.limit = limit
+            self.remaining = remaining
+            self.reset = reset
+
+    def _delay(self, now):
+        """Time between requests for the current budget, or None to wait for reset"""
+        if self.remaining is None or self.reset is None or self.reset <= now:
+            return 0.0
+        available = self.remaining - self.reserve
+        if available <= 0:
+            return None
+        if self.limit is not None and self.remaining >= self.pace_below * self.limit:
+            return 0.0
+        return (self.reset - now) / available
+
+    def acquire(self):
+        """Block until a request may be sent, and charge it to the budget"""
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time, self.blocked_until)
+            delay = self._delay(start)
+            if delay is None:
+                start = max(start, self.reset + 1.0)
+                # the window will have reset, but the new budget is unknown
+                self.remaining = None
+                delay = 0.0
+            self.next_time = start + delay
+            if self.remaining is not None:
+                self.remaining -= 1
+        if start > now:
+            time.sleep(start - now)
+
+    def update(self, response):
+        """Read the budget from rate limit response headers, if present"""
+        headers = response.headers
+        if headers.get("X-RateLimit-Resource", self.resource) != self.resource:
+            return
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        with self.lock:
+            self.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Reset" in headers:
+                self.reset = float(headers["X-RateLimit-Reset"])
+        instrument.gauge("rate_limit_remaining", self.remaining, api=self.name)
+        if self.limit is not None:
+            instrument.gauge("rate_limit_limit", self.limit, api=self.name)
+
+    def is_rate_limited(self, response):
+        if response.status_code == 429:
+            return True
+        if response.status_code != 403:
+            return False
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            return True
+        if "Retry-After" in response.headers:
+            return True
+        # GitHub secondary rate limits
+        return b"rate limit" in response.content.lower()
+
+    def retry_delay(self, response, attempt):
+        """
+        :return: float, seconds to wait before retrying a rate limited response
+        """
+        if "Retry-After" in response.headers:
+            return float(response.headers["Retry-After"])
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            if "X-RateLimit-Reset" in response.headers:
+                return max(
+                    float(response.headers["X-RateLimit-Reset"]) - time.time(), 0.0
+                ) + 1.0
+        delay = min(self.max_backoff, self.backoff * 2**attempt)
+        return delay + random.uniform(0, delay)
+
+    def block(self, seconds):
+        """Hold all requests for `seconds`"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+    def wait_time(self, n_requests):
+        """
+        :param n_requests: int, number of requests planned
+        :return: float, estimated seconds before `n_requests` fit in the
+            budget, 0.0 if they do now, or None if the budget is unknown
+        """
+        with self.lock:
+            if self.remaining is None or self.reset is None:
+                return None
+            now = time.time()
+            if n_requests <= self.remaining - self.reserve:
+                return 0.0
+            if self.limit is None or self.limit <= self.reserve:
+                return None
+            n_left = n_requests - max(self.remaining - self.reserve, 0)
+            n_windows = -(-n_left // (self.limit - self.reserve))
+            # assume an hour window, as for GitHub and Travis
+            return max(self.reset - now, 0.0) + (n_windows - 1) * 3600.0
+
+    def report(self, n_requests):
+        """Print the planned requests against the current budget"""
+        wait = self.wait_time(n_requests)
+        msg = self.name + ": " + str(n_requests) + " requests planned"
+        if wait is None:
+            print(msg + ", rate limit budget unknown")
+        else:
+            print(
+                msg + ", " + str(self.remaining) + " of " + str(self.limit)
+                + " remaining, estimated wait " + str(int(wait)) + "s"
+            )
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter that sends every request through a `RateLimiter`, and
+    retries rate limited (429, or 403 rate limit) responses after a backoff,
+    and server and connection errors as by `server_error_retry`
+    """
+
+    def __init__(self, limiter=None, **kwargs):
+        """
+        :param limiter: RateLimiter, optional
+        :param kwargs: passed to requests.adapters.HTTPAdapter; "max_retries"
+            defaults to `server_error_retry()`
+        """
+        self.limiter = limiter
+        kwargs.setdefault("max_retries", server_error_retry())
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+
+    def _send(self, request, **kwargs):
+        """Send one request, recording its time, status and size in `instrument`"""
+        if self.limiter is not None:
+            api = self.limiter.name
+        else:
+            api = urllib.parse.urlsplit(request.url).hostname
+        start = time.perf_counter()
+        response = super(RateLimitedAdapter, self).send(request, **kwargs)
+        instrument.observe("http_request", time.perf_counter() - start, api=api)
+        instrument.count(
+            "http_requests", api=api, method=request.method,
+            status=response.status_code,
+        )
+        if kwargs.get("stream"):
+            size = int(response.headers.get("Content-Length", 0))
+        else:
+            size = len(response.content)
+        instrument.count("http_bytes", size, api=api)
+        return response
+
+    def send(self, request, **kwargs):
+        if self.limiter is None:
+            return self._send(request, **kwargs)
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            response = self._send(request, **kwargs)
+            self.limiter.update(response)
+            if attempt >= self.limiter.max_retries:
+                return response
+            if not self.limiter.is_rate_limited(response):
+                return response
+            delay = self.limiter.retry_delay(response, attempt)
+            print(
+                self.limiter.name + ": rate limited, retrying in",
+                round(delay, 1), "s:", request.url,
+            )
+            instrument.count("http_rate_limited", api=self.limiter.name)
+            self.limiter.block(delay)
+            response.close()
+            attempt += 1
@@ -0,0 +1,223 @@
+"""
+Collect stats in shards, and merge shard databases
+
+A sharded update only requests the repos assigned to one of N shards, and
+writes them to its own shard database, i.e. "data/github_stats.shard-0-of-4.db",
+so several processes or machines can share the requests of many repos.
+Repos are assigned by a consistent hash of their name, or explicitly by a
+shard file, a JSON object of {repo_name: shard index}.
+
+`merge_shard` then combines a shard database into the canonical database:
+
+    code_stats merge data/github_stats.shard-*.db --provider github
+
+Repos are matched by name, so shard and canonical repo_ids may differ. A stats
+value in both databases is resolved by the column's merge rule:
+
+    "max": the larger value is kept; the result does not depend on merge order
+    "latest": the value of the database merged last is kept
+
+NULL values never replace values. The running totals of "snapshot_totals",
+i.e. conda package downloads, keep the larger.
+"""
+
+import hashlib
+import json
+import os
+
+# merge rules, see module docstring
+merge_rules = ["max", "latest"]
+
+
+def jump_hash(key, n_buckets):
+    """
+    Jump consistent hash (Lamping and Veach, 2014): when n_buckets grows by
+    one, only 1/n_buckets of the keys move, all to the new bucket
+
+    :param key: int, 64-bit
+    :param n_buckets: int, > 0
+    :return: int, bucket in range(n_buckets)
+    """
+    b = -1
+    j = 0
+    while j < n_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_of(repo_name, n_shards, assignments=None):
+    """
+    :param repo_name: str, i.e. "prisms-center/CASMcode"
+    :param n_shards: int, number of shards
+    :param assignments: dict of {repo_name: int}, optional, as from
+        `read_shard_file`, overrides the hash
+    :return: int, shard index in range(n_shards)
+    """
+    if assignments is not None and repo_name in assignments:
+        return assignments[repo_name]
+    key = int.from_bytes(hashlib.sha1(repo_name.encode()).digest()[:8], "big")
+    return jump_hash(key, n_shards)
+
+
+def parse_shard(value):
+    """
+    :param value: str, "I/N", shard index I of N shards, 0 <= I < N
+    :return (index, n_shards): tuple of int
+    """
+    try:
+        index, n_shards = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise Exception("Shard must be 'I/N', i.e. '0/4', not: '" + value + "'")
+    if not 0 <= index < n_shards:
+        raise Exception("Shard index must be in 0 to N-1: '" + value + "'")
+    return (index, n_shards)
+
+
+def read_shard_file(path, n_shards):
+    """
+    :param path: str, JSON file of {repo_name: shard index}
+    :param n_shards: int, number of shards
+    :return: dict of {repo_name: int}
+    """
+    with open(path, "r") as f:
+        assignments = json.load(f)
+    for repo_name, index in assignments.items():
+        if not isinstance(index, int) or not 0 <= index < n_shards:
+            raise Exception(
+                "Shard file " + path + ": '" + repo_name + "' shard "
+                + str(index) + " is not in 0 to " + str(n_shards - 1)
+            )
+    return assignments
+
+
+def select_shard(repo_names, shard, assignments=None):
+    """
+    :param repo_names: list of str
+    :param shard: (index, n_shards)
+    :param assignments: dict of {repo_name: int}, optional
+    :return: list of str, the repos of `shard`, in the order given
+    """
+    index, n_shards = shard
+    return [
+        repo_name
+        for repo_name in repo_names
+        if shard_of(repo_name, n_shards, assignments) == index
+    ]
+
+
+def merge_value_sql(col, rule):
+    """
+    :return: str, SQL for the merged value of `col` in an ON CONFLICT DO
+        UPDATE, from the existing value and the "excluded" incoming value
+    """
+    new = "excluded." + col
+    if rule == "latest":
+        return "COALESCE(" + new + ", " + col + ")"
+    if rule == "max":
+        return (
+            "CASE WHEN " + new + " IS NULL THEN " + col
+            + " WHEN " + col + " IS NULL OR " + new + " > " + col + " THEN " + new
+            + " ELSE " + col + " END"
+        )
+    raise Exception(
+        "Unknown merge rule '" + str(rule) + "', expected one of: " + str(merge_rules)
+    )
+
+
+def _columns(conn, schema, table):
+    return [
+        r[1] for r in conn.execute("PRAGMA " + schema + ".table_info('" + table + "')")
+    ]
+
+
+def merge_shard(db, path, rules=None):
+    """
+    Insert or update the repos, stats and snapshot totals of a shard database
+    into `db`, in one transaction, with set-based statements over the
+    attached shard
+
+    :param db: StatsBase, connected, writable
+    :param path: str, shard database file; it is only read
+    :param rules: dict of {column: rule}, optional, overriding
+        `db.merge_rule`
+    :return: dict of {"repos": int, "stats": int}, the shard's row counts
+    """
+    if not os.path.isfile(path):
+        raise Exception("Cannot merge " + path + ": does not exist")
+    if os.path.abspath(path) == os.path.abspath(db._db()):
+        raise Exception("Cannot merge " + path + " into itself")
+    rules = rules or {}
+
+    def rule(col):
+        return rules.get(col, db.merge_rule(col))
+
+    # ATTACH is not allowed in a transaction
+    db.conn.commit()
+    db.conn.execute("ATTACH DATABASE ? AS shard", (path,))
+    try:
+        shard_repos_cols = _columns(db.conn, "shard", "repos")
+        shard_stats_cols = _columns(db.conn, "shard", "stats")
+        if "name" not in shard_repos_cols or "day" not in shard_stats_cols:
+            raise Exception("Cannot merge " + path + ": not a stats database")
+        repos_cols = [
+            col for col in _columns(db.conn, "main", "repos")
+            if col in shard_repos_cols and col not in ("repo_id", "name")
+        ]
+        cols = [col for col in db.metric_cols() if col in shard_stats_cols]
+
+        with db.transaction():
+            counts = {
+                "repos": db.conn.execute("SELECT COUNT(*) FROM shard.repos").fetchone()[0],
+                "stats": db.conn.execute("SELECT COUNT(*) FROM shard.stats").fetchone()[0],
+            }
+            # "WHERE true" resolves the parsing ambiguity of INSERT ... SELECT
+            # ... ON CONFLICT
+            db.conn.execute(
+                "INSERT INTO main.repos (name" + "".join(", " + col for col in repos_cols)
+                + ") SELECT name" + "".join(", " + col for col in repos_cols)
+                + " FROM shard.repos WHERE true ON CONFLICT (name) DO "
+                + (
+                    "UPDATE SET "
+                    + ", ".join(col + "=" + merge_value_sql(col, rule(col)) for col in repos_cols)
+                    if len(repos_cols)
+                    else "NOTHING"
+                )
+            )
+            # shard repo_ids are remapped to main repo_ids by name; rows are
+            # applied in the order recorded, which decides "latest" within a
+            # shard without a unique (repo_id, day) index
+            db.conn.execute(
+                "INSERT INTO main.stats (repo_id, day"
+                + "".join(", " + col for col in cols)
+                + ") SELECT m.repo_id, s.day"
+                + "".join(", s." + col for col in cols)
+                + " FROM shard.stats AS s"
+                " JOIN shard.repos AS r ON r.repo_id = s.repo_id"
+                " JOIN main.repos AS m ON m.name = r.name"
+                " WHERE true ORDER BY s.rowid"
+                " ON CONFLICT (repo_id, day) DO "
+                + (
+                    "UPDATE SET "
+                    + ", ".join(col + "=" + merge_value_sql(col, rule(col)) for col in cols)
+                    if len(cols)
+                    else "NOTHING"
+                )
+            )
+            # running totals only grow, so the larger is the one seen last
+            if len(_columns(db.conn, "shard", "snapshot_totals")):
+                db.conn.execute(
+                    "INSERT INTO main.snapshot_totals (repo_id, item, version, total)"
+                    " SELECT m.repo_id, t.item, t.version, t.total"
+                    " FROM shard.snapshot_totals AS t"
+                    " JOIN shard.repos AS r ON r.repo_id = t.repo_id"
+                    " JOIN main.repos AS m ON m.name = r.name"
+                    " WHERE true ON CONFLICT (repo_id, item) DO UPDATE SET"
+                    " version = CASE WHEN excluded.total > total"
+                    " THEN excluded.version ELSE version END,"
+                    " total = " + merge_value_sql("total", "max")
+                )
+    finally:
+        db.conn.execute("DETACH DATABASE shard")
+    return counts
@@ -0,0 +1,840 @@
+"""
+A local stand-in for the GitHub, Travis and anaconda.org APIs, for offline
+and load tests
+
+Serves the endpoints code_stats requests:
+
+    GitHub:
+        GET /rate_limit
+        GET /repos/<owner>/<name>
+        GET /repos/<owner>/<name>/traffic/views
+        GET /repos/<owner>/<name>/traffic/clones
+        GET /orgs/<owner>/repos, GET /users/<owner>/repos
+        POST /graphql, the repository snapshot queries
+    Travis, under /travis:
+        GET /repos, GET /repo/<id>/builds, paginated with "@pagination"
+    anaconda.org, under /anaconda:
+        GET /packages/<channel>, GET /package/<channel>/<name>
+
+Responses are generated from a seed by `SyntheticAPI`, for any repo name, or
+replayed from a cassette recorded from the real APIs by `CassetteAPI`. The
+server adds X-RateLimit headers and enforces a per-hour limit for GitHub,
+answers conditional requests with "304 Not Modified", and can inject latency,
+server errors and secondary rate limits. GET /_standin/stats returns counts
+of the requests served.
+
+Run a server, and point code_stats at it:
+
+    python standin_server.py --repos 1000 --latency 0.05 --error-rate 0.01
+    export PRISMS_CODE_STATS_GITHUB_URL=http://127.0.0.1:8765
+    export PRISMS_CODE_STATS_TRAVIS_URL=http://127.0.0.1:8765/travis
+    export PRISMS_CODE_STATS_ANACONDA_URL=http://127.0.0.1:8765/anaconda
+    python code_stats.py update
+
+Record a cassette, with the server forwarding requests to the real APIs,
+then replay it:
+
+    python standin_server.py --record cassette.jsonl
+    python standin_server.py --cassette cassette.jsonl
+
+Cassettes hold responses only, without the request headers, so no tokens.
+"""
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+github_upstream = "https://api.github.com"
+travis_upstream = "https://api.travis-ci.org"
+anaconda_upstream = "https://api.anaconda.org"
+
+# response headers kept in cassettes
+recorded_headers = [
+    "Content-Type",
+    "ETag",
+    "Last-Modified",
+    "Link",
+    "X-RateLimit-Limit",
+    "X-RateLimit-Remaining",
+    "X-RateLimit-Reset",
+    "X-RateLimit-Resource",
+]
+
+# replaces the upstream API URL in recorded bodies and headers
+base_url_token = "{{base_url}}"
+
+
+class Response(object):
+    def __init__(self, status, body, headers=None):
+        """
+        :param status: int
+        :param body: JSON serializable, or str
+        :param headers: dict, optional
+        """
+        self.status = status
+        self.body = body if isinstance(body, str) else json.dumps(body)
+        self.headers = dict(headers or {})
+        self.headers.setdefault("Content-Type", "application/json; charset=utf-8")
+
+
+def not_found():
+    return Response(404, {"message": "Not Found"})
+
+
+def _name_rng(seed, *keys):
+    h = hashlib.sha1(json.dumps([seed] + list(keys)).encode()).digest()
+    return random.Random(int.from_bytes(h[:8], "big"))
+
+
+def _fraction(seed, key):
+    """:return: float in [0, 1), fixed for `seed` and `key`"""
+    return _name_rng(seed, "fraction", key).random()
+
+
+# aliased repository fields of `GithubStats.graphql_snapshot_query`
+graphql_repo_re = re.compile(
+    r"(\w+)\s*:\s*repository\(\s*owner:\s*\$(\w+)\s*,\s*name:\s*\$(\w+)\s*\)"
+)
+
+
+class SyntheticAPI(object):
+    """
+    Synthetic responses, the same for the same seed, repo name and day
+    """
+
+    def __init__(
+        self,
+        repo_names,
+        seed=0,
+        push_denied_rate=0.05,
+        travis_rate=0.8,
+        max_builds=500,
+        per_page=30,
+        packages=None,
+        list_files=True,
+    ):
+        """
+        :param repo_names: list of str, the repos listed by the org and Travis
+            repos endpoints; any other "owner/name" is served too
+        :param seed: int
+        :param push_denied_rate: float, fraction of repos whose traffic is
+            refused with 403 "Must have push access to repository"
+        :param travis_rate: float, fraction of `repo_names` on Travis
+        :param max_builds: int, maximum number of Travis builds of a repo
+        :param per_page: int, default GitHub page size
+        :param packages: list of str, optional, the conda packages listed by
+            the anaconda.org channel endpoint, as "channel/name"; any other
+            package is served too
+        :param list_files: bool, if False, channel listings omit "files"
+        """
+        self.repo_names = list(repo_names)
+        self.seed = seed
+        self.push_denied_rate = push_denied_rate
+        self.max_builds = max_builds
+        self.per_page = per_page
+        self.travis_repos = [
+            {"id": i + 1, "slug": repo_name}
+            for i, repo_name in enumerate(self.repo_names)
+            if _fraction(seed, "travis " + repo_name) < travis_rate
+        ]
+        self.travis_ids = {repo["id"]: repo["slug"] for repo in self.travis_repos}
+        self.packages = list(packages or [])
+        self.list_files = list_files
+        # files are uploaded before `start`, and their download totals grow
+        # with `clock`, epoch seconds
+        self.start = time.time()
+        self.clock = time.time
+
+    def repo(self, base_url, full_name):
+        rng = _name_rng(self.seed, "repo", full_name)
+        owner, name = full_name.split("/", 1)
+        stars = rng.randint(0, 2000)
+        return {
+            "id": rng.randint(1, 10**9),
+            "name": name,
+            "full_name": full_name,
+            "owner": {"login": owner, "type": "Organization"},
+            "private": False,
+            "fork": False,
+            "archived": False,
+            "url": base_url + "/repos/" + full_name,
+            "html_url": "https://github.com/" + full_name,
+            "stargazers_count": stars,
+            "watchers_count": stars,
+            "forks_count": rng.randint(0, stars // 4 + 1),
+            "open_issues_count": rng.randint(0, 100),
+        }
+
+    def releases_count(self, full_name):
+        return _name_rng(self.seed, "releases", full_name).randint(0, 50)
+
+    def traffic(self, full_name, kind, today):
+        """
+        :param kind: str, "views" or "clones"
+        :return: dict, the last 14 days of `kind` traffic
+        """
+        days = []
+        for i in range(13, -1, -1):
+            day = today - datetime.timedelta(days=i)
+            rng = _name_rng(self.seed, kind, full_name, day.isoformat())
+            uniques = rng.randint(0, 40)
+            days.append(
+                {
+                    "timestamp": day.isoformat() + "T00:00:00Z",
+                    "count": uniques * rng.randint(1, 5),
+                    "uniques": uniques,
+                }
+            )
+        return {
+            "count": sum(d["count"] for d in days),
+            "uniques": sum(d["uniques"] for d in days),
+            kind: days,
+        }
+
+    def builds(self, travis_id, today):
+        """:return: list of dict, the repo's builds, newest first by id"""
+        rng = _name_rng(self.seed, "builds", self.travis_ids[travis_id])
+        n = rng.randint(0, self.max_builds)
+        first = today - datetime.timedelta(days=730)
+        builds = []
+        for i in range(n):
+            started_at = None
+            if rng.random() > 0.05:
+                day = first + datetime.timedelta(days=int(730 * (i + rng.random()) / n))
+                started_at = day.isoformat() + "T%02d:%02d:00Z" % (
+                    rng.randint(0, 23), rng.randint(0, 59),
+                )
+            builds.append({"id": travis_id * 100000 + i, "started_at": started_at})
+        builds.reverse()
+        return builds
+
+    def github(self, method, path, query, body, base_url):
+        """:return: Response, or None if not an endpoint of this API"""
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        parts = path.strip("/").split("/")
+        if method == "POST" and path == "/graphql":
+            return self.graphql(json.loads(body or "{}"))
+        if method != "GET":
+            return None
+        if len(parts) == 3 and parts[0] == "repos":
+            return Response(200, self.repo(base_url, parts[1] + "/" + parts[2]))
+        if len(parts) == 5 and parts[0] == "repos" and parts[3] == "traffic":
+            full_name = parts[1] + "/" + parts[2]
+            if parts[4] not in ("views", "clones"):
+                return not_found()
+            if _fraction(self.seed, "push " + full_name) < self.push_denied_rate:
+                return Response(
+                    403,
+                    {
+                        "message": "Must have push access to repository",
+                        "documentation_url": "https://docs.github.com/rest",
+                    },
+                )
+            return Response(200, self.traffic(full_name, parts[4], today))
+        if len(parts) == 3 and parts[0] in ("orgs", "users") and parts[2] == "repos":
+            owned = [name for name in self.repo_names if name.split("/")[0] == parts[1]]
+            if not len(owned):
+                return not_found()
+            per_page = int(query.get("per_page", self.per_page))
+            page = int(query.get("page", 1))
+            items = owned[(page - 1) * per_page : page * per_page]
+            headers = {}
+            if page * per_page < len(owned):
+                q = dict(query, page=str(page + 1))
+                headers["Link"] = (
+                    "<" + base_url + path + "?" + urllib.parse.urlencode(q)
+                    + '>; rel="next"'
+                )
+            return Response(
+                200, [self.repo(base_url, name) for name in items], headers=headers
+            )
+        return None
+
+    def graphql(self, request):
+        variables = request.get("variables") or {}
+        data = {}
+        errors = []
+        for alias, owner_var, name_var in graphql_repo_re.findall(request.get("query", "")):
+            full_name = variables.get(owner_var, "") + "/" + variables.get(name_var, "")
+            if full_name.startswith("missing-"):
+                data[alias] = None
+                errors.append(
+                    {
+                        "type": "NOT_FOUND",
+                        "path": [alias],
+                        "message": "Could not resolve to a Repository with the name '"
+                        + full_name + "'.",
+                    }
+                )
+                continue
+            repo = self.repo("", full_name)
+            rng = _name_rng(self.seed, "issues", full_name)
+            issues = rng.randint(0, repo["open_issues_count"])
+            data[alias] = {
+                "stargazerCount": repo["stargazers_count"],
+                "forkCount": repo["forks_count"],
+                "issues": {"totalCount": issues},
+                "pullRequests": {"totalCount": repo["open_issues_count"] - issues},
+                "releases": {"totalCount": self.releases_count(full_name)},
+            }
+        data["rateLimit"] = {"cost": 1, "remaining": 4999}
+        result = {"data": data}
+        if len(errors):
+            result["errors"] = errors
+        return Response(200, result)
+
+    def package(self, full_name, files=True):
+        """
+        :return: dict, an anaconda.org package, whose files' download totals
+            grow steadily from their upload
+        """
+        rng = _name_rng(self.seed, "package", full_name)
+        channel, name = full_name.split("/", 1)
+        now = self.clock()
+        package = {"name": name, "owner": channel, "full_name": full_name}
+        if not files:
+            return package
+        package["files"] = []
+        for i in range(rng.randint(1, 6)):
+            version = "1." + str(i) + ".0"
+            uploaded = self.start - rng.uniform(1, 1000) * 86400
+            per_day = rng.uniform(0, 20)
+            for platform in ["linux-64", "osx-64"]:
+                package["files"].append(
+                    {
+                        "basename": platform + "/" + name + "-" + version + "-0.tar.bz2",
+                        "version": version,
+                        "upload_time": datetime.datetime.fromtimestamp(
+                            uploaded, datetime.timezone.utc
+                        ).isoformat(),
+                        "ndownloads": int(per_day * (now - uploaded) / 86400),
+                    }
+                )
+        return package
+
+    def anaconda(self, method, path, query, body, base_url):
+        """:return: Response, or None if not an endpoint of this API"""
+        if method != "GET":
+            return None
+        parts = path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "packages":
+            listed = [
+                self.package(full_name, files=self.list_files)
+                for full_name in self.packages
+                if full_name.split("/")[0] == parts[1]
+            ]
+            if not len(listed):
+                return Response(404, {"error": "user " + parts[1] + " does not exist"})
+            return Response(200, listed)
+        if len(parts) == 3 and parts[0] == "package":
+            if parts[2].startswith("missing-"):
+                return Response(404, {"error": "package does not exist"})
+            return Response(200, self.package(parts[1] + "/" + parts[2]))
+        return None
+
+    def travis(self, method, path, query, body, base_url):
+        """:return: Response, or None if not an endpoint of this API"""
+        if method != "GET":
+            return None
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        parts = path.strip("/").split("/")
+        if parts == ["repos"]:
+            return travis_page(path, query, "repositories", self.travis_repos)
+        if len(parts) == 3 and parts[0] == "repo" and parts[2] == "builds":
+            try:
+                travis_id = int(parts[1])
+            except ValueError:
+                return not_found()
+            if travis_id not in self.travis_ids:
+                return not_found()
+            builds = self.builds(travis_id, today)
+            if query.get("sort_by") == "started_at:desc":
+                builds = sorted(
+                    builds, key=lambda build: build["started_at"] or "", reverse=True
+                )
+            return travis_page(path, query, "builds", builds)
+        return None
+
+
+def travis_page(path, query, key, items, default_limit=25):
+    """:return: Response, one page of a Travis API v3 collection"""
+    limit = int(query.get("limit", default_limit))
+    offset = int(query.get("offset", 0))
+    is_last = offset + limit >= len(items)
+
+    def href(offset):
+        q = dict(query, limit=str(limit), offset=str(offset))
+        return {"@href": path + "?" + urllib.parse.urlencode(q)}
+
+    last_offset = max(0, (len(items) - 1) // limit * limit) if limit else 0
+    return Response(
+        200,
+        {
+            "@type": key,
+            key: items[offset : offset + limit],
+            "@pagination": {
+                "limit": limit,
+                "offset": offset,
+                "count": len(items),
+                "is_first": offset == 0,
+                "is_last": is_last,
+                "next": None if is_last else href(offset + limit),
+                "prev": None if offset == 0 else href(max(0, offset - limit)),
+                "first": href(0),
+                "last": href(last_offset),
+            },
+        },
+    )
+
+
+def cassette_key(api, method, path_qs, body):
+    key = api + " " + method + " " + path_qs
+    if body:
+        key += " " + hashlib.sha1(body.encode()).hexdigest()
+    return key
+
+
+class CassetteAPI(object):
+    """
+    Responses replayed from a cassette, a JSON lines file of recorded
+    responses; for a request recorded more than once, the last is replayed
+    """
+
+    def __init__(self, path):
+        self.responses = {}
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                r = json.loads(line)
+                self.responses[r["key"]] = r
+
+    def _replay(self, api, method, path, query, body, base_url):
+        path_qs = path + ("?" + urllib.parse.urlencode(query) if query else "")
+        r = self.responses.get(cassette_key(api, method, path_qs, body))
+        if r is None:
+            return Response(404, {"message": "Not in cassette: " + method + " " + path_qs})
+        return Response(
+            r["status"],
+            r["body"].replace(base_url_token, base_url),
+            headers={
+                k: v.replace(base_url_token, base_url) for k, v in r["headers"].items()
+            },
+        )
+
+    def github(self, method, path, query, body, base_url):
+        return self._replay("github", method, path, query, body, base_url)
+
+    def travis(self, method, path, query, body, base_url):
+        return self._replay("travis", method, path, query, body, base_url)
+
+    def anaconda(self, method, path, query, body, base_url):
+        return self._replay("anaconda", method, path, query, body, base_url)
+
+
+class RecordingAPI(object):
+    """
+    Forward requests to the real APIs, with their Authorization header, and
+    append the responses to a cassette
+    """
+
+    def __init__(
+        self,
+        path,
+        github_url=github_upstream,
+        travis_url=travis_upstream,
+        anaconda_url=anaconda_upstream,
+    ):
+        import requests
+
+        self.path = path
+        self.upstream = {
+            "github": github_url,
+            "travis": travis_url,
+            "anaconda": anaconda_url,
+        }
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+
+    def _forward(self, api, method, path, query, body, base_url, headers):
+        upstream = self.upstream[api]
+        path_qs = path + ("?" + urllib.parse.urlencode(query) if query else "")
+        forwarded = {
+            k: v
+            for k, v in headers.items()
+            if k.lower() in ("authorization", "accept", "travis-api-version", "content-type")
+        }
+        r = self.session.request(
+            method, upstream + path_qs, data=body or None, headers=forwarded
+        )
+        kept = {k: r.headers[k] for k in recorded_headers if k in r.headers}
+        with self.lock, open(self.path, "a") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "key": cassette_key(api, method, path_qs, body),
+                        "status": r.status_code,
+                        "headers": {
+                            k: v.replace(upstream, base_url_token) for k, v in kept.items()
+                        },
+                        "body": r.text.replace(upstream, base_url_token),
+                    }
+                )
+                + "\n"
+            )
+        return Response(
+            r.status_code,
+            r.text.replace(upstream, base_url),
+            headers={k: v.replace(upstream, base_url) for k, v in kept.items()},
+        )
+
+    def github(self, method, path, query, body, base_url, headers=None):
+        return self._forward("github", method, path, query, body, base_url, headers or {})
+
+    def travis(self, method, path, query, body, base_url, headers=None):
+        return self._forward("travis", method, path, query, body, base_url, headers or {})
+
+    def anaconda(self, method, path, query, body, base_url, headers=None):
+        return self._forward(
+            "anaconda", method, path, query, body, base_url, headers or {}
+        )
+
+
+class RateBudget(object):
+    """A fixed window request budget, as GitHub's X-RateLimit headers describe"""
+
+    def __init__(self, limit, window=3600.0):
+        self.limit = limit
+        self.window = window
+        self.reset = time.time() + window
+        self.used = 0
+
+    def charge(self, n=1):
+        """:return: bool, False if the budget is used up"""
+        now = time.time()
+        if now >= self.reset:
+            self.reset = now + self.window
+            self.used = 0
+        if self.used + n > self.limit:
+            return False
+        self.used += n
+        return True
+
+    def headers(self, resource):
+        return {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(max(0, self.limit - self.used)),
+            "X-RateLimit-Reset": str(int(self.reset)),
+            "X-RateLimit-Used": str(self.used),
+            "X-RateLimit-Resource": resource,
+        }
+
+
+class StandinServer(object):
+    """
+    Serve an API (`SyntheticAPI`, `CassetteAPI` or `RecordingAPI`) over HTTP,
+    in a background thread
+    """
+
+    def __init__(
+        self,
+        api,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        latency_jitter=0.5,
+        error_rate=0.0,
+        secondary_rate_limit_rate=0.0,
+        rate_limit=5000,
+        rate_window=3600.0,
+        seed=0,
+    ):
+        """
+        :param api: object with `github` and `travis` methods returning a
+            Response, or None if not found
+        :param host: str
+        :param port: int, 0 for any free port
+        :param latency: float, mean seconds added to each response
+        :param latency_jitter: float, latency varies by up to this fraction
+        :param error_rate: float, fraction of requests answered with 502
+        :param secondary_rate_limit_rate: float, fraction of requests
+            answered as secondary rate limited, with Retry-After: 1
+        :param rate_limit: int, GitHub requests per `rate_window` seconds, for
+            each of the "core" and "graphql" resources
+        :param rate_window: float, seconds
+        :param seed: int, for the injected latency and errors
+        """
+        self.api = api
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.secondary_rate_limit_rate = secondary_rate_limit_rate
+        self.budgets = {
+            "core": RateBudget(rate_limit, rate_window),
+            "graphql": RateBudget(rate_limit, rate_window),
+        }
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://" + self.host + ":" + str(self.httpd.server_address[1])
+
+    @property
+    def github_url(self):
+        return self.url
+
+    @property
+    def travis_url(self):
+        return self.url + "/travis"
+
+    @property
+    def anaconda_url(self):
+        return self.url + "/anaconda"
+
+    def count(self, api, endpoint, status):
+        key = api + " " + endpoint + " " + str(status)
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep-alive, so clients' connection pools are exercised
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+            def do_POST(self):
+                server.handle(self)
+
+        self.httpd = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _inject(self):
+        """:return: str, "error", "secondary" or None, and sleep the latency"""
+        with self.lock:
+            jitter = 1.0 + self.latency_jitter * (2 * self.rng.random() - 1)
+            x = self.rng.random()
+        if self.latency > 0:
+            time.sleep(self.latency * jitter)
+        if x < self.error_rate:
+            return "error"
+        if x < self.error_rate + self.secondary_rate_limit_rate:
+            return "secondary"
+        return None
+
+    def respond(self, api, method, path, query, body, headers):
+        """:return: (endpoint, Response)"""
+        if api == "standin" and path == "/_standin/stats":
+            with self.lock:
+                return "stats", Response(200, {"counts": dict(self.counts)})
+
+        # endpoint name for counts, i.e. "/repos/*/*/traffic/views"
+        endpoint = re.sub(r"^/repos/[^/]+/[^/]+", "/repos/*/*", path)
+        endpoint = re.sub(r"^/(orgs|users|repo|packages)/[^/]+", r"/\1/*", endpoint)
+        endpoint = re.sub(r"^/package/[^/]+/[^/]+", "/package/*/*", endpoint)
+        if api == "github" and path == "/rate_limit":
+            resources = {
+                name: {
+                    "limit": budget.limit,
+                    "remaining": max(0, budget.limit - budget.used),
+                    "reset": int(budget.reset),
+                    "used": budget.used,
+                }
+                for name, budget in self.budgets.items()
+            }
+            return endpoint, Response(
+                200, {"resources": resources, "rate": resources["core"]}
+            )
+
+        injected = self._inject()
+        if injected == "error":
+            return endpoint, Response(502, {"message": "Server Error"})
+        if injected == "secondary":
+            if api == "github":
+                return endpoint, Response(
+                    403,
+                    {"message": "You have exceeded a secondary rate limit."},
+                    headers={"Retry-After": "1"},
+                )
+            return endpoint, Response(
+                429, {"error_message": "rate limited"}, headers={"Retry-After": "1"}
+            )
+
+        resource = "graphql" if path == "/graphql" else "core"
+        rate_headers = {}
+        if api == "github":
+            budget = self.budgets[resource]
+            with self.lock:
+                ok = budget.charge()
+                rate_headers = budget.headers(resource)
+            if not ok:
+                return endpoint, Response(
+                    403,
+                    {"message": "API rate limit exceeded."},
+                    headers=rate_headers,
+                )
+
+        base_url = self.url + ("" if api == "github" else "/" + api)
+        handler = getattr(self.api, api)
+        if isinstance(self.api, RecordingAPI):
+            r = handler(method, path, query, body, base_url, headers=headers)
+        else:
+            r = handler(method, path, query, body, base_url)
+        if r is None:
+            r = not_found()
+        r.headers.update(rate_headers)
+        return endpoint, r
+
+    def handle(self, request):
+        u = urllib.parse.urlsplit(request.path)
+        query = dict(urllib.parse.parse_qsl(u.query))
+        body = ""
+        if "Content-Length" in request.headers:
+            body = request.rfile.read(int(request.headers["Content-Length"])).decode()
+        path = u.path
+        api = "github"
+        if path.startswith("/_standin/"):
+            api = "standin"
+        else:
+            for prefix in ["travis", "anaconda"]:
+                if path == "/" + prefix or path.startswith("/" + prefix + "/"):
+                    api = prefix
+                    path = path[len(prefix) + 1:] or "/"
+        # PyGithub's default base_url ends with /api/v3 for GitHub Enterprise
+        if api == "github" and path.startswith("/api/v3/"):
+            path = path[len("/api/v3"):]
+
+        endpoint, r = self.respond(
+            api, request.command, path, query, body, dict(request.headers)
+        )
+        data = r.body.encode()
+        status = r.status
+        if status == 200:
+            etag = '"' + hashlib.md5(data).hexdigest() + '"'
+            r.headers.setdefault("ETag", etag)
+            if request.headers.get("If-None-Match") == r.headers["ETag"]:
+                status = 304
+                data = b""
+                # GitHub does not count 304 responses against the rate limit
+                if api == "github" and endpoint != "/rate_limit":
+                    budget = self.budgets["graphql" if path == "/graphql" else "core"]
+                    with self.lock:
+                        budget.used = max(0, budget.used - 1)
+        self.count(api, endpoint, status)
+
+        request.send_response(status)
+        for k, v in r.headers.items():
+            request.send_header(k, v)
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve a local stand-in for the GitHub and Travis APIs"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--repos", type=int, default=100, help="synthetic repos listed, standin-org/..."
+    )
+    parser.add_argument(
+        "--names", nargs="+", default=[], help="also list these repos, i.e. owner/name"
+    )
+    parser.add_argument(
+        "--packages", type=int, default=20,
+        help="synthetic conda packages listed, standin-org/...",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--push-denied-rate", type=float, default=0.05,
+        help="fraction of repos refusing traffic requests",
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per response")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of 502 responses"
+    )
+    parser.add_argument(
+        "--secondary-rate-limit-rate", type=float, default=0.0,
+        help="fraction of secondary rate limit responses",
+    )
+    parser.add_argument(
+        "--rate-limit", type=int, default=5000, help="GitHub requests per hour"
+    )
+    parser.add_argument("--cassette", help="replay responses from this cassette")
+    parser.add_argument(
+        "--record", metavar="CASSETTE",
+        help="forward requests to the real APIs and append responses to CASSETTE",
+    )
+    args = parser.parse_args(argv)
+
+    if args.cassette is not None:
+        api = CassetteAPI(args.cassette)
+    elif args.record is not None:
+        api = RecordingAPI(args.record)
+    else:
+        names = ["standin-org/repo" + str(i).zfill(5) for i in range(args.repos)]
+        api = SyntheticAPI(
+            args.names + names,
+            seed=args.seed,
+            push_denied_rate=args.push_denied_rate,
+            packages=[
+                "standin-org/package" + str(i).zfill(5) for i in range(args.packages)
+            ],
+        )
+    server = StandinServer(
+        api,
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        secondary_rate_limit_rate=args.secondary_rate_limit_rate,
+        rate_limit=args.rate_limit,
+        seed=args.seed,
+    ).start()
+    print("export PRISMS_CODE_STATS_GITHUB_URL=" + server.github_url)
+    print("export PRISMS_CODE_STATS_TRAVIS_URL=" + server.travis_url)
+    print("export PRISMS_CODE_STATS_ANACONDA_URL=" + server.anaconda_url)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
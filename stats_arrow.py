@@ -0,0 +1,329 @@
+"""
+Export and import stats databases as Arrow IPC or Parquet files
+
+Each provider's tables are written to a directory partitioned by year:
+
+    <dirpath>/<provider>/repos.<ext>
+    <dirpath>/<provider>/stats/year=<yyyy>/part-0.<ext>
+    <dirpath>/<provider>/stats_weekly/year=<yyyy>/part-0.<ext>
+    <dirpath>/<provider>/stats_monthly/year=<yyyy>/part-0.<ext>
+
+where <ext> is "arrow" (Arrow IPC file format) or "parquet". Arrow IPC files
+can be memory-mapped and read without copying, i.e. with `read_table`.
+
+pyarrow is only required by the functions in this module.
+"""
+
+import glob
+import os
+import shutil
+
+from code_stats import rollups
+
+# file formats, also used as the file extensions
+formats = ["arrow", "parquet"]
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception(
+            "Arrow and Parquet export and import require pyarrow: pip install pyarrow"
+        )
+    return pyarrow
+
+
+def arrow_type(pa, decl_type):
+    """
+    :param decl_type: str, sqlite declared column type, i.e. "INT"
+    :return: pyarrow.DataType, using sqlite's column affinity rules
+    """
+    decl_type = decl_type.upper()
+    if "INT" in decl_type:
+        return pa.int64()
+    if "CHAR" in decl_type or "CLOB" in decl_type or "TEXT" in decl_type:
+        return pa.string()
+    return pa.float64()
+
+
+def table_schema(pa, conn, table):
+    """
+    :return: pyarrow.Schema of the columns of a sqlite table
+    """
+    return pa.schema(
+        [
+            (r[1], arrow_type(pa, r[2]))
+            for r in conn.execute("PRAGMA table_info('" + table + "')")
+        ]
+    )
+
+
+def year_sql(table):
+    """
+    :return: str, SQL expression for the partition year of a row of `table`
+    """
+    if table == "stats_monthly":
+        return "(month / 100)"
+    key = dict(rollups).get(table, "day")
+    # 1721424.5 is the Julian day of ordinal day 0
+    return "CAST(strftime('%Y', " + key + " + 1721424.5) AS INT)"
+
+
+def partition_path(dirpath, provider, table, year, fmt):
+    return os.path.join(
+        dirpath, provider, table, "year=" + str(year), "part-0." + fmt
+    )
+
+
+def _open_writer(pa, path, schema, fmt):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if fmt == "parquet":
+        import pyarrow.parquet
+
+        return pyarrow.parquet.ParquetWriter(path, schema)
+    return pa.ipc.new_file(path, schema)
+
+
+def _batch(pa, schema, rows):
+    columns = list(zip(*rows)) if len(rows) else [[] for field in schema]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def export_table(db, dirpath, table, fmt="arrow", chunk_size=65536):
+    """
+    Stream one stats table into year partitions, `chunk_size` rows at a time
+
+    Any previous export of the table is replaced.
+
+    :return: int, number of rows written
+    """
+    pa = require_pyarrow()
+    provider = db._shortname()
+    schema = table_schema(pa, db.conn, table)
+    key = dict(rollups).get(table, "day")
+    shutil.rmtree(os.path.join(dirpath, provider, table), ignore_errors=True)
+
+    cur = db.conn.execute(
+        "SELECT " + year_sql(table) + ", "
+        + ", ".join(field.name for field in schema)
+        + " FROM " + table + " ORDER BY " + key + ", repo_id"
+    )
+    count = 0
+    year = None
+    writer = None
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not len(rows):
+                break
+            begin = 0
+            # rows are ordered by key, so each year is one run of rows
+            for i in range(len(rows) + 1):
+                if i < len(rows) and rows[i][0] == year:
+                    continue
+                if i > begin:
+                    writer.write_batch(_batch(pa, schema, [r[1:] for r in rows[begin:i]]))
+                if i == len(rows):
+                    break
+                if writer is not None:
+                    writer.close()
+                year = rows[i][0]
+                writer = _open_writer(
+                    pa, partition_path(dirpath, provider, table, year, fmt), schema, fmt
+                )
+                begin = i
+            count += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    cur.close()
+    return count
+
+
+def export_tables(db, dirpath, fmt="arrow", chunk_size=65536):
+    """
+    Export the "repos" table, the "stats" table and its rollups, from one
+    consistent snapshot of the database
+
+    :param db: StatsBase, connected
+    :param dirpath: str, export directory
+    :param fmt: str, "arrow" or "parquet"
+    :param chunk_size: int, maximum rows held in memory
+    :return: dict of {table: number of rows written}
+    """
+    pa = require_pyarrow()
+    if fmt not in formats:
+        raise Exception("Unknown export format: '" + fmt + "'")
+    provider = db._shortname()
+    counts = {}
+    db.conn.commit()
+    db.conn.execute("BEGIN")
+    try:
+        schema = table_schema(pa, db.conn, "repos")
+        rows = db.conn.execute(
+            "SELECT " + ", ".join(field.name for field in schema)
+            + " FROM repos ORDER BY repo_id"
+        ).fetchall()
+        path = os.path.join(dirpath, provider, "repos." + fmt)
+        writer = _open_writer(pa, path, schema, fmt)
+        writer.write_batch(_batch(pa, schema, rows))
+        writer.close()
+        counts["repos"] = len(rows)
+
+        for table in ["stats"] + [table for table, key in rollups]:
+            counts[table] = export_table(
+                db, dirpath, table, fmt=fmt, chunk_size=chunk_size
+            )
+    finally:
+        db.conn.rollback()
+    return counts
+
+
+def _find_format(dirpath, provider):
+    for fmt in formats:
+        if os.path.isfile(os.path.join(dirpath, provider, "repos." + fmt)):
+            return fmt
+    raise Exception(
+        "No exported '" + provider + "' tables found in: " + str(dirpath)
+    )
+
+
+def partition_paths(dirpath, provider, table, years=None):
+    """
+    :param years: list of int, optional, only these years' partitions
+    :return: list of str, partition files, in order of year
+    """
+    ext = _find_format(dirpath, provider)
+    paths = []
+    for path in glob.glob(
+        os.path.join(dirpath, provider, table, "year=*", "part-*." + ext)
+    ):
+        year = int(os.path.basename(os.path.dirname(path))[len("year="):])
+        if years is None or year in years:
+            paths.append((year, path))
+    return [path for year, path in sorted(paths)]
+
+
+def _read_file(path, memory_map=True):
+    pa = require_pyarrow()
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_table(path, memory_map=memory_map)
+    if memory_map:
+        source = pa.memory_map(path, "r")
+    else:
+        source = pa.OSFile(path, "rb")
+    return pa.ipc.open_file(source).read_all()
+
+
+def read_table(dirpath, provider, table="stats", years=None, memory_map=True):
+    """
+    Read an exported table, without copying Arrow IPC data if memory mapped
+
+    :param dirpath: str, export directory
+    :param provider: str, i.e. "github"
+    :param table: str, "repos", "stats", "stats_weekly" or "stats_monthly"
+    :param years: list of int, optional, only read these years' partitions
+    :param memory_map: bool, memory-map the files rather than reading them
+    :return: pyarrow.Table
+    """
+    pa = require_pyarrow()
+    if table == "repos":
+        ext = _find_format(dirpath, provider)
+        return _read_file(
+            os.path.join(dirpath, provider, "repos." + ext), memory_map=memory_map
+        )
+    paths = partition_paths(dirpath, provider, table, years=years)
+    if not len(paths):
+        # no rows were exported, or none in the years requested
+        return pa.table({})
+    return pa.concat_tables([_read_file(path, memory_map=memory_map) for path in paths])
+
+
+def _iter_batches(path, chunk_size):
+    pa = require_pyarrow()
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+
+        for batch in pyarrow.parquet.ParquetFile(path, memory_map=True).iter_batches(
+            batch_size=chunk_size
+        ):
+            yield batch
+        return
+    reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+    for i in range(reader.num_record_batches):
+        yield reader.get_batch(i)
+
+
+def import_tables(db, dirpath, chunk_size=65536):
+    """
+    Insert or update repos and stats from an export, in one transaction
+
+    Repos are matched by name, and added if missing. Stats are upserted, and
+    NULL values in the export do not overwrite existing values. Rollups are
+    maintained by the database triggers, so they are not read.
+
+    :param db: StatsBase, connected
+    :param dirpath: str, export directory
+    :param chunk_size: int, maximum rows held in memory
+    :return: dict of {table: number of rows read}
+    """
+    provider = db._shortname()
+    repos = read_table(dirpath, provider, "repos").to_pylist()
+    repos_cols = [
+        r["name"] for r in db.conn.execute("PRAGMA table_info('repos')")
+    ]
+    stats_cols = [
+        r["name"] for r in db.conn.execute("PRAGMA table_info('stats')")
+        if r["name"] not in ("record_id", "repo_id", "day")
+    ]
+
+    def rows(repo_ids):
+        for path in partition_paths(dirpath, provider, "stats"):
+            for batch in _iter_batches(path, chunk_size):
+                names = batch.schema.names
+                cols = [
+                    (name, batch.column(i).to_pylist())
+                    for i, name in enumerate(names)
+                    if name in stats_cols
+                ]
+                repo_id_col = batch.column(names.index("repo_id")).to_pylist()
+                day_col = batch.column(names.index("day")).to_pylist()
+                for i in range(batch.num_rows):
+                    repo_id = repo_ids.get(repo_id_col[i])
+                    if repo_id is None:
+                        continue
+                    record = {}
+                    for name, values in cols:
+                        if values[i] is not None:
+                            record[name] = values[i]
+                    yield (repo_id, day_col[i], record)
+
+    counts = {"repos": len(repos)}
+    with db.conn:
+        repo_ids = {}
+        for repo in repos:
+            db.conn.execute(
+                "INSERT OR IGNORE INTO repos (name) VALUES (?)", (repo["name"],)
+            )
+            record = {
+                key: value
+                for key, value in repo.items()
+                if key in repos_cols and key not in ("repo_id", "name")
+                and value is not None
+            }
+            if len(record):
+                db.conn.execute(
+                    "UPDATE repos SET "
+                    + ", ".join(key + "=?" for key in record)
+                    + " WHERE name=?",
+                    tuple(record.values()) + (repo["name"],),
+                )
+            repo_ids[repo["repo_id"]] = db.get_repo_id(repo["name"])
+        counts["stats"] = db._upsert_stats(rows(repo_ids), batch_size=chunk_size)
+    return counts
@@ -0,0 +1,190 @@
+"""
+Compact in-memory stats: one numpy array of repos x periods x metrics
+"""
+
+import bisect
+
+import numpy as np
+
+
+class StatsCube(object):
+    """
+    Stats for many repos, periods and metrics in one numpy array
+
+    Attributes:
+        values: numpy.ndarray, shape (len(repos), len(periods), len(metrics))
+        repos: list of str, repo names
+        periods: list of datetime.date, in increasing order, i.e. week ends
+        metrics: list of str, stats columns, i.e. "views"
+        repo_index, period_index, metric_index: dict of {name: index}
+
+    Methods return new cubes, which share `values` where numpy slicing allows.
+    """
+
+    __slots__ = (
+        "values",
+        "repos",
+        "periods",
+        "metrics",
+        "repo_index",
+        "period_index",
+        "metric_index",
+    )
+
+    def __init__(self, values, repos, periods, metrics):
+        """
+        :param values: array_like, shape (len(repos), len(periods), len(metrics)),
+            used without copying if it is already a numpy array
+        :param repos: list of str, repo names
+        :param periods: list of datetime.date, in increasing order
+        :param metrics: list of str, stats columns
+        """
+        values = np.asarray(values)
+        shape = (len(repos), len(periods), len(metrics))
+        if values.shape != shape:
+            raise Exception(
+                "StatsCube values shape " + str(values.shape)
+                + " does not match " + str(shape)
+            )
+        self.values = values
+        self.repos = list(repos)
+        self.periods = list(periods)
+        self.metrics = list(metrics)
+        self.repo_index = {name: i for i, name in enumerate(self.repos)}
+        self.period_index = {date: i for i, date in enumerate(self.periods)}
+        self.metric_index = {name: i for i, name in enumerate(self.metrics)}
+
+    @classmethod
+    def zeros(cls, repos, periods, metrics, dtype=np.float64):
+        return cls(
+            np.zeros((len(repos), len(periods), len(metrics)), dtype=dtype),
+            repos,
+            periods,
+            metrics,
+        )
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __repr__(self):
+        return (
+            "StatsCube(" + str(len(self.repos)) + " repos, "
+            + str(len(self.periods)) + " periods, metrics=" + str(self.metrics) + ")"
+        )
+
+    def copy(self):
+        return StatsCube(self.values.copy(), self.repos, self.periods, self.metrics)
+
+    def _indices(self, names, index, kind):
+        try:
+            return [index[name] for name in names]
+        except KeyError as e:
+            raise Exception("StatsCube has no " + kind + ": " + str(e))
+
+    def select(self, repos=None, metrics=None, start=None, end=None):
+        """
+        Select a sub-cube
+
+        Selecting a period range only, or a single repo or metric, returns a
+        view of `values`; selecting several repos or metrics by name copies.
+
+        :param repos: list of str, optional, repos in the order wanted
+        :param metrics: list of str, optional, metrics in the order wanted
+        :param start: datetime.date, optional, first period included
+        :param end: datetime.date, optional, last period included
+        :return: StatsCube
+        """
+        values = self.values
+        i0 = 0 if start is None else bisect.bisect_left(self.periods, start)
+        i1 = len(self.periods) if end is None else bisect.bisect_right(self.periods, end)
+        values = values[:, i0:i1, :]
+        periods = self.periods[i0:i1]
+
+        for axis, names, index, kind in [
+            (0, repos, self.repo_index, "repo"),
+            (2, metrics, self.metric_index, "metric"),
+        ]:
+            if names is None:
+                continue
+            indices = self._indices(names, index, kind)
+            if len(indices) == 1:
+                # a basic slice, so still a view
+                i = indices[0]
+                values = values[i : i + 1] if axis == 0 else values[:, :, i : i + 1]
+            else:
+                values = np.take(values, indices, axis=axis)
+        return StatsCube(
+            values,
+            self.repos if repos is None else repos,
+            periods,
+            self.metrics if metrics is None else metrics,
+        )
+
+    def cumsum(self):
+        """:return: StatsCube, running totals over periods"""
+        return StatsCube(
+            np.cumsum(self.values, axis=1), self.repos, self.periods, self.metrics
+        )
+
+    def total(self):
+        """:return: numpy.ndarray, shape (len(repos), len(metrics)), sums over periods"""
+        return self.values.sum(axis=1)
+
+    def merge(self, groups):
+        """
+        Sum groups of repos into one repo each, i.e. a renamed repo's history
+        into its new name
+
+        Each group is placed where its name is in `repos`, or else where the
+        first of its repos is. Repos not in any group are kept as they are.
+
+        :param groups: dict of {name: list of str}, the repos summed into
+            each name, together with the name itself if it is in this cube,
+            whether or not it is listed; repos not in this cube are ignored
+        :return: StatsCube
+        """
+        rows = {}
+        for i, repo in enumerate(self.repos):
+            rows[repo] = [i]
+        position = {repo: i for i, repo in enumerate(self.repos)}
+        for name, group in groups.items():
+            indices = set(
+                self.repo_index[repo] for repo in group if repo in self.repo_index
+            )
+            if not len(indices):
+                continue
+            if name in self.repo_index:
+                indices.add(self.repo_index[name])
+            indices = sorted(indices)
+            for i in indices:
+                rows.pop(self.repos[i], None)
+            position[name] = self.repo_index.get(name, indices[0])
+            rows[name] = indices
+        repos = sorted(rows, key=lambda name: position[name])
+
+        values = np.empty((len(repos),) + self.values.shape[1:], dtype=self.values.dtype)
+        for j, name in enumerate(repos):
+            indices = rows[name]
+            if len(indices) == 1:
+                values[j] = self.values[indices[0]]
+            else:
+                np.sum(self.values[indices], axis=0, out=values[j])
+        return StatsCube(values, repos, self.periods, self.metrics)
+
+    def frame(self, metric):
+        """
+        :param metric: str
+        :return: pandas.DataFrame, with periods index and repo name columns,
+            a view of `values`, without copying
+        """
+        import pandas
+
+        k = self.metric_index[metric]
+        return pandas.DataFrame(
+            self.values[:, :, k].T, index=self.periods, columns=self.repos, copy=False
+        )
+
+    def frames(self):
+        """:return: dict of {metric: pandas.DataFrame}, as from `frame`"""
+        return {metric: self.frame(metric) for metric in self.metrics}
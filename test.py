@@ -10,13 +10,14 @@ import requests
 travis_token = cs.get_config_value("travis", "token")
 print(travis_token)
 
-domain = "https://api.travis-ci.org"
+# PRISMS_CODE_STATS_TRAVIS_URL overrides, i.e. to use standin_server
+domain = cs.api_url("travis", "https://api.travis-ci.org")
 
 r = requests.get(
     domain + "/repos",
     headers={
         "Travis-API-Version": "3",
-        "Authorization": "token " + travis_token
+        "Authorization": "token " + str(travis_token)
     })
 res = r.json()
 repo_ids = {}
@@ -42,7 +43,7 @@ for repo_name in repos:
             domain + href,
             headers={
                 "Travis-API-Version": "3",
-                "Authorization": "token " + travis_token
+                "Authorization": "token " + str(travis_token)
             })
         res = r.json()
         for build in res['builds']:
@@ -0,0 +1,80 @@
+"""
+Retries of `rate_limit.RateLimitedAdapter`
+
+    python -m pytest -q test_rate_limit.py
+"""
+
+import http.server
+import threading
+
+import pytest
+import requests
+
+from rate_limit import RateLimitedAdapter, RateLimiter, server_error_retry
+
+
+@pytest.fixture
+def failing_server():
+    """
+    A server answering the first `fail` requests to each path with 502, then
+    200; its URL is "http://127.0.0.1:<port>/<fail>/..."
+    """
+    seen = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _respond(self):
+            fail = int(self.path.split("/")[1])
+            seen[self.path] = seen.get(self.path, 0) + 1
+            status = 502 if seen[self.path] <= fail else 200
+            body = b'{"ok": true}'
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = _respond
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            self._respond()
+
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:" + str(httpd.server_address[1]), seen
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def session(limiter=None, **kwargs):
+    s = requests.Session()
+    s.mount("http://", RateLimitedAdapter(limiter=limiter, **kwargs))
+    return s
+
+
+@pytest.mark.parametrize("limiter", [None, RateLimiter("test")])
+def test_server_error_retried(failing_server, limiter):
+    url, seen = failing_server
+    r = session(limiter).get(url + "/1/repo")
+    assert r.status_code == 200
+    assert seen["/1/repo"] == 2
+
+
+def test_server_error_retried_post(failing_server):
+    url, seen = failing_server
+    r = session().post(url + "/1/graphql", json={"query": "{}"})
+    assert r.status_code == 200
+    assert seen["/1/graphql"] == 2
+
+
+def test_server_error_returned_once_retries_are_used(failing_server):
+    url, seen = failing_server
+    r = session(max_retries=server_error_retry(backoff_factor=0.0)).get(
+        url + "/100/repo"
+    )
+    assert r.status_code == 502
+    assert seen["/100/repo"] == 4
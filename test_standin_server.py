@@ -0,0 +1,235 @@
+"""
+Run the GitHub and Travis updates against `standin_server`, offline
+
+    python -m pytest -q test_standin_server.py
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import code_stats as cs
+import update_all
+from standin_server import StandinServer, SyntheticAPI
+
+repo_names = ["standin-org/alpha", "standin-org/beta"]
+package_names = ["standin-org/gamma", "standin-org/delta"]
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """A StandinServer, with code_stats configured in `tmp_path` to use it"""
+    server = StandinServer(
+        SyntheticAPI(
+            repo_names + update_all.repos,
+            seed=1,
+            push_denied_rate=0.0,
+            travis_rate=1.0,
+            packages=package_names + [
+                channel + "/package" for channel in update_all.anaconda_channels
+            ],
+        )
+    ).start()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("PRISMS_CODE_STATS_DIR", str(tmp_path))
+    monkeypatch.setenv("PRISMS_CODE_STATS_GITHUB_URL", server.github_url)
+    monkeypatch.setenv("PRISMS_CODE_STATS_TRAVIS_URL", server.travis_url)
+    monkeypatch.setenv("PRISMS_CODE_STATS_ANACONDA_URL", server.anaconda_url)
+    yield server
+    server.stop()
+
+
+def stats_sums(db, cols):
+    """:return: dict of {repo name: {col: sum}}"""
+    sums = {}
+    for row in db.conn.execute(
+        "SELECT r.name" + "".join(", SUM(s." + col + ")" for col in cols)
+        + " FROM stats AS s JOIN repos AS r ON r.repo_id = s.repo_id GROUP BY r.name"
+    ):
+        sums[row[0]] = dict(zip(cols, row[1:]))
+    return sums
+
+
+def test_github_update_stats(server):
+    db = cs.GithubStats()
+    db.connect()
+    db.add_repos(repo_names)
+    db.update_stats(max_workers=2)
+
+    sums = stats_sums(db, ["views", "clones", "stargazers_count"])
+    assert sorted(sums) == repo_names
+    for repo_name in repo_names:
+        assert sums[repo_name]["views"] is not None
+        assert sums[repo_name]["clones"] is not None
+        assert sums[repo_name]["stargazers_count"] is not None
+    version = db.stats_version()
+
+    # the same responses again, from the HTTP cache, change nothing
+    db.update_stats(max_workers=2)
+    assert db.stats_version() == version
+    db.close()
+
+
+def test_github_client_requester_attributes(server):
+    """`github_client` sets private attributes of PyGithub's Requester"""
+    from github import Github
+    from github.Requester import (
+        HTTPRequestsConnectionClass,
+        HTTPSRequestsConnectionClass,
+    )
+
+    names = [
+        "_Requester__httpConnectionClass",
+        "_Requester__httpsConnectionClass",
+        "_Requester__connectionClass",
+        "_Requester__persist",
+    ]
+    plain = Github(base_url=server.github_url)
+    for name in names:
+        assert hasattr(plain.requester, name)
+
+    g = cs.github_client("token", base_url=server.github_url)
+    for lazy in (False, True):
+        requester = g.withLazy(lazy).requester
+        assert requester.is_lazy == lazy
+        assert requester._Requester__persist is False
+        assert requester._Requester__connectionClass is (
+            requester._Requester__httpConnectionClass
+        )
+        assert requester._Requester__connectionClass.__name__ == (
+            "SharedSessionConnection"
+        )
+    assert g.get_repo(repo_names[0]).full_name == repo_names[0]
+    g.close()
+
+    # other clients keep PyGithub's connection classes
+    requester = Github(base_url=server.github_url).requester
+    assert requester._Requester__httpConnectionClass is HTTPRequestsConnectionClass
+    assert requester._Requester__httpsConnectionClass is HTTPSRequestsConnectionClass
+
+
+def test_github_views_kept_when_clones_fail(server, monkeypatch):
+    from github.GithubException import GithubException
+    from github.Repository import Repository
+
+    def get_clones_traffic(self, *args, **kwargs):
+        raise GithubException(502, {"message": "Server Error"}, None)
+
+    monkeypatch.setattr(Repository, "get_clones_traffic", get_clones_traffic)
+    db = cs.GithubStats()
+    db.connect()
+    db.add_repos(repo_names)
+    assert sorted(db.update_repos(max_workers=2)) == repo_names
+
+    sums = stats_sums(db, ["views", "clones"])
+    for repo_name in repo_names:
+        assert sums[repo_name]["views"] is not None
+        assert sums[repo_name]["clones"] is None
+    db.close()
+
+
+def test_travis_update_stats(server):
+    db = cs.TravisStats()
+    db.connect()
+    db.add_repos(repo_names)
+    db.update_stats()
+
+    sums = stats_sums(db, ["build_count"])
+    assert sorted(sums) == repo_names
+    for repo_name in repo_names:
+        assert sums[repo_name]["build_count"] > 0
+    db.close()
+
+
+def test_travis_repo_error_fails_only_that_repo(server, monkeypatch):
+    get_build_counts_async = cs.TravisStats._get_build_counts_async
+    failing_ids = []
+
+    async def get_build_counts(self, travis_id, since, semaphore):
+        if travis_id in failing_ids:
+            raise ValueError("invalid JSON")
+        return await get_build_counts_async(self, travis_id, since, semaphore)
+
+    monkeypatch.setattr(cs.TravisStats, "_get_build_counts_async", get_build_counts)
+    db = cs.TravisStats()
+    db.connect()
+    db.add_repos(repo_names)
+    db._connect_session()
+    db._check_travis_ids()
+    failing_ids.append(
+        db.conn.execute(
+            "SELECT travis_id FROM repos WHERE name=?", (repo_names[0],)
+        ).fetchone()[0]
+    )
+    assert db.update_repos() == [repo_names[0]]
+
+    sums = stats_sums(db, ["build_count"])
+    assert list(sums) == [repo_names[1]]
+    db.close()
+
+
+def test_daemon_discovers_anaconda_channel_packages(server):
+    import daemon
+
+    scheduler = daemon.Scheduler(
+        cs.AnacondaStats, db_kwargs={"channels": ["standin-org"]}, repos=[]
+    )
+    result = scheduler.run_tick()
+    assert result["due"] == len(package_names)
+
+    db = cs.AnacondaStats()
+    db.connect(readonly=True)
+    assert sorted(db.list_repo_names()) == sorted(package_names)
+    db.close()
+
+
+def test_anaconda_failed_channel_listing(server):
+    db = cs.AnacondaStats(channels=["standin-org", "missing-org"])
+    db.connect()
+    assert db.update_repos() == ["missing-org"]
+    assert sorted(db.list_repo_names()) == sorted(package_names)
+    db.close()
+
+
+def test_cli_update_all_providers(server, tmp_path):
+    """`code_stats.py update` as run by refresh.sh, a script in a subprocess"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code_stats.py")
+    r = subprocess.run(
+        [sys.executable, script, "update", "--provider", "all"],
+        cwd=str(tmp_path),
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    assert r.returncode == 0, r.stdout + r.stderr
+
+    for db_cls, names in [
+        (cs.AnacondaStats, [c + "/package" for c in update_all.anaconda_channels]),
+        (cs.GithubStats, update_all.repos),
+        (cs.TravisStats, update_all.repos),
+    ]:
+        db = db_cls()
+        db.connect(readonly=True)
+        assert sorted(db.list_repo_names()) == sorted(names)
+        assert db.conn.execute("SELECT COUNT(*) FROM stats").fetchone()[0] > 0
+        db.close()
+
+
+def test_readonly_connections_shared(server):
+    db = cs.TravisStats()
+    db.connect()
+    db.add_repos(repo_names)
+    db.close()
+
+    db.connect(readonly=True)
+    conn = db.conn
+    db.close()
+    other = cs.TravisStats()
+    other.connect(readonly=True)
+    assert other.conn is conn
+    assert sorted(other.list_repo_names()) == repo_names
+    other.close()
+    cs.close_reader_pools()
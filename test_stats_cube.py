@@ -0,0 +1,31 @@
+"""
+    python -m pytest -q test_stats_cube.py
+"""
+
+import datetime
+
+import numpy as np
+
+from stats_cube import StatsCube
+
+
+def cube():
+    return StatsCube(
+        np.arange(6, dtype=np.float64).reshape(3, 2, 1),
+        ["a/x", "b/y", "c/z"],
+        [datetime.date(2020, 1, 3), datetime.date(2020, 1, 10)],
+        ["views"],
+    )
+
+
+def test_merge_includes_the_name_itself():
+    for group in (["b/y"], ["a/x", "b/y"]):
+        merged = cube().merge({"a/x": group})
+        assert merged.repos == ["a/x", "c/z"]
+        assert merged.values[:, :, 0].tolist() == [[2.0, 4.0], [4.0, 5.0]]
+
+
+def test_merge_into_new_name():
+    merged = cube().merge({"n/w": ["b/y", "c/z"]})
+    assert merged.repos == ["a/x", "n/w"]
+    assert merged.values[:, :, 0].tolist() == [[0.0, 1.0], [6.0, 8.0]]
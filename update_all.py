@@ -1,4 +1,5 @@
-from code_stats import GithubStats, TravisStats
+import instrument
+from code_stats import AnacondaStats, GithubStats, TravisStats
 
 repos = [
     "prisms-center/phaseField",
@@ -10,17 +11,41 @@ repos = [
     "prisms-center/Fatigue",
     "dftfeDevelopers/dftfe"]
 
-def update_all(db_cls, repos):
+# anaconda.org channels whose packages are all tracked, and packages of other
+# channels, as "channel/package"
+anaconda_channels = ["prisms-center"]
+anaconda_packages = []
+
+def provider_repos(db_cls):
+    """:return: list of str, the repos listed here for `db_cls`"""
+    # by attribute, not class identity, so this also holds for the classes
+    # of code_stats run as a script
+    if db_cls.github_repos:
+        return repos
+    return anaconda_packages
+
+def update_all(db_cls, repos, db_kwargs=None, shard=None, **kwargs):
+    """
+    :param db_kwargs: dict, passed to `db_cls` when constructed
+    :param shard: (index, n_shards), optional, update the shard database of
+        `db_cls`, which should be given only the shard's `repos`
+    :param kwargs: passed to `db_cls.update_stats`
+    """
     print("begin update_all:", str(db_cls))
-    db = db_cls()
+    db = db_cls(**(db_kwargs or {}))
+    db.shard = shard
     db.connect()
-    for repo_name in repos:
-        db.add_repo(repo_name)
-    db.update_stats()
+    db.add_repos(repos)
+    with instrument.timer("update", provider=db._shortname()):
+        db.update_stats(**kwargs)
     # for repo_name in db.list_repo_names():
     #     print("Repository:", repo_name)
     #     db.print_stats(repo_name)
     db.close()
 
-update_all(GithubStats, repos)
-update_all(TravisStats, repos)
+if __name__ == "__main__":
+    update_all(GithubStats, repos)
+    update_all(TravisStats, repos)
+    update_all(
+        AnacondaStats, anaconda_packages, db_kwargs={"channels": anaconda_channels}
+    )
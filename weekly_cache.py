@@ -0,0 +1,151 @@
+"""
+Cache weekly stats sums in memory-mapped .npy files next to the database
+
+Each cache file holds `code_stats_data.get_weekly_arrays` values for one
+list of columns, with a JSON file recording the repos, weeks and the
+database's `stats_version` it was computed at. When stats change, only the
+weeks from the first changed day on are summed again.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import code_stats as cs
+import code_stats_data
+import instrument
+
+
+def cache_dir(db):
+    return os.path.join(cs.code_stats_prefix(), db._shortname() + "_cache")
+
+
+def cache_paths(db, cols):
+    """
+    :return (npy_path, meta_path): str, the cache files for `cols`
+    """
+    name = "weekly-" + hashlib.sha1(json.dumps(list(cols)).encode()).hexdigest()[:12]
+    return (
+        os.path.join(cache_dir(db), name + ".npy"),
+        os.path.join(cache_dir(db), name + ".json"),
+    )
+
+
+def read_meta(meta_path):
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    tmp = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def first_week_changed(meta, repo_names, dates, cols, db):
+    """
+    :return: int, index of the first week the cache described by `meta` does
+        not hold up to date sums for; 0 if it can not be used at all
+    """
+    if meta is None:
+        return 0
+    if (
+        meta["cols"] != list(cols)
+        or meta["repos"] != repo_names
+        or meta["first_date"] != dates[0].isoformat()
+        or meta["n_dates"] > len(dates)
+    ):
+        return 0
+    day = db.first_day_changed_since(meta["version"])
+    if day is None:
+        return meta["n_dates"]
+    # index of the week containing `day`, as in `code_stats_data.week_index_sql`
+    week = max(0, (day - cs.toordinal(dates[0]) + 6) // 7)
+    return min(week, meta["n_dates"])
+
+
+def get_weekly_arrays(db, dates, cols):
+    """
+    As `code_stats_data.get_weekly_arrays`, reading the cache for `cols`, and
+    updating it first if stats changed since it was written
+
+    The cache is read and updated in one read transaction, so the values
+    match one `stats_version`.
+
+    :param db: StatsBase, connected
+    :param dates: list of datetime.date, one week apart, as from
+        `code_stats_data.get_weekly_dates`
+    :param cols: list of str, stats columns
+    :return (repo_names, values): list of str, and a read-only numpy.memmap of
+        float64 with shape (len(repo_names), len(dates), len(cols))
+    """
+    if not len(dates):
+        return code_stats_data.get_weekly_arrays(db, dates, cols)
+    npy_path, meta_path = cache_paths(db, cols)
+
+    db.conn.commit()
+    db.conn.execute("BEGIN")
+    try:
+        version = db.stats_version()
+        repo_names = [r["name"] for r in code_stats_data.get_repos(db)]
+        meta = read_meta(meta_path)
+        if not os.path.isfile(npy_path):
+            meta = None
+        first_week = first_week_changed(meta, repo_names, dates, cols, db)
+        if first_week == len(dates) and meta["n_dates"] == len(dates):
+            if meta["version"] != version:
+                meta["version"] = version
+                _write_json(meta_path, meta)
+            instrument.count("weekly_cache_hits", db=db._shortname())
+            return repo_names, np.load(npy_path, mmap_mode="r")
+
+        _, recent = code_stats_data.get_weekly_arrays(
+            db, dates, cols, first_week=first_week
+        )
+        os.makedirs(cache_dir(db), exist_ok=True)
+        tmp = npy_path + "." + str(os.getpid()) + ".tmp"
+        values = np.lib.format.open_memmap(
+            tmp,
+            mode="w+",
+            dtype=np.float64,
+            shape=(len(repo_names), len(dates), len(cols)),
+        )
+        if first_week > 0:
+            values[:, :first_week, :] = np.load(npy_path, mmap_mode="r")[
+                :, :first_week, :
+            ]
+        values[:, first_week:, :] = recent
+        values.flush()
+        del values
+
+        # without meta the cache is rebuilt, so remove it while replacing the data
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        os.replace(tmp, npy_path)
+        _write_json(
+            meta_path,
+            {
+                "version": version,
+                "repos": repo_names,
+                "cols": list(cols),
+                "first_date": dates[0].isoformat(),
+                "n_dates": len(dates),
+                "updated": datetime.datetime.now().isoformat(),
+            },
+        )
+        instrument.count(
+            "weekly_cache_weeks_summed", len(dates) - first_week, db=db._shortname()
+        )
+        print(
+            "Updated weekly cache", os.path.basename(npy_path) + ":",
+            len(dates) - first_week, "of", len(dates), "weeks",
+        )
+        return repo_names, np.load(npy_path, mmap_mode="r")
+    finally:
+        db.conn.rollback()